@@ -59,7 +59,7 @@ class TripSerializer(serializers.ModelSerializer):
             (link.from_stop_id, link.to_stop_id): link for link in route_links
         }
         previous_stop_id = None
-        for stop_time in obj.stoptime_set.all():
+        for stop_time in obj.stop_times:
             route_link = route_links.get((previous_stop_id, stop_time.stop_id))
             yield {
                 "stop": {
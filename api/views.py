@@ -29,7 +29,9 @@ class VehicleTypeViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 class TripViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Trip.objects.select_related('route__service').prefetch_related('stoptime_set__stop__locality')
+    queryset = Trip.objects.select_related('route__service').prefetch_related(
+        'stoptime_set__stop__locality', 'timing_pattern__timingpatternstop_set__stop__locality'
+    )
     serializer_class = serializers.TripSerializer
     pagination_class = LimitedPagination
 
@@ -296,7 +296,7 @@ class DataSourceAdmin(admin.ModelAdmin):
     journeys.admin_order_field = 'journeys'
 
     def delete_routes(self, request, queryset):
-        result = Route.objects.filter(source__in=queryset).delete()
+        result = models.Service.delete_routes(Route.objects.filter(source__in=queryset))
         self.message_user(request, result)
 
     def remove_datetimes(self, request, queryset):
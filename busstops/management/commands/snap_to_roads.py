@@ -21,13 +21,16 @@ class Command(BaseCommand):
         for service in Service.objects.filter(current=True, operator='LYNX'):
             print(service)
             linestrings = []
-            for trip in Trip.objects.filter(route__service=service).distinct('journey_pattern'):
+            trips = Trip.objects.filter(route__service=service).distinct('journey_pattern').prefetch_related(
+                'stoptime_set__stop', 'timing_pattern__timingpatternstop_set__stop'
+            )
+            for trip in trips:
                 points = [
                     {
                         'lat': stoptime.stop.latlong.y,
                         'lon': stoptime.stop.latlong.x,
                         'time': stoptime.arrival.total_seconds()
-                    } for stoptime in trip.stoptime_set.all()
+                    } for stoptime in trip.stop_times
                 ]
                 r = session.post('https://api.stadiamaps.com/trace_route', params=params, json={
                     'costing': 'bus',
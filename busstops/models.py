@@ -9,20 +9,20 @@ from urllib.parse import urlencode
 from autoslug import AutoSlugField
 
 from django.contrib.gis.db import models
-from django.contrib.gis.db.models import Union
-from django.contrib.gis.geos import LineString, MultiLineString
 from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.contrib.postgres.aggregates import StringAgg, ArrayAgg
 from django.contrib.postgres.indexes import GinIndex
 from django.core.cache import cache
+from django.db import connection, transaction
 from django.db.models import Q, OuterRef, Exists
 from django.db.models.functions import Upper, Coalesce
 from django.urls import reverse
 from django.utils.text import slugify
+from django.utils.timezone import localdate
 from django.utils.html import format_html, escape
 from django.utils.safestring import mark_safe
 
-from bustimes.models import Route, Trip
+from bustimes.models import get_routes, Route, Trip
 from bustimes.timetables import Timetable, get_stop_usages
 from buses.utils import varnish_ban
 
@@ -881,9 +881,87 @@ class Service(models.Model):
                 return timetable_change
             previous_route = route
 
+    @staticmethod
+    def get_timetable_version_key(service_id):
+        return f'{service_id}timetable_version'
+
+    @classmethod
+    def timetables_changed(cls, service_ids):
+        """Call after changing services' routes or trips, so any cached timetables aren't used
+        (once the transaction is committed - otherwise a timetable could be rebuilt from the old data in the meantime)
+        """
+        keys = [cls.get_timetable_version_key(service_id) for service_id in service_ids]
+        transaction.on_commit(lambda: cache.set_many({key: time.time() for key in keys}, None))
+
+    @classmethod
+    def delete_routes(cls, routes):
+        """Delete some routes (a QuerySet), and call timetables_changed for their services
+        (which an importer's finish_services might not know about, if they still have other routes).
+        Returns the same as QuerySet.delete
+        """
+        service_ids = set(routes.values_list('service', flat=True))
+        if not service_ids:
+            return 0, {}
+        cls.timetables_changed(service_ids)
+        return routes.delete()
+
+    @classmethod
+    def get_timetable_versions(cls, service_ids):
+        """Each service's current timetable version (see timetables_changed), keyed by service id"""
+        keys = {service_id: cls.get_timetable_version_key(service_id) for service_id in service_ids}
+        versions = cache.get_many(keys.values())
+        if len(versions) < len(keys):
+            # no version yet (or it's been evicted) - start a new one, so older cached things can't be used
+            missing = {key: time.time() for key in keys.values() if key not in versions}
+            cache.set_many(missing, None)
+            versions.update(missing)
+        return {service_id: versions[key] for service_id, key in keys.items()}
+
+    @classmethod
+    def get_current_route_ids(cls, service_ids, date=None, routes=None):
+        """Given some service ids, return the ids of each service's current routes (see get_routes) on a date,
+        keyed by service id - from the cache if possible, until a service's timetable version changes.
+        routes is each service's routes (with their sources), if they've already been got
+        """
+        versions = cls.get_timetable_versions(service_ids)
+        keys = {service_id: f'{service_id}route_ids{version}{date}' for service_id, version in versions.items()}
+        cached = cache.get_many(keys.values())
+        route_ids = {service_id: cached[key] for service_id, key in keys.items() if key in cached}
+
+        missing = [service_id for service_id in keys if service_id not in route_ids]
+        if missing:
+            if routes is None:
+                routes = {}
+                for route in Route.objects.filter(service__in=missing).select_related('source'):
+                    routes.setdefault(route.service_id, []).append(route)
+            for service_id in missing:
+                route_ids[service_id] = [route.id for route in get_routes(routes.get(service_id, []), date)]
+            cache.set_many({keys[service_id]: route_ids[service_id] for service_id in missing}, 86400)
+
+        return route_ids
+
+    def get_timetable_cache_key(self, day=None, related=(), detailed=False):
+        versions = self.get_timetable_versions([self.id] + [service.id for service in related])
+        versions = ','.join(str(version) for version in versions.values())
+        # (the date options depend on today's date)
+        return f'{self.id}timetable{versions}{day}{localdate()}{detailed}'
+
     def get_timetable(self, day=None, related=(), detailed=False):
-        """Given a Service, return a Timetable"""
+        """Given a Service, return a Timetable (from the cache if possible)"""
+
+        key = self.get_timetable_cache_key(day, related, detailed)
+        timetable = cache.get(key)
+        if timetable is None:
+            timetable = self.build_timetable(day, related, detailed)
+            if timetable is None:
+                return
+            cache.set(key, timetable, 86400)
+
+        self.timetable_change = self.get_next_timetable_change(timetable)
 
+        return timetable
+
+    def build_timetable(self, day=None, related=(), detailed=False):
         if self.region_id == 'NI' or self.source and self.source.name.endswith(' GTFS'):
             timetable = Timetable(self.route_set.all(), day)
         else:
@@ -897,8 +975,6 @@ class Service(models.Model):
                 logger.error(e, exc_info=True)
                 return
 
-        self.timetable_change = self.get_next_timetable_change(timetable)
-
         timetable.groupings = [grouping for grouping in timetable.groupings if grouping.rows]
 
         if all(route.line_name == self.line_name for route in timetable.routes):
@@ -916,13 +992,13 @@ class Service(models.Model):
         existing = self.stopusage_set.all()
 
         stop_usages = [
-            StopUsage(service=self, stop_id=stop_time.stop_id, timing_status=stop_time.timing_status,
+            StopUsage(service=self, stop_id=stop_id, timing_status=timing_status,
                       direction='outbound', order=i)
-            for i, stop_time in enumerate(outbound)
+            for i, (stop_id, timing_status) in enumerate(outbound)
         ] + [
-            StopUsage(service=self, stop_id=stop_time.stop_id, timing_status=stop_time.timing_status,
+            StopUsage(service=self, stop_id=stop_id, timing_status=timing_status,
                       direction='inbound', order=i)
-            for i, stop_time in enumerate(inbound)
+            for i, (stop_id, timing_status) in enumerate(inbound)
         ]
 
         existing_hash = [(su.stop_id, su.timing_status, su.direction, su.order) for su in existing]
@@ -935,33 +1011,68 @@ class Service(models.Model):
 
         return stop_usages
 
-    def update_geometry(self):
-        geometry = self.route_set.aggregate(Union('geometry'))['geometry__union']
-        if geometry:
-            geometry = geometry.simplify()
-        else:
-            patterns = []
-            linestrings = []
-            for trip in Trip.objects.filter(route__service=self).prefetch_related('stoptime_set__stop'):
-                stops = [
-                    stoptime.stop for stoptime in trip.stoptime_set.all() if stoptime.stop and stoptime.stop.latlong
-                ]
-                pattern = [stop.pk for stop in stops]
-                if pattern in patterns:
-                    continue
-                patterns.append(pattern)
-                points = [stop.latlong for stop in stops]
-                if len(points) > 1:
-                    linestrings.append(LineString(points))
-            if linestrings:
-                geometry = MultiLineString(*linestrings).simplify()
-
-        if geometry:
-            if type(geometry) is LineString:
-                self.geometry = MultiLineString(geometry)
-            else:
-                self.geometry = geometry
-            self.save(update_fields=['geometry'])
+    @staticmethod
+    def update_geometries(service_ids):
+        """Set some services' geometry fields, in one statement, to the union of their routes' geometries or
+        (if none of a service's routes have a geometry) the lines between stops of each distinct sequence of stops.
+        A service's geometry is left alone if neither is available
+        """
+        if not service_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(UPDATE_GEOMETRIES_SQL, {'service_ids': list(service_ids)})
+
+
+# used by Service.update_geometries.
+# lines are made from each trip's own stop times or (once per timing pattern) its timing pattern's stops,
+# then only the first line with each distinct sequence of stops is used
+UPDATE_GEOMETRIES_SQL = """
+WITH route_geometries AS (
+    SELECT service_id, ST_Union(geometry) AS geometry
+    FROM bustimes_route
+    WHERE service_id = ANY(%(service_ids)s) AND geometry IS NOT NULL
+    GROUP BY service_id
+), lines AS (
+    SELECT route.service_id, trip.id AS trip_id,
+        ARRAY_AGG(stop.atco_code ORDER BY stop_time.id) AS stops,
+        ST_MakeLine(stop.latlong ORDER BY stop_time.id) AS line
+    FROM bustimes_route route
+    INNER JOIN bustimes_trip trip ON trip.route_id = route.id
+    INNER JOIN bustimes_stoptime stop_time ON stop_time.trip_id = trip.id
+    INNER JOIN busstops_stoppoint stop ON stop.atco_code = stop_time.stop_id
+    WHERE route.service_id = ANY(%(service_ids)s) AND trip.timing_pattern_id IS NULL AND stop.latlong IS NOT NULL
+    GROUP BY route.service_id, trip.id
+  UNION ALL
+    SELECT route.service_id, MIN(trip.id) AS trip_id,
+        ARRAY_AGG(stop.atco_code ORDER BY pattern_stop.id) AS stops,
+        ST_MakeLine(stop.latlong ORDER BY pattern_stop.id) AS line
+    FROM bustimes_route route
+    INNER JOIN bustimes_timingpattern pattern ON pattern.route_id = route.id
+    INNER JOIN LATERAL (
+        SELECT MIN(id) AS id FROM bustimes_trip WHERE timing_pattern_id = pattern.id
+    ) trip ON trip.id IS NOT NULL
+    INNER JOIN bustimes_timingpatternstop pattern_stop ON pattern_stop.pattern_id = pattern.id
+    INNER JOIN busstops_stoppoint stop ON stop.atco_code = pattern_stop.stop_id
+    WHERE route.service_id = ANY(%(service_ids)s) AND stop.latlong IS NOT NULL
+    GROUP BY route.service_id, pattern.id
+), distinct_lines AS (
+    SELECT DISTINCT ON (service_id, stops) service_id, trip_id, line
+    FROM lines
+    WHERE service_id NOT IN (SELECT service_id FROM route_geometries)
+    ORDER BY service_id, stops, trip_id
+), geometries AS (
+    SELECT service_id, geometry FROM route_geometries
+  UNION ALL
+    SELECT service_id, ST_Collect(line ORDER BY trip_id) AS geometry
+    FROM distinct_lines
+    WHERE ST_NPoints(line) > 1
+    GROUP BY service_id
+)
+UPDATE busstops_service service
+SET geometry = ST_Multi(ST_Simplify(geometries.geometry, 0))
+FROM geometries
+WHERE service.id = geometries.service_id
+"""
 
 
 class ServiceCode(models.Model):
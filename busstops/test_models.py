@@ -1,4 +1,5 @@
-from django.test import TestCase
+from datetime import date
+from django.test import TestCase, override_settings
 from bustimes.models import Route
 from accounts.models import User
 from .models import (
@@ -154,6 +155,37 @@ class ServiceTests(TestCase):
         self.assertEqual('20', self.london_service.get_operator_number('WAIR'))
         self.assertEqual('18', self.london_service.get_operator_number('TVSN'))
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_get_current_route_ids(self):
+        route_1, route_2 = self.service.route_set.order_by('start_date')
+
+        with self.assertNumQueries(1):
+            route_ids = Service.get_current_route_ids([self.service.id, self.london_service.id], date(2012, 2, 1))
+        self.assertEqual(route_ids, {self.service.id: [route_1.id], self.london_service.id: []})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Service.get_current_route_ids([self.service.id], date(2012, 2, 1)), {
+                self.service.id: [route_1.id]
+            })
+
+        # worked out again after an import
+        route_2.start_date = date(2012, 1, 1)
+        route_2.save(update_fields=['start_date'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Service.timetables_changed([self.service.id])
+        with self.assertNumQueries(1):
+            route_ids = Service.get_current_route_ids([self.service.id], date(2012, 2, 1))
+        self.assertEqual(sorted(route_ids[self.service.id]), sorted([route_1.id, route_2.id]))
+
+        # deleting a route (but not all of the service's routes)
+        with self.captureOnCommitCallbacks(execute=True):
+            Service.delete_routes(Route.objects.filter(id=route_2.id))
+        with self.assertNumQueries(1):
+            route_ids = Service.get_current_route_ids([self.service.id], date(2012, 2, 1))
+        self.assertEqual(route_ids[self.service.id], [route_1.id])
+
+        self.assertEqual(Service.delete_routes(Route.objects.none()), (0, {}))
+
     def test_admin(self):
         self.client.force_login(self.user)
 
@@ -23,6 +23,7 @@ urlpatterns = [
     path('data', views.data),
     path('status', views.status),
     path('stops.json', views.stops),
+    path('stops/departures.json', views.stops_departures),
     path('regions/<pk>', views.RegionDetailView.as_view(), name='region_detail'),
     path('places/<int:pk>', views.PlaceDetailView.as_view(), name='place_detail'),
     re_path(r'^(admin-)?areas/(?P<pk>\d+)', views.AdminAreaDetailView.as_view(), name='adminarea_detail'),
@@ -34,6 +35,7 @@ urlpatterns = [
     path('operators/<slug>', views.OperatorDetailView.as_view(), name='operator_detail'),
     path('services/<int:service_id>.json', views.service_map_data),
     path('services/<int:service_id>/timetable', views.service_timetable),
+    path('services/<int:service_id>/timetable.json', views.service_timetable_json),
     path('services/<slug>', views.ServiceDetailView.as_view(), name='service_detail'),
     path('sitemap.xml', index, {'sitemaps': sitemaps}),
     path('sitemap-<section>.xml', sitemap, {'sitemaps': sitemaps},
@@ -3,6 +3,7 @@
 import json
 import requests
 import datetime
+from hashlib import sha1
 from ukpostcodeutils import validation
 
 from django.shortcuts import render, get_object_or_404, get_list_or_404, redirect
@@ -16,6 +17,7 @@ from django.db.models.functions import Now
 from django.http import JsonResponse, Http404, HttpResponseBadRequest
 from django.utils import timezone
 from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.detail import DetailView
 from django.core.paginator import Paginator
 from django.contrib.sitemaps import Sitemap
@@ -24,12 +26,13 @@ from django.core.mail import EmailMessage
 from departures import live
 from disruptions.models import Situation, Consequence
 from fares.forms import FaresForm
-from bustimes.models import get_routes
+from bustimes.models import get_routes, Route
+from bustimes.timetables import Repetition
 from vehicles.models import Vehicle
 from vosa.models import Registration
 from .utils import get_bounding_box
 from .models import (Region, StopPoint, AdminArea, Locality, District, Operator,
-                     Service, Place, ServiceColour, DataSource)
+                     Service, ServiceLink, Place, ServiceColour, DataSource)
 from .forms import ContactForm, SearchForm
 
 
@@ -214,6 +217,31 @@ def stops(request):
     })
 
 
+def stops_departures(request):
+    """JSON endpoint for the apps, with live departures for several stops (e.g. ?stops=2000G000106,2000G000400)
+    from SIRI-SM sources - keyed by ATCO code, without the stops that have no source
+    """
+    atco_codes = request.GET.get('stops', '').split(',')[:live.MAX_STOPS]
+    if not any(atco_codes):
+        return HttpResponseBadRequest()
+
+    current_services = Service.objects.filter(current=True).defer('geometry')
+    stops = StopPoint.objects.filter(atco_code__in=atco_codes, active=True).prefetch_related(
+        Prefetch('service_set', queryset=current_services, to_attr='current_services')
+    ).defer('latlong')
+
+    departures = live.get_siri_departures([(stop, stop.current_services) for stop in stops])
+
+    return JsonResponse({
+        atco_code: [{
+            'time': row['time'],
+            'live': row['live'],
+            'service': row['service'].line_name if type(row['service']) is Service else row['service'],
+            'destination': row['destination'],
+        } for row in rows] for atco_code, rows in departures.items() if rows is not None
+    })
+
+
 class UppercasePrimaryKeyMixin:
     """Normalises the primary key argument to uppercase"""
     def get_object(self, queryset=None):
@@ -715,24 +743,111 @@ class ServiceDetailView(DetailView):
         return super().render_to_response(context)
 
 
+def get_service_timetable(service, date):
+    parallel = service.get_linked_services()
+    timetable = service.get_timetable(date, parallel)
+    if timetable:
+        stops = StopPoint.objects.select_related('locality').defer('latlong', 'locality__latlong')
+        stop_codes = (row.stop.atco_code for grouping in timetable.groupings for row in grouping.rows)
+        stops = stops.in_bulk(stop_codes)
+        for grouping in timetable.groupings:
+            grouping.apply_stops(stops)
+    return timetable
+
+
 def service_timetable(request, service_id):
     service = get_object_or_404(Service.objects.defer('geometry'), id=service_id)
     date = request.GET.get('date')
     if date:
         date = datetime.date.fromisoformat(date)
-    parallel = service.get_linked_services()
-    timetable = service.get_timetable(date, parallel)
-    stops = StopPoint.objects.select_related('locality').defer('latlong', 'locality__latlong')
-    stop_codes = (row.stop.atco_code for grouping in timetable.groupings for row in grouping.rows)
-    stops = stops.in_bulk(stop_codes)
-    for grouping in timetable.groupings:
-        grouping.apply_stops(stops)
+    timetable = get_service_timetable(service, date)
     return render(request, 'timetable.html', {
         'object': service,
         'timetable': timetable
     })
 
 
+def service_timetable_etag(request, service_id):
+    """Changes whenever the service's (or a parallel service's) routes or timetable version
+    (see Service.timetables_changed) do, or their sources are updated, or their stops are renamed -
+    or the date changes (as the date options depend on it)
+    """
+    linked = ServiceLink.objects.filter(
+        Q(from_service=service_id, to_service=OuterRef('id')) |
+        Q(from_service=OuterRef('id'), to_service=service_id),
+        how='parallel'
+    )
+    service_ids = [service_id] + sorted(Service.objects.filter(Exists(linked)).values_list('id', flat=True))
+    versions = Service.get_timetable_versions(service_ids)
+    routes = Route.objects.filter(service__in=service_ids).order_by('id')
+    routes = list(routes.values_list('id', 'source__datetime'))
+    # (the fields that StopPoint.get_qualified_name uses)
+    stops = StopPoint.objects.filter(service__in=service_ids).distinct().order_by('atco_code')
+    stops = list(stops.values_list('atco_code', 'common_name', 'indicator', 'town', 'locality__name'))
+    key = f"{service_ids}{versions}{routes}{stops}{request.GET.get('date')}{timezone.localdate()}"
+    return sha1(key.encode()).hexdigest()
+
+
+def get_cell_json(cell):
+    """A time in seconds, or [arrival, departure] if they're different, or None if the trip doesn't stop"""
+    if not cell:
+        return None
+    arrival = int(cell.arrival.total_seconds())
+    if cell.wait_time:
+        return [arrival, int(cell.departure.total_seconds())]
+    return arrival
+
+
+@condition(etag_func=service_timetable_etag)
+def service_timetable_json(request, service_id):
+    service = get_object_or_404(Service.objects.defer('geometry'), id=service_id)
+    date = request.GET.get('date')
+    if date:
+        try:
+            date = datetime.date.fromisoformat(date)
+        except ValueError:
+            return HttpResponseBadRequest()
+    timetable = get_service_timetable(service, date)
+
+    groupings = []
+    for grouping in timetable.groupings if timetable else ():
+        # 'then every x minutes until' cells, which stand in for some trips and (in the HTML) span all the rows -
+        # 'column' is the index in each row's times that it comes before
+        repetitions = []
+        column = 0
+        for cell in grouping.rows[0].times:
+            if type(cell) is Repetition:
+                repetitions.append({
+                    'column': column,
+                    'span': cell.colspan,
+                    'every': int(cell.duration.total_seconds())
+                })
+            else:
+                column += 1
+
+        groupings.append({
+            'inbound': grouping.inbound,
+            'rows': [{
+                'stop': {
+                    'atco_code': row.stop.atco_code,
+                    'name': row.stop.get_qualified_name() if type(row.stop) is StopPoint else str(row.stop),
+                },
+                'minor': row.is_minor(),
+                'times': [get_cell_json(cell) for cell in row.times if type(cell) is not Repetition]
+            } for row in grouping.rows],
+            'notes': [
+                [{'text': foot.notes or None, 'span': foot.span} for foot in feet]
+                for feet in grouping.column_feet.values()
+            ],
+            'repetitions': repetitions
+        })
+
+    return JsonResponse({
+        'date': timetable and timetable.date,
+        'groupings': groupings
+    })
+
+
 @cache_control(max_age=86400)
 def service_map_data(request, service_id):
     service = get_object_or_404(Service.objects.only('geometry'), id=service_id)
@@ -5,14 +5,30 @@ from django.contrib.gis.forms import OSMWidget
 from django.contrib.postgres.aggregates import StringAgg
 from django.utils.safestring import mark_safe
 from django.urls import reverse
+from busstops.models import Service
 from .models import (
     Route, Trip,
     Calendar, CalendarDate, CalendarBankHoliday,
     BankHoliday, BankHolidayDate,
-    Note, StopTime, Garage
+    Note, StopTime, Garage,
+    compile_calendars
 )
 
 
+def calendars_changed(calendars):
+    """Call Service.timetables_changed for the services with trips that use some calendars"""
+    Service.timetables_changed(
+        list(Route.objects.filter(trip__calendar__in=calendars).values_list('service', flat=True).distinct())
+    )
+
+
+def trips_changed(trips):
+    """Call Service.timetables_changed for the services some trips belong to"""
+    Service.timetables_changed(
+        list(Route.objects.filter(trip__in=trips).values_list('service', flat=True).distinct())
+    )
+
+
 class TripInline(admin.TabularInline):
     model = Trip
     show_change_link = True
@@ -35,12 +51,39 @@ class RouteAdmin(admin.ModelAdmin):
     search_fields = ['line_name', 'line_brand', 'description']
     inlines = [TripInline]
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        Service.timetables_changed({form.instance.service_id, form.initial.get('service')} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        Service.timetables_changed([obj.service_id])
+
+    def delete_queryset(self, request, queryset):
+        Service.delete_routes(queryset)
+
 
 @admin.register(Trip)
 class TripAdmin(admin.ModelAdmin):
     raw_id_fields = ['route'] + TripInline.raw_id_fields
     inlines = [StopTimeInline]
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        Service.timetables_changed(
+            Route.objects.filter(id__in=[form.instance.route_id, form.initial.get('route')]).values_list(
+                'service', flat=True
+            )
+        )
+
+    def delete_model(self, request, obj):
+        trips_changed([obj])
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        trips_changed(queryset)
+        super().delete_queryset(request, queryset)
+
 
 class CalendarDateInline(admin.TabularInline):
     model = CalendarDate
@@ -57,6 +100,22 @@ class CalendarDateAdmin(admin.ModelAdmin):
     list_filter = ['start_date', 'end_date']
     raw_id_fields = ['calendar']
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        compile_calendars([obj.calendar])
+        calendars_changed([obj.calendar_id])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        compile_calendars([obj.calendar])
+        calendars_changed([obj.calendar_id])
+
+    def delete_queryset(self, request, queryset):
+        calendars = list(Calendar.objects.filter(calendardate__in=queryset).distinct())
+        super().delete_queryset(request, queryset)
+        compile_calendars(calendars)
+        calendars_changed(calendars)
+
 
 @admin.register(Calendar)
 class CalendarAdmin(admin.ModelAdmin):
@@ -65,7 +124,16 @@ class CalendarAdmin(admin.ModelAdmin):
     list_filter = [
         ('trip', admin.EmptyFieldListFilter)
     ]
-    readonly_fields = ['routes']
+    readonly_fields = ['routes', 'hash']
+
+    def save_model(self, request, obj, form, change):
+        obj.hash = None  # the contents might not match the hash any more, so don't let importers reuse it
+        super().save_model(request, obj, form, change)
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        compile_calendars([form.instance])
+        calendars_changed([form.instance])
 
     def routes(self, obj):
         routes = Route.objects.filter(Exists(Trip.objects.filter(calendar=obj, route=OuterRef('pk'))))
@@ -110,3 +178,9 @@ class BankHolidayDateInline(admin.TabularInline):
 @admin.register(BankHoliday)
 class BankHolidayAdmin(admin.ModelAdmin):
     inlines = [BankHolidayDateInline]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        calendars = Calendar.objects.filter(calendarbankholiday__bank_holiday=form.instance)
+        compile_calendars(calendars)
+        calendars_changed(calendars)
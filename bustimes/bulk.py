@@ -0,0 +1,86 @@
+"""
+Loading lots of rows (Trips and StopTimes, mainly) into the database using PostgreSQL's COPY FROM,
+which is a lot faster than the INSERT statements that bulk_create() uses
+"""
+
+import io
+from django.db import connection
+
+
+def encode(value):
+    """Encode a value (that's already been through Field.get_db_prep_save) for COPY's text format"""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    value = str(value)
+    if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+        value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return value
+
+
+def reserve_ids(model, count):
+    """Get count new primary key values from the model's sequence"""
+    table = model._meta.db_table
+    column = model._meta.pk.column
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            [table, column, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def copy_objects(model, objs, set_ids=False):
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+
+    for obj in objs:
+        # set foreign key ids from related objects that have been saved since being assigned, like bulk_create() does
+        obj._prepare_related_fields_for_save(operation_name='bulk_create')
+
+    if set_ids:
+        new_objs = [obj for obj in objs if obj.pk is None]
+        for obj, pk in zip(new_objs, reserve_ids(model, len(new_objs))):
+            obj.pk = pk
+        fields = [model._meta.pk] + fields
+
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+
+    rows = io.StringIO()
+    for obj in objs:
+        rows.write('\t'.join(
+            encode(field.get_db_prep_save(getattr(obj, field.attname), connection)) for field in fields
+        ))
+        rows.write('\n')
+    rows.seek(0)
+
+    sql = f"COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN"
+    with connection.cursor() as cursor:
+        if hasattr(cursor, 'debug_sql'):
+            # log the query like execute() would (so it counts in assertNumQueries, for example)
+            with cursor.debug_sql(sql):
+                cursor.copy_expert(sql, rows)
+        else:
+            cursor.copy_expert(sql, rows)
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+
+
+def bulk_create(model, objs, batch_size=10000, copy=True, set_ids=False):
+    """
+    Like model.objects.bulk_create(objs), but using COPY if possible.
+    With set_ids=True, primary keys are assigned to the objects first, so that related rows can refer to them.
+    Only suitable for models whose fields are simple types (not geometries).
+    If copy=False (or not using PostgreSQL), fall back to bulk_create()
+    """
+    if not copy or connection.vendor != 'postgresql':
+        return model.objects.bulk_create(objs, batch_size=batch_size)
+
+    objs = list(objs)
+    for i in range(0, len(objs), batch_size):
+        copy_objects(model, objs[i:i + batch_size], set_ids)
+    return objs
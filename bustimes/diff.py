@@ -0,0 +1,175 @@
+"""
+Updating a route's existing trips (and their stop times and notes) to match newly imported ones,
+with as few writes as possible - rather than deleting everything and inserting it all again,
+which churns the biggest tables and changes the trip ids that vehicle journeys link to
+"""
+
+from collections import Counter
+from .bulk import bulk_create
+from .models import Trip, StopTime, Block, TimingPattern
+
+
+TRIP_FIELDS = (
+    'inbound',
+    'journey_pattern',
+    'ticket_machine_code',
+    'vehicle_journey_code',
+    'block',
+    'destination',
+    'calendar',
+    'sequence',
+    'start',
+    'end',
+    'garage',
+    'vehicle_type',
+    'timing_pattern',
+)
+
+STOP_TIME_FIELDS = (
+    'stop_code', 'stop_id', 'arrival', 'departure', 'sequence', 'timing_status', 'pick_up', 'set_down'
+)
+
+
+def get_trip_key(trip):
+    return (trip.vehicle_journey_code, trip.ticket_machine_code, trip.journey_pattern)
+
+
+def match_trips(old_trips, new_trips, get_key):
+    """
+    Pair up old and new trips with the same key (in order of start time, if more than one has the same key).
+    Returns a list of (old trip, new trip) pairs, and the unmatched old and new trips
+    """
+    old_groups = {}
+    for trip in old_trips:
+        old_groups.setdefault(get_key(trip), []).append(trip)
+
+    pairs = []
+    unmatched = []
+    for trip in sorted(new_trips, key=lambda trip: trip.start):
+        group = old_groups.get(get_key(trip))
+        if group:
+            pairs.append((group.pop(0), trip))
+        else:
+            unmatched.append(trip)
+
+    return pairs, [trip for group in old_groups.values() for trip in group], unmatched
+
+
+def reuse_block(old_trip, new_trip):
+    """If a new trip's (not yet saved) block is the same as the old trip's, use the existing row"""
+    block = new_trip.block
+    if block and block.pk is None and old_trip.block:
+        if block.code == old_trip.block.code and block.description == old_trip.block.description:
+            block.pk = old_trip.block_id
+            block._state.adding = False
+
+
+def get_stop_time_key(stop_time):
+    return tuple(getattr(stop_time, field) for field in STOP_TIME_FIELDS)
+
+
+def update_trips(route, trips, stop_times, trip_notes, blocks, copy=True):
+    """
+    Match a route's existing trips with new (unsaved) ones by their VehicleJourneyCode, ticket machine code and
+    journey pattern (or, failing that, journey pattern and start time), and only insert, update or delete
+    the trips, stop times and notes that have actually changed.
+    Returns a Counter of the numbers of rows inserted, updated, deleted and unchanged
+    """
+    churn = Counter()
+
+    old_trips = list(route.trip_set.select_related('block').order_by('start', 'id'))
+
+    pairs, old_unmatched, new_trips = match_trips(old_trips, trips, get_trip_key)
+    if old_unmatched and new_trips:
+        # trips imported without a VehicleJourneyCode, or whose codes have changed
+        more_pairs, old_unmatched, new_trips = match_trips(
+            old_unmatched, new_trips, lambda trip: (trip.journey_pattern, trip.start)
+        )
+        pairs += more_pairs
+
+    for old_trip, new_trip in pairs:
+        new_trip.id = old_trip.id
+        new_trip._state.adding = False
+        reuse_block(old_trip, new_trip)
+
+    Block.objects.bulk_create([block for block in blocks if block.pk is None])
+    for trip in trips:
+        trip.block = trip.block  # set block_id
+
+    fields = [Trip._meta.get_field(field).attname for field in TRIP_FIELDS]
+    changed_trips = [
+        new_trip for old_trip, new_trip in pairs
+        if any(getattr(old_trip, field) != getattr(new_trip, field) for field in fields)
+    ]
+
+    bulk_create(Trip, new_trips, copy=copy, set_ids=True)
+    Trip.objects.bulk_update(changed_trips, fields=TRIP_FIELDS)
+    if old_unmatched:
+        _, deleted = Trip.objects.filter(id__in=[trip.id for trip in old_unmatched]).delete()
+        churn['stop times deleted'] += deleted.get(StopTime._meta.label, 0)
+        churn['notes deleted'] += deleted.get(Trip.notes.through._meta.label, 0)
+
+    # timing patterns that the old trips used but the new ones don't
+    unused_pattern_ids = {trip.timing_pattern_id for trip in old_trips} - {trip.timing_pattern_id for trip in trips}
+    unused_pattern_ids.discard(None)
+    if unused_pattern_ids:
+        TimingPattern.objects.filter(id__in=unused_pattern_ids).delete()
+    churn['timing patterns deleted'] = len(unused_pattern_ids)
+
+    churn['trips inserted'] = len(new_trips)
+    churn['trips updated'] = len(changed_trips)
+    churn['trips deleted'] = len(old_unmatched)
+    churn['trips unchanged'] = len(pairs) - len(changed_trips)
+
+    # stop times - replace a matched trip's stop times only if any of them have changed
+
+    new_stop_times = {}
+    for stop_time in stop_times:
+        stop_time.trip = stop_time.trip  # set trip_id
+        new_stop_times.setdefault(stop_time.trip_id, []).append(stop_time)
+
+    old_stop_times = {}
+    if pairs:
+        for trip_id, *key in StopTime.objects.filter(
+            trip__route=route
+        ).order_by('trip', 'id').values_list('trip', *STOP_TIME_FIELDS):
+            old_stop_times.setdefault(trip_id, []).append(tuple(key))
+
+    changed_trip_ids = [
+        trip.id for _, trip in pairs
+        if old_stop_times.get(trip.id, []) != [
+            get_stop_time_key(stop_time) for stop_time in new_stop_times.get(trip.id, ())
+        ]
+    ]
+    if changed_trip_ids:
+        churn['stop times deleted'] += StopTime.objects.filter(trip__in=changed_trip_ids).delete()[0]
+    stop_times = [
+        stop_time for trip_id in changed_trip_ids + [trip.id for trip in new_trips]
+        for stop_time in new_stop_times.get(trip_id, ())
+    ]
+    bulk_create(StopTime, stop_times, batch_size=1000, copy=copy)
+    churn['stop times inserted'] = len(stop_times)
+
+    # notes
+
+    old_trip_notes = {}
+    if pairs:
+        old_trip_notes = {
+            (trip_id, note_id): trip_note_id for trip_note_id, trip_id, note_id
+            in Trip.notes.through.objects.filter(trip__route=route).values_list('id', 'trip', 'note')
+        }
+    new_trip_notes = {
+        (trip_note.trip.id, trip_note.note.id): trip_note for trip_note in trip_notes
+    }
+    trip_note_ids = [
+        trip_note_id for key, trip_note_id in old_trip_notes.items() if key not in new_trip_notes
+    ]
+    if trip_note_ids:
+        Trip.notes.through.objects.filter(id__in=trip_note_ids).delete()
+    Trip.notes.through.objects.bulk_create([
+        trip_note for key, trip_note in new_trip_notes.items() if key not in old_trip_notes
+    ])
+    churn['notes deleted'] += len(trip_note_ids)
+    churn['notes inserted'] = len(new_trip_notes.keys() - old_trip_notes.keys())
+
+    return churn
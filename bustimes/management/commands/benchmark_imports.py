@@ -0,0 +1,196 @@
+"""
+Usage:
+
+    ./manage.py benchmark_imports --output benchmark.json
+    ./manage.py benchmark_imports transxchange --baseline benchmark.json --threshold 0.2
+
+Runs the TransXChange, GTFS and ATCO-CIF importers over the test fixtures, one file at a time,
+and records the wall time, peak RSS, number of SQL queries and time spent on SQL for each file.
+Each import is rolled back afterwards, so the database is left as it was.
+"""
+
+import json
+import logging
+import resource
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from busstops.models import DataSource
+from .import_gtfs import Command as GTFSCommand
+
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / 'tests' / 'fixtures'
+
+METRICS = ('seconds', 'max_rss', 'queries', 'query_seconds')
+
+# ignore differences smaller than these, which are probably just noise
+TOLERANCES = {
+    'seconds': 0.05,
+    'max_rss': 1024,  # KiB
+    'queries': 0,
+    'query_seconds': 0.05,
+}
+
+
+class QueryCounter(logging.Handler):
+    """Counts the queries logged by the 'django.db.backends' logger, including COPYs (see bustimes.bulk)"""
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.queries = 0
+        self.seconds = 0
+
+    def emit(self, record):
+        self.queries += 1
+        self.seconds += record.duration
+
+
+def import_transxchange(path, directory):
+    call_command('import_transxchange', str(path))
+
+
+def import_gtfs(path, directory):
+    zip_path = Path(directory) / f'{path.name}.zip'
+    with zipfile.ZipFile(zip_path, 'w') as open_zipfile:
+        for item in path.iterdir():
+            open_zipfile.write(item, item.name)
+
+    command = GTFSCommand()
+    command.source, _ = DataSource.objects.get_or_create(name=f'{path.name} GTFS')
+    command.source.datetime = timezone.now()
+    command.handle_zipfile(zip_path)
+
+
+def import_atco_cif(path, directory):
+    zip_path = Path(directory) / f'{path.stem}.zip'
+    with zipfile.ZipFile(zip_path, 'w') as open_zipfile:
+        open_zipfile.write(path, path.name)
+
+    call_command('import_atco_cif', str(zip_path))
+
+
+IMPORTERS = {
+    'transxchange': (import_transxchange, '*.xml'),
+    'gtfs': (import_gtfs, 'google_transit_*'),  # directories
+    'cif': (import_atco_cif, '*.cif'),
+}
+
+
+def get_paths(importer):
+    _, pattern = IMPORTERS[importer]
+    return sorted(path for path in FIXTURES_DIR.glob(pattern) if path.is_dir() == (importer == 'gtfs'))
+
+
+def benchmark_file(importer, path):
+    """Import one file (in a transaction that's rolled back) and return the metrics"""
+    function, _ = IMPORTERS[importer]
+
+    logger = logging.getLogger('django.db.backends')
+    level = logger.level
+    propagate = logger.propagate
+    counter = QueryCounter()
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    force_debug_cursor = connection.force_debug_cursor
+    connection.force_debug_cursor = True
+
+    try:
+        with TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            with transaction.atomic():
+                function(path, directory)
+                transaction.set_rollback(True)
+            seconds = time.perf_counter() - start
+    finally:
+        connection.force_debug_cursor = force_debug_cursor
+        logger.removeHandler(counter)
+        logger.setLevel(level)
+        logger.propagate = propagate
+
+    return {
+        'seconds': seconds,
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # KiB (on Linux)
+        'queries': counter.queries,
+        'query_seconds': counter.seconds,
+    }
+
+
+def get_regressions(results, baseline, threshold):
+    """Compare results with a previous report,
+    and return a list of metrics that are more than threshold (e.g. 0.2 = 20%) worse
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        if 'error' in result:
+            if 'error' not in baseline[key]:
+                regressions.append(f"{key}: {result['error']}")
+            continue
+        for metric in METRICS:
+            old = baseline[key].get(metric)
+            new = result[metric]
+            if old is None:
+                continue
+            if new > old * (1 + threshold) and new - old > TOLERANCES[metric]:
+                regressions.append(f'{key} {metric}: {old} -> {new}')
+    return regressions
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('importers', nargs='*', type=str,
+                            help=f"Which importers to run - {', '.join(IMPORTERS)} (default all)")
+        parser.add_argument('--output', type=str, help='Write a JSON report to this file (default stdout)')
+        parser.add_argument('--baseline', type=str, help='A previous JSON report to compare with')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Fail if a metric is this much worse than in the baseline (default 0.2 = 20%%)')
+        parser.add_argument('--in-process', action='store_true',
+                            help="Don't run each file in a new process (so max_rss is the peak for the whole run)")
+
+    def benchmark(self, importer, path, in_process):
+        if in_process or transaction.get_connection().in_atomic_block:
+            # (a forked process can't share a connection that's in the middle of a transaction)
+            return benchmark_file(importer, path)
+
+        # a new process for each file, so max_rss is only for that file
+        connections.close_all()
+        with ProcessPoolExecutor(1, mp_context=get_context('fork')) as executor:
+            return executor.submit(benchmark_file, importer, path).result()
+
+    def handle(self, *args, **options):
+        for importer in options['importers']:
+            if importer not in IMPORTERS:
+                raise CommandError(f'Unknown importer {importer}')
+
+        results = {}
+
+        for importer in options['importers'] or IMPORTERS:
+            for path in get_paths(importer):
+                key = f'{importer}/{path.name}'
+                try:
+                    results[key] = self.benchmark(importer, path, options['in_process'])
+                except Exception as e:
+                    results[key] = {'error': repr(e)}
+                if options['verbosity'] > 1:
+                    self.stderr.write(f'{key} {results[key]}')
+
+        report = json.dumps(results, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(report)
+        else:
+            self.stdout.write(report)
+
+        if options['baseline']:
+            baseline = json.loads(Path(options['baseline']).read_text())
+            regressions = get_regressions(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('\n'.join(['Regressions:'] + regressions))
@@ -0,0 +1,34 @@
+"""
+Usage:
+
+    ./manage.py compile_calendars
+
+Works out the operating_days of calendars that are still in use (see compile_calendars).
+Run it every so often (daily, say) so they keep going far enough into the future
+"""
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef, Q
+from django.utils.timezone import localdate
+from ...models import Calendar, Trip, OPERATING_DAYS_BEFORE, compile_calendars
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **options):
+        calendars = Calendar.objects.filter(
+            Q(end_date__gte=localdate() - OPERATING_DAYS_BEFORE) | Q(end_date=None),
+            Exists(Trip.objects.filter(calendar=OuterRef('id')))
+        ).order_by('id')
+
+        count = 0
+        last_id = 0
+        while True:
+            batch = list(calendars.filter(id__gt=last_id)[:1000])
+            if not batch:
+                break
+            compile_calendars(batch)
+            count += len(batch)
+            last_id = batch[-1].id
+
+        if options['verbosity'] > 0:
+            self.stdout.write(f'{count} calendars compiled')
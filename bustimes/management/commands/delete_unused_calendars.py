@@ -0,0 +1,41 @@
+"""
+Usage:
+
+    ./manage.py delete_unused_calendars
+
+Importers share identical calendars (see get_or_create_calendar), so calendars aren't deleted with their trips.
+This deletes the ones that no trips use any more, with their CalendarDates and CalendarBankHolidays -
+if no import has used them for a day, so an import that's still running (whose trips aren't visible yet)
+doesn't lose a calendar it's using
+"""
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils.timezone import now
+from ...models import Calendar, CalendarDate, CalendarBankHoliday, Trip
+
+
+# must be longer than any import's transaction (plus CALENDAR_LAST_USED_INTERVAL, see get_or_create_calendar)
+GRACE_PERIOD = timedelta(days=1)
+
+
+class Command(BaseCommand):
+    @transaction.atomic
+    def handle(self, *args, **options):
+        unused_calendars = Calendar.objects.filter(
+            Q(last_used__lt=now() - GRACE_PERIOD) | Q(last_used=None),
+            ~Exists(Trip.objects.filter(calendar=OuterRef('id')))
+        )
+        # lock them, so an import can't start reusing one before it's deleted
+        # (and skip any that an import has just locked by marking them as used)
+        calendar_ids = list(unused_calendars.select_for_update(skip_locked=True).values_list('id', flat=True))
+
+        # (one DELETE statement each, rather than Django's cascading deletion fetching every row first)
+        calendar_dates, _ = CalendarDate.objects.filter(calendar__in=calendar_ids).delete()
+        bank_holidays, _ = CalendarBankHoliday.objects.filter(calendar__in=calendar_ids).delete()
+        calendars = Calendar.objects.filter(id__in=calendar_ids)._raw_delete(Calendar.objects.db)
+
+        if options['verbosity'] > 0:
+            self.stdout.write(f'{calendars} calendars, {calendar_dates} dates, {bank_holidays} bank holidays deleted')
@@ -6,7 +6,8 @@ from django.core.management.base import BaseCommand
 from django.contrib.gis.geos import LineString, MultiLineString, Point
 from django.utils import timezone
 from busstops.models import Service, DataSource, StopPoint
-from ...models import Route, Calendar, CalendarDate, Trip, StopTime, Note
+from ...bulk import bulk_create
+from ...models import Route, Calendar, CalendarDate, Trip, StopTime, Note, get_or_create_calendar
 from ...timetables import get_journey_patterns
 
 
@@ -24,11 +25,17 @@ def parse_time(string):
 
 
 class Command(BaseCommand):
+    copy = True
+
     @staticmethod
     def add_arguments(parser):
         parser.add_argument('filenames', nargs='+', type=str)
+        parser.add_argument('--orm-inserts', action='store_true',
+                            help='Insert trips and stop times with INSERT statements instead of COPY')
 
     def handle(self, *args, **options):
+        self.copy = not options['orm_inserts']
+
         for archive_name in options['filenames']:
 
             if 'ulb' in archive_name.lower() or 'ulsterbus' in archive_name.lower():
@@ -64,6 +71,7 @@ class Command(BaseCommand):
             route.service.geometry = MultiLineString(*line_strings)
 
         services = {route.service.id: route.service for route in self.routes.values()}.values()
+        Service.timetables_changed(service.id for service in services)
         Service.objects.bulk_update(services,
                                     fields=['geometry', 'description', 'outbound_description', 'inbound_description'])
         for service in services:
@@ -78,6 +86,9 @@ class Command(BaseCommand):
         self.trip = None
         self.stop_times = []
         self.notes = []
+        self.trips_to_create = []
+        self.trip_notes = []
+        self.stop_times_to_create = []
 
         # detect encoding
         detector = UniversalDetector()
@@ -129,12 +140,22 @@ class Command(BaseCommand):
             self.handle_line(line, previous_line, encoding)
             previous_line = line
 
+        self.save_trips()
+
+    def save_trips(self):
+        bulk_create(Trip, self.trips_to_create, copy=self.copy, set_ids=True)
+        Trip.notes.through.objects.bulk_create(self.trip_notes)
+        bulk_create(StopTime, self.stop_times_to_create, copy=self.copy)
+        self.trips_to_create = []
+        self.trip_notes = []
+        self.stop_times_to_create = []
+
     def get_calendar(self):
         line = self.trip_header
         key = line[13:38].decode() + str(self.exceptions)
         if key in self.calendars:
             return self.calendars[key]
-        calendar = Calendar.objects.create(
+        calendar = Calendar(
             mon=line[29:30] == b'1',
             tue=line[30:31] == b'1',
             wed=line[31:32] == b'1',
@@ -145,14 +166,13 @@ class Command(BaseCommand):
             start_date=parse_date(line[13:21]),
             end_date=parse_date(line[21:29])
         )
-        CalendarDate.objects.bulk_create(
+        calendar = get_or_create_calendar(calendar, (
             CalendarDate(
-                calendar=calendar,
                 start_date=parse_date(exception[2:10]),
                 end_date=parse_date(exception[10:18]),
                 operation=exception[18:19] == b'1',
             ) for exception in self.exceptions
-        )
+        ))
 
         self.calendars[key] = calendar
         return calendar
@@ -269,15 +289,14 @@ class Command(BaseCommand):
                 self.trip.destination_id = stop_code
                 self.trip.end = arrival
 
-                self.trip.save()
-
-                self.trip.notes.set(self.notes)
+                self.trips_to_create.append(self.trip)
+                self.trip_notes += [Trip.notes.through(trip=self.trip, note=note) for note in set(self.notes)]
                 self.notes = []
 
-                for stop_time in self.stop_times:
-                    stop_time.trip = stop_time.trip  # set trip_id
-                StopTime.objects.bulk_create(self.stop_times)
+                self.stop_times_to_create += self.stop_times
                 self.stop_times = []
+                if len(self.stop_times_to_create) >= 10000:
+                    self.save_trips()
 
         elif identity == b'QN':  # note
             previous_identity = previous_line[:2]
@@ -2,9 +2,7 @@
 """
 import logging
 import requests
-import hashlib
 import zipfile
-import xml.etree.cElementTree as ET
 from pathlib import Path
 from django.db.models import Q, OuterRef, Exists
 from io import StringIO
@@ -14,8 +12,9 @@ from django.conf import settings
 from django.db import DataError
 from django.utils import timezone
 from busstops.models import DataSource, Operator, Service
+from transxchange.txc import PARSE_ERRORS
 from .import_transxchange import Command as TransXChangeCommand
-from ...utils import download, download_if_changed
+from ...utils import download, download_if_changed, get_sha1
 from ...models import Route
 
 
@@ -33,7 +32,7 @@ def clean_up(operators, sources, incomplete=False):
     )
     if incomplete:  # leave other sources alone
         routes = routes.filter(source__url__contains='bus-data.dft.gov.uk')
-    routes.delete()
+    Service.delete_routes(routes)
     Service.objects.filter(operator__in=operators, current=True, route=None).update(current=False)
 
 
@@ -52,6 +51,8 @@ def handle_file(command, path, qualify_filename=False):
     # the downloaded file might be plain XML, or a zipped archive - we just don't know yet
     full_path = settings.DATA_DIR / path
 
+    command.set_route_hashes()
+
     try:
         with zipfile.ZipFile(full_path) as archive:
             for filename in archive.namelist():
@@ -61,35 +62,34 @@ def handle_file(command, path, qualify_filename=False):
                     if qualify_filename:
                         # source has multiple versions (Passsenger) so add a prefix like 'gonortheast_123.zip/'
                         filename = str(Path(path) / filename)
+                    if command.file_is_unchanged(open_file, filename):
+                        continue
+                    open_file.seek(0)
                     try:
                         try:
                             command.handle_file(open_file, filename)
-                        except ET.ParseError:
+                        except PARSE_ERRORS:
                             open_file.seek(0)
                             content = open_file.read().decode('utf-16')
                             fake_file = StringIO(content)
                             command.handle_file(fake_file, filename)
-                    except (ET.ParseError, ValueError, AttributeError, DataError) as e:
+                    except (*PARSE_ERRORS, ValueError, AttributeError, DataError) as e:
                         if filename.endswith('.xml'):
                             logger.info(filename)
                             logger.error(e, exc_info=True)
     except zipfile.BadZipFile:
-        with full_path.open() as open_file:
-            try:
-                command.handle_file(open_file, str(path))
-            except (AttributeError, DataError) as e:
-                logger.error(e, exc_info=True)
+        with full_path.open('rb') as open_file:
+            unchanged = command.file_is_unchanged(open_file, str(path))
+        if not unchanged:
+            with full_path.open() as open_file:
+                try:
+                    command.handle_file(open_file, str(path))
+                except (AttributeError, DataError) as e:
+                    logger.error(e, exc_info=True)
 
     if not qualify_filename:
-        sha1 = hashlib.sha1()
         with full_path.open('rb') as open_file:
-            while True:
-                data = open_file.read(65536)
-                if data:
-                    sha1.update(data)
-                else:
-                    break
-        command.source.sha1 = sha1.hexdigest()
+            command.source.sha1 = get_sha1(open_file)
 
 
 def get_bus_open_data_paramses(api_key, operator):
@@ -125,6 +125,7 @@ def bus_open_data(api_key, operator):
     assert len(api_key) == 40
 
     command = get_command()
+    command.force = bool(operator)
 
     datasets = []
 
@@ -238,6 +239,7 @@ def bus_open_data(api_key, operator):
 
 def ticketer(specific_operator=None):
     command = get_command()
+    command.force = bool(specific_operator)
 
     base_dir = settings.DATA_DIR / 'ticketer'
 
@@ -295,6 +297,7 @@ def ticketer(specific_operator=None):
 
 def stagecoach(operator=None):
     command = get_command()
+    command.force = bool(operator)
 
     for region_id, noc, name, nocs in settings.STAGECOACH_OPERATORS:
         if operator and operator != noc:  # something like 'sswl'
@@ -10,9 +10,11 @@ from django.utils.dateparse import parse_duration
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db.models import Count, Q
-from django.contrib.gis.geos import GEOSGeometry, LineString, MultiLineString
+from django.contrib.gis.geos import GEOSGeometry, MultiLineString
 from busstops.models import Region, DataSource, StopPoint, Service, Operator, AdminArea
-from ...models import Route, Calendar, CalendarDate, Trip, StopTime
+from transxchange.txc import get_linestring
+from ...bulk import bulk_create
+from ...models import Route, Calendar, CalendarDate, Trip, StopTime, get_or_create_calendar
 from ...utils import download_if_changed
 
 
@@ -28,7 +30,7 @@ MODES = {
 
 
 def parse_date(string):
-    return datetime.strptime(string, '%Y%m%d')
+    return datetime.strptime(string, '%Y%m%d').date()
 
 
 def read_file(archive, name):
@@ -57,8 +59,12 @@ def get_stop_id(stop_id):
 
 
 class Command(BaseCommand):
+    copy = True
+
     def add_arguments(self, parser):
         parser.add_argument('--force', action='store_true', help="Import data even if the GTFS feeds haven't changed")
+        parser.add_argument('--orm-inserts', action='store_true',
+                            help='Insert trips and stop times with INSERT statements instead of COPY')
         parser.add_argument('collections', nargs='*', type=str)
 
     def handle_operator(self, line):
@@ -162,9 +168,7 @@ class Command(BaseCommand):
                 shape_id = line['shape_id']
                 if shape_id not in self.shapes:
                     self.shapes[shape_id] = []
-                self.shapes[shape_id].append(
-                    GEOSGeometry(f"POINT({line['shape_pt_lon']} {line['shape_pt_lat']})")
-                )
+                self.shapes[shape_id] += (line['shape_pt_lon'], line['shape_pt_lat'])
 
             for line in read_file(archive, 'agency.txt'):
                 self.operators[line['agency_id']] = self.handle_operator(line)
@@ -188,17 +192,21 @@ class Command(BaseCommand):
                     start_date=parse_date(line['start_date']),
                     end_date=parse_date(line['end_date']),
                 )
-                calendar.save()
                 calendars[line['service_id']] = calendar
 
+            calendar_dates = {service_id: [] for service_id in calendars}
             for line in read_file(archive, 'calendar_dates.txt'):
-                CalendarDate.objects.create(
-                    calendar=calendars[line['service_id']],
-                    start_date=parse_date(line['date']),
-                    end_date=parse_date(line['date']),
-                    operation=line['exception_type'] == '1'
+                calendar_dates[line['service_id']].append(
+                    CalendarDate(
+                        start_date=parse_date(line['date']),
+                        end_date=parse_date(line['date']),
+                        operation=line['exception_type'] == '1'
+                    )
                 )
 
+            for service_id, calendar in calendars.items():
+                calendars[service_id] = get_or_create_calendar(calendar, calendar_dates[service_id])
+
             trips = {}
             for line in read_file(archive, 'trips.txt'):
                 route = self.routes.get(line['route_id'])
@@ -248,6 +256,8 @@ class Command(BaseCommand):
 
             utc = all(timezone == 'UTC' for timezone in self.agency_timezones.values())
 
+            trips_to_create = []
+            stop_times_to_create = []
             stop_times = []
             trip_id = None
             trip = None
@@ -263,11 +273,15 @@ class Command(BaseCommand):
                             stop_time.departure = None
                         trip.start = stop_times[0].departure
                         trip.end = stop_times[-1].arrival
-                        trip.save()
                         for stop_time in stop_times:
                             stop_time.trip = trip
-                        StopTime.objects.bulk_create(stop_times)
+                        trips_to_create.append(trip)
+                        stop_times_to_create += stop_times
                         stop_times = []
+                        if len(stop_times_to_create) >= 10000:
+                            self.save_trips(trips_to_create, stop_times_to_create)
+                            trips_to_create = []
+                            stop_times_to_create = []
                     trip = Trip()
                 trip_id = line['trip_id']
                 trip = trips[trip_id]
@@ -305,14 +319,17 @@ class Command(BaseCommand):
             stop_time.departure = None
         trip.start = stop_times[0].departure
         trip.end = stop_times[-1].arrival
-        trip.save()
         for stop_time in stop_times:
             stop_time.trip = trip
-        StopTime.objects.bulk_create(stop_times)
+        trips_to_create.append(trip)
+        stop_times_to_create += stop_times
+        self.save_trips(trips_to_create, stop_times_to_create)
+
+        Service.timetables_changed(service.id for service in self.services.values())
 
         for service in self.services.values():
             if service.id in self.service_shapes:
-                linestrings = [LineString(*self.shapes[shape])
+                linestrings = [get_linestring(self.shapes[shape])
                                for shape in self.service_shapes[service.id]
                                if shape in self.shapes]
                 service.geometry = MultiLineString(*linestrings)
@@ -345,7 +362,13 @@ class Command(BaseCommand):
         StopPoint.objects.filter(active=False, service__current=True).update(active=True)
         StopPoint.objects.filter(active=True, service__isnull=True).update(active=False)
 
+    def save_trips(self, trips, stop_times):
+        bulk_create(Trip, trips, copy=self.copy, set_ids=True)
+        bulk_create(StopTime, stop_times, copy=self.copy)
+
     def handle(self, *args, **options):
+        self.copy = not options['orm_inserts']
+
         if options['collections']:
             collections = [f'google_transit_{collection}.zip' for collection in options['collections']]
         else:
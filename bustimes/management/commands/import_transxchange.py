@@ -10,18 +10,25 @@ import re
 import csv
 import zipfile
 import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import cache
+from itertools import groupby
 from titlecase import titlecase
 from django.conf import settings
 from django.contrib.gis.geos import MultiLineString
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
+from django.db import IntegrityError, connections, transaction
 from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
 from busstops.models import Operator, Service, DataSource, StopPoint, StopUsage, ServiceCode, ServiceLink
+from ...bulk import bulk_create
+from ...diff import update_trips
+from ...utils import get_sha1
 from ...models import (Route, Trip, StopTime, Note, Garage, VehicleType, Block, RouteLink,
-                       Calendar, CalendarDate, CalendarBankHoliday, BankHoliday)
-from transxchange.txc import TransXChange
+                       Calendar, CalendarDate, CalendarBankHoliday, BankHoliday, TimingPattern, TimingPatternStop,
+                       get_or_create_calendar)
+from transxchange.txc import DEFAULT_PARSER, PARSERS, TransXChange
 from vosa.models import Registration
 
 
@@ -140,6 +147,84 @@ def get_calendar_date(date, operation, summary):
     )
 
 
+def get_trip(journey):
+    """
+    Given a VehicleJourney, return an unsaved Trip, its StopTimes, and whether any of the timing statuses are blank.
+    Doesn't touch the database, so the route, calendar etc are set later (see Command.handle_journeys),
+    and each StopTime's stop_code is the stop's ATCO code until it's looked up
+    """
+    trip = Trip(
+        inbound=journey.journey_pattern.is_inbound(),
+        journey_pattern=journey.journey_pattern.id,
+        ticket_machine_code=journey.ticket_machine_journey_code or '',
+        vehicle_journey_code=journey.code or '',
+        sequence=journey.sequencenumber
+    )
+    stop_times = []
+
+    blank = False
+    for cell in journey.get_times():
+        timing_status = cell.stopusage.timingstatus
+        if timing_status is None:
+            timing_status = ''
+            blank = True
+        elif len(timing_status) > 3:
+            if timing_status == 'otherPoint':
+                timing_status = 'OTH'
+            elif timing_status == 'timeInfoPoint':
+                timing_status = 'TIP'
+            elif timing_status == 'principleTimingPoint' or timing_status == 'principalTimingPoint':
+                timing_status = 'PTP'
+            else:
+                logger.warning(timing_status)
+
+        stop_time = StopTime(
+            trip=trip,
+            stop_code=cell.stopusage.stop.atco_code,
+            sequence=cell.stopusage.sequencenumber,
+            timing_status=timing_status
+        )
+        if stop_time.sequence is not None and stop_time.sequence > 32767:  # too big for smallint
+            stop_time.sequence = None
+
+        if cell.stopusage.activity == 'pickUp':
+            stop_time.set_down = False
+        elif cell.stopusage.activity == 'setDown':
+            stop_time.pick_up = False
+        elif cell.stopusage.activity == 'pass':
+            stop_time.pick_up = False
+            stop_time.set_down = False
+
+        stop_time.departure = cell.departure_time
+        if cell.arrival_time != cell.departure_time:
+            stop_time.arrival = cell.arrival_time
+
+        if trip.start is None:
+            trip.start = stop_time.departure_or_arrival()
+
+        stop_times.append(stop_time)
+
+    # last stop
+    if not stop_time.arrival:
+        stop_time.arrival = stop_time.departure
+        stop_time.departure = None
+
+    trip.end = stop_time.arrival_or_departure()
+
+    return trip, stop_times, blank
+
+
+def parse_archive_member(archive_name, filename, parser):
+    """
+    Parse one XML file from a zip archive, and make each journey's Trip and StopTimes (see get_trip) -
+    run in a worker process by Command.handle_files_in_parallel, so must not touch the database
+    """
+    with zipfile.ZipFile(archive_name) as archive:
+        with archive.open(filename) as open_file:
+            transxchange = TransXChange(open_file, parser)
+    return transxchange, {journey: get_trip(journey) for journey in transxchange.journeys}
+
+
 def get_registration(service_code):
     parts = service_code.split('_')[0].split(':')
     if len(parts[0]) != 9:
@@ -160,8 +245,26 @@ class Command(BaseCommand):
     def add_arguments(parser):
         parser.add_argument('archives', nargs=1, type=str)
         parser.add_argument('files', nargs='*', type=str)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to parse XML files with (default 1 - no pool)')
+        parser.add_argument('--orm-inserts', action='store_true',
+                            help='Insert trips and stop times with INSERT statements instead of COPY')
+        parser.add_argument('--timing-patterns', action='store_true',
+                            help='Store shared timing patterns instead of stop times for each trip')
+        parser.add_argument('--force', action='store_true',
+                            help="Import files even if they haven't changed since they were last imported")
+        parser.add_argument('--parser', choices=PARSERS, default=DEFAULT_PARSER,
+                            help='XML parser - lxml uses less memory, but is slower')
 
     def set_up(self):
+        self.workers = 1
+        self.copy = True
+        self.timing_patterns = False
+        self.force = False
+        self.parser = DEFAULT_PARSER
+        self.route_hashes = {}
+        self.file_hashes = {}
+        self.trips = {}
         self.service_descriptions = {}
         self.calendar_cache = {}
         self.operators = {}
@@ -171,6 +274,11 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         self.set_up()
+        self.workers = options['workers']
+        self.copy = not options['orm_inserts']
+        self.timing_patterns = options['timing_patterns']
+        self.force = options['force']
+        self.parser = options['parser']
 
         self.open_data_operators, self.incomplete_operators = get_open_data_operators()
 
@@ -291,8 +399,43 @@ class Command(BaseCommand):
         inbound = self.service_descriptions.get(f'{key}I', '')
         return outbound, inbound
 
+    def set_route_hashes(self):
+        """
+        Get the hashes of the files that the source's existing routes were imported from,
+        so that unchanged files can be skipped (unless --force)
+        """
+        self.route_hashes = {}
+        self.file_hashes = {}
+        if self.force:
+            return
+        today = self.source.datetime.date()
+        routes = self.source.route_set.values_list('id', 'code', 'sha1', 'end_date')
+        for route_id, code, sha1, end_date in routes:
+            filename = code.split('#')[0]
+            if filename not in self.route_hashes:
+                self.route_hashes[filename] = {}
+            if end_date and end_date < today:
+                # re-import, so that the now-expired route is dealt with
+                sha1 = None
+            self.route_hashes[filename][route_id] = sha1
+
+    def file_is_unchanged(self, open_file, filename: str) -> bool:
+        """
+        Hash a file, and if all the existing routes from the file were imported from an identical file,
+        count them as current (so they're not deleted by mark_old_services_as_not_current) and return True
+        """
+        # (even with --force, so that the routes' sha1s are still recorded)
+        sha1 = self.file_hashes[filename] = get_sha1(open_file)
+        if self.force:
+            return False
+        routes = self.route_hashes.get(filename)
+        if routes and all(route_sha1 == sha1 for route_sha1 in routes.values()):
+            self.route_ids.update(routes)
+            return True
+        return False
+
     def mark_old_services_as_not_current(self):
-        self.source.route_set.exclude(id__in=self.route_ids).delete()
+        Service.delete_routes(self.source.route_set.exclude(id__in=self.route_ids))
         old_services = self.source.service_set.filter(current=True, route=None).exclude(id__in=self.service_ids)
         old_services.update(current=False)
 
@@ -314,8 +457,25 @@ class Command(BaseCommand):
                 if 'NCSD_TXC_2_4/' in namelist:
                     filenames = [filename for filename in namelist if filename.startswith('NCSD_TXC_2_4/')]
 
-                for filename in filenames or namelist:
-                    if filename.endswith('.xml'):
+                xml_filenames = [filename for filename in filenames or namelist if filename.endswith('.xml')]
+
+                if not filenames:
+                    self.set_route_hashes()
+                    unchanged_filenames = set()
+                    for filename in xml_filenames:
+                        with archive.open(filename) as open_file:
+                            if self.file_is_unchanged(open_file, filename):
+                                unchanged_filenames.add(filename)
+                    if unchanged_filenames:
+                        logger.info(f'{len(unchanged_filenames)} unchanged files')
+                        xml_filenames = [
+                            filename for filename in xml_filenames if filename not in unchanged_filenames
+                        ]
+
+                if self.workers > 1 and len(xml_filenames) > 1:
+                    self.handle_files_in_parallel(archive_name, xml_filenames)
+                else:
+                    for filename in xml_filenames:
                         with archive.open(filename) as open_file:
                             self.handle_file(open_file, filename)
         except zipfile.BadZipfile:
@@ -334,9 +494,54 @@ class Command(BaseCommand):
             ~Exists(StopUsage.objects.filter(stop=OuterRef('pk'), service__current=True)), active=False
         ).update(active=True)
 
+    def handle_files_in_parallel(self, archive_name, filenames, batch_size=50):
+        """
+        Parse files (and make their trips and stop times) in a pool of worker processes,
+        while this process does all the database writes, in the original file order, committing every batch_size files.
+        Each file gets its own savepoint, so if one fails the files before it are still committed, like in serial mode
+        """
+        if not transaction.get_connection().in_atomic_block:
+            # don't let forked workers inherit open database connections
+            connections.close_all()
+
+        filenames = iter(filenames)
+        pending = deque()  # futures in file order
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            def submit():
+                # keep a bounded number of parsed documents in flight, to cap memory use
+                for filename in filenames:
+                    future = executor.submit(parse_archive_member, archive_name, filename, self.parser)
+                    pending.append((filename, future))
+                    if len(pending) >= self.workers * 2:
+                        break
+
+            submit()
+            error = None
+            while pending and not error:
+                with transaction.atomic():
+                    for _ in range(batch_size):
+                        if not pending:
+                            break
+                        filename, future = pending.popleft()
+                        try:
+                            transxchange, trips = future.result()
+                            submit()
+                            with transaction.atomic():
+                                self.handle_transxchange(transxchange, filename, trips)
+                        except Exception as e:
+                            error = e
+                            break
+            if error:
+                for _, future in pending:
+                    future.cancel()
+                raise error
+
     def finish_services(self):
         """update/create StopUsages, search_vector and geometry fields"""
 
+        Service.timetables_changed(self.service_ids)
+
         services = Service.objects.filter(id__in=self.service_ids)
 
         for service in services:
@@ -345,30 +550,27 @@ class Command(BaseCommand):
             # using StopUsages
             service.update_search_vector()
 
-            # using routes
-            service.update_geometry()
+        # using routes (or stop times), all in one go
+        Service.update_geometries(self.service_ids)
 
     @cache
     def get_bank_holiday(self, bank_holiday_name):
         return BankHoliday.objects.get_or_create(name=bank_holiday_name)[0]
 
-    def do_bank_holidays(self, holiday_elements, operating_period, operation, calendar_dates):
-        if not holiday_elements:
+    def do_bank_holidays(self, bank_holidays, operating_period, operation, calendar_dates):
+        if not bank_holidays:
             return
 
-        for element in holiday_elements:
-            bank_holiday_name = element.tag
+        for bank_holiday_name, date, description in bank_holidays:
             if bank_holiday_name == 'OtherPublicHoliday':
-                calendar_dates.append(
-                    get_calendar_date(element.findtext('Date'), operation, element.findtext('Description'))
-                )
+                calendar_dates.append(get_calendar_date(date, operation, description))
             else:
                 if bank_holiday_name == 'HolidaysOnly':
                     bank_holiday_name = 'AllBankHolidays'
                 yield self.get_bank_holiday(bank_holiday_name)
 
     def get_calendar(self, operating_profile, operating_period):
-        calendar_hash = f'{operating_profile.hash}{operating_period}'
+        calendar_hash = (operating_profile.hash, operating_period.start, operating_period.end)
 
         if calendar_hash in self.calendar_cache:
             return self.calendar_cache[calendar_hash]
@@ -391,7 +593,7 @@ class Command(BaseCommand):
         bank_holidays = {}  # a dictionary to remove duplicates! (non-operation overrides operation)
 
         for bank_holiday in self.do_bank_holidays(
-            holiday_elements=operating_profile.operation_bank_holidays,
+            bank_holidays=operating_profile.operation_bank_holidays,
             operating_period=operating_period,
             operation=True,
             calendar_dates=calendar_dates
@@ -402,7 +604,7 @@ class Command(BaseCommand):
             )
 
         for bank_holiday in self.do_bank_holidays(
-            holiday_elements=operating_profile.nonoperation_bank_holidays,
+            bank_holidays=operating_profile.nonoperation_bank_holidays,
             operating_period=operating_period,
             operation=False,
             calendar_dates=calendar_dates
@@ -490,21 +692,15 @@ class Command(BaseCommand):
             elif day == 6:
                 calendar.sun = True
 
-        calendar.save()
-
         weird = False
         for date in calendar_dates:
-            date.calendar = calendar
             if date.end_date < date.start_date:
                 weird = True
                 logger.warning(date)
         if weird:
             calendar_dates = [date for date in calendar_dates if date.end_date >= date.start_date]
-        CalendarDate.objects.bulk_create(calendar_dates)
 
-        for bank_holiday in bank_holidays.values():
-            bank_holiday.calendar = calendar
-        CalendarBankHoliday.objects.bulk_create(bank_holidays.values())
+        calendar = get_or_create_calendar(calendar, calendar_dates, bank_holidays.values())
 
         self.calendar_cache[calendar_hash] = calendar
 
@@ -518,6 +714,7 @@ class Command(BaseCommand):
         )
 
         self.route_ids.add(route.id)
+        self.file_route_ids.add(route.id)
 
         stop_times = []
 
@@ -539,14 +736,13 @@ class Command(BaseCommand):
             else:
                 calendar = None
 
-            trip = Trip(
-                inbound=journey.journey_pattern.is_inbound(),
-                calendar=calendar,
-                route=route,
-                journey_pattern=journey.journey_pattern.id,
-                ticket_machine_code=journey.ticket_machine_journey_code or '',
-                sequence=journey.sequencenumber
-            )
+            if journey in self.trips:
+                # already made by a worker process
+                trip, journey_stop_times, blank = self.trips.pop(journey)
+            else:
+                trip, journey_stop_times, blank = get_trip(journey)
+            trip.calendar = calendar
+            trip.route = route
 
             if journey.block and journey.block.code:
                 if journey.block.code not in self.blocks:
@@ -570,62 +766,17 @@ class Command(BaseCommand):
             if journey.garage_ref:
                 trip.garage = self.garages.get(journey.garage_ref)
 
-            blank = False
-            for cell in journey.get_times():
-                timing_status = cell.stopusage.timingstatus
-                if timing_status is None:
-                    timing_status = ''
-                    blank = True
-                elif len(timing_status) > 3:
-                    if timing_status == 'otherPoint':
-                        timing_status = 'OTH'
-                    elif timing_status == 'timeInfoPoint':
-                        timing_status = 'TIP'
-                    elif timing_status == 'principleTimingPoint' or timing_status == 'principalTimingPoint':
-                        timing_status = 'PTP'
-                    else:
-                        logger.warning(timing_status)
-
-                stop_time = StopTime(
-                    trip=trip,
-                    sequence=cell.stopusage.sequencenumber,
-                    timing_status=timing_status
-                )
-                if stop_time.sequence is not None and stop_time.sequence > 32767:  # too big for smallint
-                    stop_time.sequence = None
-
-                if cell.stopusage.activity == 'pickUp':
-                    stop_time.set_down = False
-                elif cell.stopusage.activity == 'setDown':
-                    stop_time.pick_up = False
-                elif cell.stopusage.activity == 'pass':
-                    stop_time.pick_up = False
-                    stop_time.set_down = False
-
-                stop_time.departure = cell.departure_time
-                if cell.arrival_time != cell.departure_time:
-                    stop_time.arrival = cell.arrival_time
-
-                if trip.start is None:
-                    trip.start = stop_time.departure_or_arrival()
-
-                atco_code = cell.stopusage.stop.atco_code
+            for stop_time in journey_stop_times:
+                atco_code = stop_time.stop_code
                 if atco_code in stops:
                     if type(stops[atco_code]) is str:
                         stop_time.stop_code = stops[atco_code]
                     else:
-                        stop_time.stop_id = cell.stopusage.stop.atco_code
-                        trip.destination_id = stop_time.stop_id
-                else:
-                    stop_time.stop_code = atco_code
-                stop_times.append(stop_time)
-
-            # last stop
-            if not stop_time.arrival:
-                stop_time.arrival = stop_time.departure
-                stop_time.departure = None
+                        stop_time.stop_code = ''
+                        stop_time.stop_id = atco_code
+                        trip.destination_id = atco_code
+            stop_times += journey_stop_times
 
-            trip.end = stop_time.arrival_or_departure()
             trips.append(trip)
 
             if trip.start == trip.end:
@@ -646,51 +797,75 @@ class Command(BaseCommand):
                     self.notes[note_cache_key] = note
                 trip_notes.append(Trip.notes.through(trip=trip, note=note))
 
-        Block.objects.bulk_create(blocks)
-        for trip in trips:
-            trip.block = trip.block
+        if self.timing_patterns:
+            self.create_timing_patterns(route, stop_times, route_created)
+            stop_times = []
 
-        if not route_created:
-            # reuse trip ids if the number and start times haven't changed
-            existing_trips = route.trip_set.order_by('id')
-            if len(existing_trips) == len(trips):
-                for i, old_trip in enumerate(existing_trips):
-                    if old_trip.start == trips[i].start:
-                        trips[i].id = old_trip.id
-                    else:
-                        logger.info(f"{route_code} {old_trip.start} {trips[i].start}")
-                        existing_trips.delete()
-                        existing_trips = None
-                        break
-            else:
-                existing_trips.delete()
-                existing_trips = None
-        else:
-            existing_trips = None
-
-        if existing_trips:
-            Trip.objects.bulk_update(trips, fields=[
-                'inbound',
-                'journey_pattern',
-                'ticket_machine_code',
-                'block',
-                'destination',
-                'calendar',
-                'sequence',
-                'end',
-                'garage',
-                'vehicle_type',
-            ])
-            Trip.notes.through.objects.filter(trip__route=route).delete()
-            StopTime.objects.filter(trip__route=route).delete()
+        if route_created:
+            Block.objects.bulk_create(blocks)
+            for trip in trips:
+                trip.block = trip.block  # set block_id
+
+            bulk_create(Trip, trips, copy=self.copy, set_ids=True)
+            Trip.notes.through.objects.bulk_create(trip_notes)
+
+            for stop_time in stop_times:
+                stop_time.trip = stop_time.trip  # set trip_id
+            bulk_create(StopTime, stop_times, batch_size=1000, copy=self.copy)
         else:
-            Trip.objects.bulk_create(trips)
+            churn = update_trips(route, trips, stop_times, trip_notes, blocks, copy=self.copy)
+            logger.info(f"{route_code}: {', '.join(f'{count} {key}' for key, count in churn.items() if count)}")
 
-        Trip.notes.through.objects.bulk_create(trip_notes)
+    def create_timing_patterns(self, route, stop_times, route_created):
+        """
+        Instead of each trip having its own StopTimes, create a TimingPattern for each distinct sequence of stops
+        and times (relative to the start of the trip), and point each trip at one.
+        The route's existing patterns are reused if they're identical (and update_trips deletes any that aren't)
+        """
+        def get_key(pattern_stops):
+            return tuple(
+                (stop.stop_code, stop.stop_id, stop.arrival, stop.departure, stop.sequence, stop.timing_status,
+                 stop.pick_up, stop.set_down) for stop in pattern_stops
+            )
+
+        timing_patterns = {}
+        pattern_stops = []
+        trip_patterns = []
 
-        for stop_time in stop_times:
-            stop_time.trip = stop_time.trip  # set trip_id
-        StopTime.objects.bulk_create(stop_times, batch_size=1000)
+        if not route_created:
+            existing_pattern_stops = TimingPatternStop.objects.filter(pattern__route=route).order_by('pattern', 'id')
+            for pattern_id, existing_stops in groupby(existing_pattern_stops, key=lambda stop: stop.pattern_id):
+                timing_pattern = TimingPattern(id=pattern_id, route=route)
+                timing_pattern._state.adding = False
+                timing_patterns[get_key(existing_stops)] = timing_pattern
+
+        for trip, trip_stop_times in groupby(stop_times, key=lambda stop_time: stop_time.trip):
+            trip_pattern_stops = [
+                TimingPatternStop(
+                    stop_code=stop_time.stop_code,
+                    stop_id=stop_time.stop_id,
+                    arrival=None if stop_time.arrival is None else stop_time.arrival - trip.start,
+                    departure=None if stop_time.departure is None else stop_time.departure - trip.start,
+                    sequence=stop_time.sequence,
+                    timing_status=stop_time.timing_status,
+                    pick_up=stop_time.pick_up,
+                    set_down=stop_time.set_down
+                ) for stop_time in trip_stop_times
+            ]
+            key = get_key(trip_pattern_stops)
+            if key not in timing_patterns:
+                timing_patterns[key] = TimingPattern(route=route)
+                for pattern_stop in trip_pattern_stops:
+                    pattern_stop.pattern = timing_patterns[key]
+                pattern_stops += trip_pattern_stops
+            trip_patterns.append((trip, timing_patterns[key]))
+
+        new_patterns = [pattern for pattern in timing_patterns.values() if pattern.pk is None]
+        bulk_create(TimingPattern, new_patterns, copy=self.copy, set_ids=True)
+        bulk_create(TimingPatternStop, pattern_stops, batch_size=1000, copy=self.copy)
+
+        for trip, timing_pattern in trip_patterns:
+            trip.timing_pattern = timing_pattern  # set timing_pattern_id
 
     def get_description(self, txc_service):
         description = txc_service.description
@@ -858,7 +1033,11 @@ class Command(BaseCommand):
                     existing = services
 
                 if len(transxchange.services) == 1:
-                    has_stop_time = Exists(StopTime.objects.filter(stop__in=stops, trip__route__service=OuterRef('id')))
+                    has_stop_time = Exists(
+                        StopTime.objects.filter(stop__in=stops, trip__route__service=OuterRef('id'))
+                    ) | Exists(
+                        TimingPatternStop.objects.filter(stop__in=stops, pattern__route__service=OuterRef('id'))
+                    )
                     has_stop_usage = Exists(StopUsage.objects.filter(stop__in=stops, service=OuterRef('id')))
                     has_no_route = ~Exists(Route.objects.filter(service=OuterRef('id')))
                     condition = has_stop_time | (has_stop_usage & has_no_route)
@@ -1115,12 +1294,20 @@ class Command(BaseCommand):
         return stops
 
     def handle_file(self, open_file, filename: str):
-        transxchange = TransXChange(open_file)
+        transxchange = TransXChange(open_file, self.parser)
+        self.handle_transxchange(transxchange, filename)
 
+    def handle_transxchange(self, transxchange, filename: str, trips=None):
+        """
+        Import a parsed file - trips is {VehicleJourney: get_trip(journey)}, if a worker process has already made them
+        """
         if not transxchange.journeys:
             logger.warning(f'{filename} has no journeys')
             return
 
+        self.trips = trips or {}
+        self.file_route_ids = set()
+
         self.blocks = {}
         self.vehicle_types = {}
 
@@ -1144,3 +1331,10 @@ class Command(BaseCommand):
                 continue
 
             self.handle_service(filename, transxchange, txc_service, today, stops)
+
+        sha1 = self.file_hashes.get(filename)
+        if sha1 and self.file_route_ids:
+            # now that the whole file has been imported
+            Route.objects.filter(id__in=self.file_route_ids).update(sha1=sha1)
+
+        self.trips = {}
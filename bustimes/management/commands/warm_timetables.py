@@ -0,0 +1,48 @@
+"""
+Usage:
+
+    ./manage.py warm_timetables --services 200 --days 7
+
+Builds and caches (see Service.get_timetable) the timetables for the busiest current services
+(the ones with the most trips), for the default date and each of the next few days,
+so the first visitors after an import don't have to wait for them.
+Also caches their current route ids (see Service.get_current_route_ids) for those days
+"""
+
+import datetime
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils.timezone import localdate
+from busstops.models import Service
+
+
+class Command(BaseCommand):
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--services', type=int, default=200, help='How many services (default 200)')
+        parser.add_argument('--days', type=int, default=7, help='How many days (default 7)')
+
+    def handle(self, *args, **options):
+        today = localdate()
+        days = [None] + [today + datetime.timedelta(days=i) for i in range(options['days'])]
+
+        services = Service.objects.filter(
+            current=True, timetable_wrong=False
+        ).annotate(
+            trips=Count('route__trip')
+        ).order_by('-trips').defer('geometry', 'search_vector')[:options['services']]
+
+        for service in services:
+            # the same related services as ServiceDetailView
+            if service.get_similar_services():
+                related = service.get_linked_services()
+            else:
+                related = []
+            for day in days:
+                service.get_timetable(day, related)
+            if options['verbosity'] > 1:
+                self.stdout.write(str(service))
+
+        service_ids = [service.id for service in services]
+        for day in days:
+            Service.get_current_route_ids(service_ids, day)
@@ -0,0 +1,71 @@
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.contrib.gis.geos import Point
+from django.test import TestCase
+from busstops.models import Region, Operator, Service, StopPoint
+from ..commands.benchmark_imports import get_regressions
+
+
+class BenchmarkImportsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        ni = Region.objects.create(pk='NI', name='Northern Ireland')
+        Operator.objects.create(pk='GLE', name='Goldline Express', region=ni)
+
+        StopPoint.objects.bulk_create(
+            StopPoint(atco_code, latlong=Point(0, 0), active=True) for atco_code in (
+                '700000015363',
+                '700000015687',
+                '700000004923',
+                '700000005645'
+            )
+        )
+
+    def test_benchmark_imports(self):
+        with TemporaryDirectory() as directory:
+            output = Path(directory) / 'benchmark.json'
+
+            call_command('benchmark_imports', 'cif', '--output', output)
+
+            results = json.loads(output.read_text())
+            self.assertEqual(list(results), ['cif/218 219.cif'])
+            result = results['cif/218 219.cif']
+            self.assertGreater(result['queries'], 10)
+            self.assertGreater(result['seconds'], result['query_seconds'])
+            self.assertGreater(result['max_rss'], 0)
+
+            # rolled back
+            self.assertFalse(Service.objects.all())
+
+            # compare with a baseline that was much better
+            result['queries'] = 10
+            baseline = Path(directory) / 'baseline.json'
+            baseline.write_text(json.dumps(results))
+
+            with self.assertRaisesMessage(CommandError, 'cif/218 219.cif queries: 10 -> '):
+                call_command('benchmark_imports', 'cif', '--output', output, '--baseline', baseline)
+
+        with self.assertRaisesMessage(CommandError, 'Unknown importer nx'):
+            call_command('benchmark_imports', 'nx')
+
+    def test_get_regressions(self):
+        baseline = {
+            'transxchange/a.xml': {'seconds': 1, 'max_rss': 100000, 'queries': 50, 'query_seconds': 0.01},
+            'transxchange/b.xml': {'seconds': 1, 'max_rss': 100000, 'queries': 50, 'query_seconds': 0.01},
+        }
+        results = {
+            'transxchange/a.xml': {'seconds': 1.1, 'max_rss': 100500, 'queries': 50, 'query_seconds': 0.03},
+            'transxchange/b.xml': {'error': "KeyError('b')"},
+            'transxchange/c.xml': {'seconds': 2, 'max_rss': 200000, 'queries': 500, 'query_seconds': 1},
+        }
+        self.assertEqual(get_regressions(results, baseline, 0.2), ["transxchange/b.xml: KeyError('b')"])
+
+        results['transxchange/a.xml']['seconds'] = 1.3
+        self.assertEqual(get_regressions(results, baseline, 0.2), [
+            'transxchange/a.xml seconds: 1 -> 1.3',
+            "transxchange/b.xml: KeyError('b')"
+        ])
+        self.assertEqual(get_regressions(results, baseline, 0.5), ["transxchange/b.xml: KeyError('b')"])
@@ -8,9 +8,9 @@ from unittest.mock import patch
 import time_machine
 from django.test import TestCase, override_settings
 from django.core.management import call_command
-from busstops.models import Region, Operator, DataSource, OperatorCode, Service, ServiceCode
+from busstops.models import Region, Operator, DataSource, OperatorCode, Service, ServiceCode, StopPoint
 from vehicles.models import VehicleJourney
-from ...models import Route, BankHoliday, CalendarBankHoliday, VehicleType, Block, Garage
+from ...models import Route, Trip, StopTime, BankHoliday, CalendarBankHoliday, VehicleType, Block, Garage
 
 
 FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
@@ -89,6 +89,33 @@ class ImportBusOpenDataTest(TestCase):
             '1 April 2020.'
         )
 
+        response = self.client.get(f'/services/{route.service_id}/timetable.json')
+        rows = [
+            row for grouping in response.json()['groupings'] for row in grouping['rows']
+            if row['stop']['atco_code'] == '2900W0321'
+        ]
+        self.assertEqual(rows[0]['stop']['name'], 'Walpole St Peter Lion Store')
+        self.assertIn([44340], [row['times'] for row in rows])  # 12:19
+
+        # conditional requests (the ETag uses timetable versions, which need a real cache)
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            url = f'/services/{route.service_id}/timetable.json'
+            etag = self.client.get(url).headers['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            # a stop renamed
+            StopPoint.objects.filter(atco_code='2900W0321').update(common_name='Village Shop')
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+
+            # trips or calendars edited, without touching the routes
+            with self.captureOnCommitCallbacks(execute=True):
+                Service.timetables_changed([route.service_id])
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
         # test views:
 
         trip = route.trip_set.first()
@@ -120,22 +147,29 @@ class ImportBusOpenDataTest(TestCase):
             ]
         }
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(7):
             response = self.client.get('/stops/2900W0321/times.json')
         self.assertEqual(response.json(), expected_json)
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(7):
             response = self.client.get('/stops/2900W0321/times.json?when=2020-05-01T09:15:00%2b01:00')
         self.assertEqual(response.json(), expected_json)
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(7):
             response = self.client.get('/stops/2900W0321/times.json?when=2020-05-01T09:15:00')
         self.assertEqual(response.json(), expected_json)
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(7):
             response = self.client.get('/stops/2900W0321/times.json?limit=10')
         self.assertEqual(1, len(response.json()['times']))
 
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertNumQueries(7):
+                self.client.get('/stops/2900W0321/times.json')
+            with self.assertNumQueries(4):  # using the cached DepartureIndex
+                response = self.client.get('/stops/2900W0321/times.json')
+        self.assertEqual(response.json(), expected_json)
+
         with self.assertNumQueries(1):
             response = self.client.get('/stops/2900W0321/times.json?limit=nine')
         self.assertEqual(400, response.status_code)
@@ -234,7 +268,7 @@ class ImportBusOpenDataTest(TestCase):
                     'bustimes.management.commands.import_bod.download_if_changed',
                     return_value=(True, parse_datetime('2020-06-10T12:00:00+01:00')),
                 ) as download_if_changed:
-                    with self.assertNumQueries(140):
+                    with self.assertNumQueries(163):
                         call_command('import_bod', 'stagecoach')
                     download_if_changed.assert_called_with(
                         path, 'https://opendata.stagecoachbus.com/' + archive_name
@@ -246,9 +280,18 @@ class ImportBusOpenDataTest(TestCase):
                     with self.assertNumQueries(0):
                         call_command('import_bod', 'stagecoach', 'scox')
 
-                    with self.assertNumQueries(81):
+                    trips = list(Trip.objects.order_by('id').values_list('id', 'start'))
+                    stop_times = list(StopTime.objects.order_by('id').values_list('id', 'trip', 'departure'))
+
+                    with self.assertNumQueries(68):
                         call_command('import_bod', 'stagecoach', 'sccm')
 
+                    # trips and stop times left alone, not deleted and recreated
+                    self.assertEqual(trips, list(Trip.objects.order_by('id').values_list('id', 'start')))
+                    self.assertEqual(
+                        stop_times, list(StopTime.objects.order_by('id').values_list('id', 'trip', 'departure'))
+                    )
+
                 source = DataSource.objects.get(name='Stagecoach East')
                 response = self.client.get(f'/sources/{source.id}/routes/')
 
@@ -260,10 +303,10 @@ class ImportBusOpenDataTest(TestCase):
                 self.assertEqual('', response.filename)
 
         self.assertEqual(BankHoliday.objects.count(), 13)
-        self.assertEqual(CalendarBankHoliday.objects.count(), 130)
+        self.assertEqual(CalendarBankHoliday.objects.count(), 65)
         self.assertEqual(VehicleType.objects.count(), 3)
         self.assertEqual(Garage.objects.count(), 4)
-        self.assertEqual(Block.objects.count(), 12)
+        self.assertEqual(Block.objects.count(), 6)  # reused when re-importing
 
         with self.assertNumQueries(4):
             response = self.client.get(f'/services/{route.service_id}.json')
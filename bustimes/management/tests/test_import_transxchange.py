@@ -16,7 +16,8 @@ from django.contrib.gis.geos import Point
 
 from busstops.models import Region, StopPoint, Service, Operator, OperatorCode, DataSource
 from vosa.models import Licence, Registration
-from ...models import Route, Trip, Calendar, CalendarDate
+from vehicles.models import VehicleJourney
+from ...models import Route, Trip, Calendar, CalendarDate, StopTime, TimingPattern, TimingPatternStop
 from ..commands import import_transxchange
 
 
@@ -590,6 +591,168 @@ class ImportTransXChangeTest(TestCase):
         self.assertEqual(1, Trip.objects.filter(route__service=services[1]).count())
         self.assertEqual(2, Trip.objects.filter(route__service=services[2]).count())
 
+    @time_machine.travel('2021-06-28')
+    def test_workers(self):
+        filenames = ('twm_3-74-_-y11-1.xml', 'notts_KRWL_DS_180DS_.xml')
+        with TemporaryDirectory() as directory:
+            zipfile_path = Path(directory) / 'EA.zip'
+            with zipfile.ZipFile(zipfile_path, 'a') as open_zipfile:
+                for filename in filenames:
+                    self.write_file_to_zipfile(open_zipfile, filename)
+            call_command('import_transxchange', zipfile_path, '--workers', '2')
+            parallel = list(Trip.objects.order_by('id').values_list('route__code', 'start', 'end', 'destination'))
+            parallel_stop_times = list(StopTime.objects.order_by('id').values_list(
+                'trip__route__code', 'stop', 'stop_code', 'arrival', 'departure', 'timing_status', 'pick_up'
+            ))
+            self.assertTrue(parallel)
+
+            Route.objects.all().delete()
+            call_command('import_transxchange', zipfile_path)
+            serial = list(Trip.objects.order_by('id').values_list('route__code', 'start', 'end', 'destination'))
+            serial_stop_times = list(StopTime.objects.order_by('id').values_list(
+                'trip__route__code', 'stop', 'stop_code', 'arrival', 'departure', 'timing_status', 'pick_up'
+            ))
+
+            # if a file fails, the files before it are still imported, as they would be without --workers
+            Route.objects.all().delete()
+            handle_transxchange = import_transxchange.Command.handle_transxchange
+
+            def fail_second_file(command, transxchange, filename, trips=None):
+                handle_transxchange(command, transxchange, filename, trips)
+                if filename == filenames[1]:
+                    raise ValueError
+
+            with patch.object(
+                import_transxchange.Command, 'handle_transxchange', autospec=True, side_effect=fail_second_file
+            ):
+                with self.assertRaises(ValueError):
+                    call_command('import_transxchange', zipfile_path, '--workers', '2')
+
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial_stop_times, parallel_stop_times)
+        self.assertEqual(
+            {filenames[0]},
+            {code.split('#')[0] for code in Route.objects.values_list('code', flat=True)}
+        )
+
+    @time_machine.travel('2021-06-28')
+    def test_unchanged_files(self):
+        filenames = ('twm_3-74-_-y11-1.xml', 'notts_KRWL_DS_180DS_.xml')
+        with TemporaryDirectory() as directory:
+            zipfile_path = Path(directory) / 'EA.zip'
+            with zipfile.ZipFile(zipfile_path, 'w') as open_zipfile:
+                for filename in filenames:
+                    self.write_file_to_zipfile(open_zipfile, filename)
+            call_command('import_transxchange', zipfile_path)
+
+            routes = list(Route.objects.order_by('id').values_list('id', 'code', 'sha1'))
+            self.assertTrue(all(sha1 for _, _, sha1 in routes))
+
+            # change one of the files
+            with zipfile.ZipFile(zipfile_path, 'w') as open_zipfile:
+                self.write_file_to_zipfile(open_zipfile, filenames[0])
+                open_zipfile.writestr(filenames[1], (FIXTURES_DIR / filenames[1]).read_bytes() + b'\n<!-- -->\n')
+
+            with patch.object(
+                import_transxchange.Command, 'handle_file', autospec=True,
+                side_effect=import_transxchange.Command.handle_file
+            ) as handle_file:
+                call_command('import_transxchange', zipfile_path)
+            handle_file.assert_called_once()
+            self.assertEqual(handle_file.call_args[0][2], filenames[1])
+
+            new_routes = list(Route.objects.order_by('id').values_list('id', 'code', 'sha1'))
+
+            # --force imports every file, but still records their hashes for the next import
+            with patch.object(
+                import_transxchange.Command, 'handle_file', autospec=True,
+                side_effect=import_transxchange.Command.handle_file
+            ) as handle_file:
+                call_command('import_transxchange', zipfile_path, '--force')
+            self.assertEqual(2, handle_file.call_count)
+            self.assertEqual(
+                {(code, sha1) for _, code, sha1 in new_routes},
+                set(Route.objects.values_list('code', 'sha1'))
+            )
+
+        self.assertEqual(len(routes), len(new_routes))
+        for route, new_route in zip(routes, new_routes):
+            if route[1].split('#')[0] == filenames[0]:
+                self.assertEqual(route, new_route)  # untouched
+            else:
+                self.assertNotEqual(route[2], new_route[2])
+
+    def test_timing_patterns(self):
+        path = FIXTURES_DIR / '22A 22B 22C 08032021.xml'
+
+        call_command('import_transxchange', path)
+        trip = Trip.objects.get(ticket_machine_code='1935')
+        stop_times = self.client.get(f'/trips/{trip.id}.json').json()
+        self.assertEqual(0, TimingPattern.objects.count())
+
+        Route.objects.all().delete()
+        call_command('import_transxchange', path, '--timing-patterns')
+        self.assertEqual(0, StopTime.objects.count())
+        self.assertLess(TimingPattern.objects.count(), Trip.objects.count())
+
+        trip = Trip.objects.get(ticket_machine_code='1935')
+        self.assertEqual(stop_times, self.client.get(f'/trips/{trip.id}.json').json())
+
+        # a tracked journey's stops come from the timing pattern too
+        journey = VehicleJourney.objects.create(
+            datetime=timezone.now(), source=DataSource.objects.first(), service=trip.route.service, trip=trip
+        )
+        journey_stops = self.client.get(f'/journeys/{journey.id}.json').json()['stops']
+        self.assertEqual(
+            [time['aimed_departure_time'] for time in stop_times['times']],
+            [stop['aimed_departure_time'] for stop in journey_stops]
+        )
+
+        # deleting a timing pattern doesn't delete its trips
+        trips_count = Trip.objects.count()
+        trip.timing_pattern.delete()
+        self.assertEqual(trips_count, Trip.objects.count())
+
+        # importing again without --timing-patterns
+        call_command('import_transxchange', path)
+        self.assertEqual(0, TimingPattern.objects.count())
+        self.assertEqual(0, TimingPatternStop.objects.count())
+        trip = Trip.objects.get(ticket_machine_code='1935')
+        self.assertEqual(stop_times, self.client.get(f'/trips/{trip.id}.json').json())
+
+    def test_reimport_changed_file(self):
+        xml = (FIXTURES_DIR / '22A 22B 22C 08032021.xml').read_text()
+
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / '22A 22B 22C 08032021.xml'
+            path.write_text(xml)
+            call_command('import_transxchange', path)
+
+            trips = dict(Trip.objects.values_list('vehicle_journey_code', 'id'))
+            stop_times = set(StopTime.objects.values_list('id', flat=True))
+            changed_trip = Trip.objects.get(vehicle_journey_code='VJ9')
+            changed_stop_times = set(changed_trip.stoptime_set.values_list('id', flat=True))
+
+            # one journey's departure time has changed
+            path.write_text(xml.replace('<DepartureTime>06:44:00', '<DepartureTime>06:45:00'))
+            with self.assertLogs('bustimes.management.commands.import_transxchange', 'INFO') as cm:
+                call_command('import_transxchange', path)
+
+        churn = [line for line in cm.output if 'stop times' in line]
+        self.assertEqual(len(churn), 1)
+        self.assertIn(
+            f'{len(changed_stop_times)} stop times deleted, {len(changed_stop_times)} stop times inserted', churn[0]
+        )
+
+        # same trip ids
+        self.assertEqual(trips, dict(Trip.objects.values_list('vehicle_journey_code', 'id')))
+        self.assertEqual(str(Trip.objects.get(vehicle_journey_code='VJ9')), '06:45')
+
+        # only the changed trip's stop times replaced
+        new_stop_times = set(StopTime.objects.values_list('id', flat=True))
+        self.assertEqual(len(stop_times), len(new_stop_times))
+        self.assertEqual(stop_times - new_stop_times, changed_stop_times)
+
     def test_start_dead_run(self):
         """Turns out WaitTimes and RunTimes should be ignored during a StartDeadRun"""
 
@@ -605,6 +768,35 @@ class ImportTransXChangeTest(TestCase):
         self.assertEqual(str(trips[0]), '21:45')
         self.assertEqual(str(trips[1]), '21:45')
 
+    @time_machine.travel('2021-06-28')
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_timetable_cache(self):
+        with self.assertLogs('bustimes.management.commands.import_transxchange', 'WARNING'):
+            call_command('import_transxchange', FIXTURES_DIR / 'square_COMT_100_06100B.xml')
+
+        service = Service.objects.get()
+        timetable = service.get_timetable(date(2021, 6, 29))
+
+        with self.assertNumQueries(0):
+            cached_timetable = service.get_timetable(date(2021, 6, 29))
+        self.assertEqual(
+            str(cached_timetable.groupings[0].rows[0].times), str(timetable.groupings[0].rows[0].times)
+        )
+        self.assertEqual(len(cached_timetable.groupings[1].trips), len(timetable.groupings[1].trips))
+        self.assertNotIn('stop_times', cached_timetable.groupings[0].trips[0].__dict__)
+        self.assertEqual(cached_timetable.date_options, timetable.date_options)
+
+        # re-importing invalidates it
+        key = service.get_timetable_cache_key(date(2021, 6, 29))
+        with self.captureOnCommitCallbacks(execute=True):
+            Service.timetables_changed([service.id])
+        self.assertNotEqual(service.get_timetable_cache_key(date(2021, 6, 29)), key)
+
+        call_command('warm_timetables', '--days', '1')
+        with self.assertNumQueries(0):
+            self.assertTrue(service.get_timetable().groupings)
+            self.assertTrue(service.get_timetable(date(2021, 6, 28)).groupings)
+
     @time_machine.travel('2021-06-28')
     def test_difficult_layout(self):
         with self.assertLogs('bustimes.management.commands.import_transxchange', 'WARNING') as cm:
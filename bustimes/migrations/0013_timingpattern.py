@@ -0,0 +1,46 @@
+# Generated by Django 3.2.7 on 2021-10-12 20:14
+
+import bustimes.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('busstops', '0010_auto_20210930_1810'),
+        ('bustimes', '0012_alter_route_revision_number'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimingPattern',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bustimes.route')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TimingPatternStop',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('stop_code', models.CharField(blank=True, max_length=255)),
+                ('arrival', bustimes.fields.SecondsField(blank=True, null=True)),
+                ('departure', bustimes.fields.SecondsField(blank=True, null=True)),
+                ('sequence', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('timing_status', models.CharField(blank=True, max_length=3)),
+                ('pick_up', models.BooleanField(default=True)),
+                ('set_down', models.BooleanField(default=True)),
+                ('pattern', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bustimes.timingpattern')),
+                ('stop', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='busstops.stoppoint')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='timing_pattern',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='bustimes.timingpattern'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.7 on 2021-10-13 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0013_timingpattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='sha1',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
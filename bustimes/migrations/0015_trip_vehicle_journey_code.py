@@ -0,0 +1,18 @@
+# Generated by Django 3.2.8 on 2021-10-20 12:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0014_route_sha1'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='vehicle_journey_code',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2021-11-12 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0015_trip_vehicle_journey_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='hash',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+    ]
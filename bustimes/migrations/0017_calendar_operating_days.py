@@ -0,0 +1,24 @@
+# Generated by Django 3.2.9 on 2021-11-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0016_calendar_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='operating_days',
+            field=models.TextField(blank=True, default='', editable=False),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='calendar',
+            name='operating_days_start',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+    ]
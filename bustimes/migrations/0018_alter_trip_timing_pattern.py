@@ -0,0 +1,19 @@
+# Generated by Django 3.2.9 on 2021-11-22 10:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0017_calendar_operating_days'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trip',
+            name='timing_pattern',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='bustimes.timingpattern'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2021-11-22 11:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bustimes', '0018_alter_trip_timing_pattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendar',
+            name='last_used',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,7 +1,12 @@
-from django.db.models import Q, Exists, OuterRef
+import datetime
+import hashlib
+from functools import cached_property
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Exists, OuterRef, Prefetch, F, Func, Value
 from django.contrib.gis.db import models
-from django.db.models.functions import Upper
+from django.db.models.functions import Substr, Upper
 from django.urls import reverse
+from django.utils.timezone import is_aware, localdate, now
 from .fields import SecondsField
 from .utils import format_timedelta, time_datetime
 
@@ -56,8 +61,21 @@ def get_routes(routes, when=None):
 
 
 def get_calendars(when, calendar_ids=None):
-    calendars = Calendar.objects.filter(Q(end_date__gte=when) | Q(end_date=None),
-                                        start_date__lte=when)
+    if isinstance(when, datetime.datetime):
+        date = localdate(when) if is_aware(when) else when.date()
+    else:
+        date = when
+
+    # '1' or '0' if the date is in the calendar's operating_days, or '' or None if it isn't
+    operating_day = Substr('operating_days', Func(
+        Value(date, output_field=models.DateField()), F('operating_days_start'),
+        arg_joiner=' - ', template='(%(expressions)s + 1)', output_field=models.IntegerField()
+    ), 1)
+
+    calendars = Calendar.objects.alias(operating_day=operating_day)
+    compiled = Q(operating_day='1')
+    not_compiled = Q(operating_day='') | Q(operating_day=None)
+
     calendar_calendar_dates = CalendarDate.objects.filter(calendar=OuterRef('id'))
     calendar_dates = calendar_calendar_dates.filter(
         Q(end_date__gte=when) | Q(end_date=None),
@@ -78,10 +96,14 @@ def get_calendars(when, calendar_ids=None):
     )
 
     return calendars.filter(
-        ~Exists(exclusions),
-        ~Exists(calendar_bank_holidays.filter(operation=False)),
-        ~only_certain_dates | Exists(inclusions) | Exists(calendar_bank_holidays.filter(operation=True)),
-        Q(**{when.strftime('%a').lower(): True}) | Exists(special_inclusions)
+        compiled | not_compiled & Q(
+            Q(end_date__gte=when) | Q(end_date=None),
+            ~Exists(exclusions),
+            ~Exists(calendar_bank_holidays.filter(operation=False)),
+            ~only_certain_dates | Exists(inclusions) | Exists(calendar_bank_holidays.filter(operation=True)),
+            Q(**{when.strftime('%a').lower(): True}) | Exists(special_inclusions),
+            start_date__lte=when,
+        )
     )
 
 
@@ -101,6 +123,7 @@ class Route(models.Model):
     end_date = models.DateField(null=True, blank=True)
     service = models.ForeignKey('busstops.Service', models.CASCADE)
     geometry = models.MultiLineStringField(null=True, blank=True, editable=False)
+    sha1 = models.CharField(max_length=40, null=True, blank=True)  # of the file the route was imported from
 
     def contains(self, date):
         if not self.start_date or self.start_date <= date:
@@ -160,6 +183,10 @@ class CalendarBankHoliday(models.Model):
         return f'not {self.bank_holiday}'
 
 
+OPERATING_DAYS_BEFORE = datetime.timedelta(days=28)
+OPERATING_DAYS_AFTER = datetime.timedelta(days=365)
+
+
 class Calendar(models.Model):
     mon = models.BooleanField()
     tue = models.BooleanField()
@@ -172,6 +199,12 @@ class Calendar(models.Model):
     end_date = models.DateField(null=True, blank=True)
     summary = models.CharField(max_length=255, blank=True)
     bank_holidays = models.ManyToManyField(BankHoliday, through=CalendarBankHoliday)
+    hash = models.CharField(max_length=40, null=True, blank=True, unique=True)  # see get_hash
+    # whether the calendar operates on each day (1 or 0) from operating_days_start - see compile_calendars
+    operating_days_start = models.DateField(null=True, blank=True, editable=False)
+    operating_days = models.TextField(blank=True, editable=False)
+    # when an import last created or reused the calendar - see get_or_create_calendar and delete_unused_calendars
+    last_used = models.DateTimeField(null=True, blank=True, editable=False)
 
     contains = Route.contains
 
@@ -180,13 +213,76 @@ class Calendar(models.Model):
             ('start_date', 'end_date'),
         )
 
+    def get_hash(self, calendar_dates=(), bank_holidays=()):
+        """
+        A SHA-1 digest of everything about the calendar, including its CalendarDates and CalendarBankHolidays
+        (which needn't have been saved yet), so identical calendars can be shared by different imports
+        """
+        key = [
+            self.mon, self.tue, self.wed, self.thu, self.fri, self.sat, self.sun,
+            self.start_date, self.end_date, self.summary,
+            sorted(repr(
+                (date.start_date, date.end_date, date.operation, date.special, date.summary)
+            ) for date in calendar_dates),
+            sorted((bank_holiday.bank_holiday_id, bank_holiday.operation) for bank_holiday in bank_holidays)
+        ]
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
     def is_sufficiently_simple(self, future):
         if self.summary or all(date.start_date > future for date in self.calendardate_set.all()):
             if str(self):
                 return True
         return False
 
+    def operates_on(self, date, calendar_dates, bank_holidays, only_certain_dates):
+        """Like get_calendars, but in Python, given the calendar's CalendarDates
+        and a dict of its bank holidays' dates and operations (see get_bank_holidays)
+        """
+        if not self.contains(date):
+            return False
+
+        calendar_dates = [calendar_date for calendar_date in calendar_dates if calendar_date.contains(date)]
+        bank_holiday_operations = bank_holidays.get(date, ())
+
+        if False in bank_holiday_operations or any(not calendar_date.operation for calendar_date in calendar_dates):
+            return False
+
+        if only_certain_dates and True not in bank_holiday_operations:
+            if not any(calendar_date.operation for calendar_date in calendar_dates):
+                return False
+
+        if getattr(self, date.strftime('%a').lower()):
+            return True
+        return any(calendar_date.operation and calendar_date.special for calendar_date in calendar_dates)
+
+    def compile(self, calendar_dates, bank_holidays, today=None):
+        """Work out operating_days, from a few weeks ago until a year from now
+        (or the calendar's start and end dates, if they're sooner)
+        """
+        today = today or localdate()
+        start_date = max(self.start_date, today - OPERATING_DAYS_BEFORE)
+        end_date = today + OPERATING_DAYS_AFTER
+        if self.end_date:
+            end_date = min(self.end_date, end_date)
+
+        only_certain_dates = any(
+            calendar_date.operation and not calendar_date.special for calendar_date in calendar_dates
+        )
+
+        self.operating_days_start = start_date
+        self.operating_days = ''.join(
+            '1' if self.operates_on(
+                start_date + datetime.timedelta(days=i), calendar_dates, bank_holidays, only_certain_dates
+            ) else '0'
+            for i in range((end_date - start_date).days + 1)
+        )
+
     def allows(self, date):
+        if self.operating_days_start:
+            i = (date - self.operating_days_start).days
+            if 0 <= i < len(self.operating_days):
+                return self.operating_days[i] == '1'
+
         if not self.contains(date):
             return False
 
@@ -227,6 +323,89 @@ class Calendar(models.Model):
         return days
 
 
+def get_bank_holidays(calendar_bank_holidays):
+    """Given some CalendarBankHolidays, return a dict of {calendar id: {date: [operation, ...]}}
+    (the calendar id of unsaved ones is None)
+    """
+    calendar_bank_holidays = list(calendar_bank_holidays)
+    bank_holiday_dates = {}
+    if calendar_bank_holidays:
+        for bank_holiday_id, date in BankHolidayDate.objects.filter(
+            bank_holiday__in={calendar_bank_holiday.bank_holiday_id for calendar_bank_holiday in calendar_bank_holidays}
+        ).values_list('bank_holiday', 'date'):
+            bank_holiday_dates.setdefault(bank_holiday_id, []).append(date)
+
+    bank_holidays = {}
+    for calendar_bank_holiday in calendar_bank_holidays:
+        dates = bank_holidays.setdefault(calendar_bank_holiday.calendar_id, {})
+        for date in bank_holiday_dates.get(calendar_bank_holiday.bank_holiday_id, ()):
+            dates.setdefault(date, []).append(calendar_bank_holiday.operation)
+    return bank_holidays
+
+
+def compile_calendars(calendars, save=True):
+    """Work out (or update, when CalendarDates or BankHolidayDates have changed,
+    or the old ones don't go far enough into the future) the operating_days of some saved calendars
+    (without saving them, if save is False)
+    """
+    calendars = list(calendars)
+
+    calendar_dates = {}
+    for calendar_date in CalendarDate.objects.filter(calendar__in=calendars):
+        calendar_dates.setdefault(calendar_date.calendar_id, []).append(calendar_date)
+
+    bank_holidays = get_bank_holidays(CalendarBankHoliday.objects.filter(calendar__in=calendars))
+
+    for calendar in calendars:
+        calendar.compile(calendar_dates.get(calendar.id, []), bank_holidays.get(calendar.id, {}))
+
+    if save:
+        Calendar.objects.bulk_update(calendars, ['operating_days_start', 'operating_days'], batch_size=1000)
+
+
+# how often an import marks a calendar it's reusing as recently used
+CALENDAR_LAST_USED_INTERVAL = datetime.timedelta(hours=1)
+
+
+def get_or_create_calendar(calendar, calendar_dates=(), bank_holidays=()):
+    """
+    Given an unsaved Calendar and its unsaved CalendarDates and CalendarBankHolidays,
+    return an existing identical calendar, or else save them all and return the new calendar
+    """
+    calendar_dates = list(calendar_dates)
+    bank_holidays = list(bank_holidays)
+    calendar.hash = calendar.get_hash(calendar_dates, bank_holidays)
+
+    existing_calendar = Calendar.objects.filter(hash=calendar.hash).first()
+    if existing_calendar:
+        last_used = now()
+        if existing_calendar.last_used and last_used - existing_calendar.last_used < CALENDAR_LAST_USED_INTERVAL:
+            return existing_calendar
+        # (locks the row until the import's transaction ends, so delete_unused_calendars can't delete it before then)
+        if Calendar.objects.filter(id=existing_calendar.id).update(last_used=last_used):
+            existing_calendar.last_used = last_used
+            return existing_calendar
+        # deleted by delete_unused_calendars in the meantime - so create it again
+
+    calendar.last_used = now()
+    calendar.compile(calendar_dates, get_bank_holidays(bank_holidays).get(None, {}))
+
+    try:
+        with transaction.atomic():
+            calendar.save()
+            for calendar_date in calendar_dates:
+                calendar_date.calendar = calendar
+            CalendarDate.objects.bulk_create(calendar_dates)
+            for bank_holiday in bank_holidays:
+                bank_holiday.calendar = calendar
+            CalendarBankHoliday.objects.bulk_create(bank_holidays)
+    except IntegrityError:
+        # created by another import in the meantime
+        return Calendar.objects.get(hash=calendar.hash)
+
+    return calendar
+
+
 class CalendarDate(models.Model):
     calendar = models.ForeignKey(Calendar, models.CASCADE)
     start_date = models.DateField(db_index=True)
@@ -263,6 +442,7 @@ class Trip(models.Model):
     inbound = models.BooleanField(default=False)
     journey_pattern = models.CharField(max_length=255, blank=True)
     ticket_machine_code = models.CharField(max_length=255, blank=True, db_index=True)
+    vehicle_journey_code = models.CharField(max_length=255, blank=True)
     block = models.ForeignKey('Block', models.SET_NULL, null=True, blank=True)
     destination = models.ForeignKey('busstops.StopPoint', models.SET_NULL, null=True, blank=True)
     calendar = models.ForeignKey(Calendar, models.DO_NOTHING, null=True, blank=True)
@@ -273,10 +453,20 @@ class Trip(models.Model):
     garage = models.ForeignKey('Garage', models.SET_NULL, null=True, blank=True)
     vehicle_type = models.ForeignKey('VehicleType', models.SET_NULL, null=True, blank=True)
     operator = models.ForeignKey('busstops.Operator', models.SET_NULL, null=True, blank=True)
+    timing_pattern = models.ForeignKey('TimingPattern', models.SET_NULL, null=True, blank=True)
 
     def __str__(self):
         return format_timedelta(self.start)
 
+    @cached_property
+    def stop_times(self):
+        """This trip's StopTimes - either its own, or (unsaved) ones made from its shared TimingPattern"""
+        if self.timing_pattern_id:
+            return [
+                pattern_stop.get_stop_time(self) for pattern_stop in self.timing_pattern.timingpatternstop_set.all()
+            ]
+        return list(self.stoptime_set.all())
+
     def start_time(self):
         return format_timedelta(self.start)
 
@@ -318,6 +508,59 @@ class Trip(models.Model):
         return reverse('trip_detail', args=(self.id,))
 
 
+def prefetch_stop_times(*args, **kwargs):
+    """
+    Prefetch objects for getting Trip.stop_times that match a filter, whichever way they're stored.
+    For example, trips.prefetch_related(*prefetch_stop_times(stop__isnull=False))
+    """
+    return [
+        Prefetch('stoptime_set', queryset=StopTime.objects.filter(*args, **kwargs)),
+        Prefetch('timing_pattern__timingpatternstop_set', queryset=TimingPatternStop.objects.filter(*args, **kwargs)),
+    ]
+
+
+class TimingPattern(models.Model):
+    """
+    A sequence of stops and times (relative to the start of the trip) shared by trips on a route,
+    instead of each trip having its own StopTimes
+    """
+    route = models.ForeignKey(Route, models.CASCADE)
+
+
+class TimingPatternStop(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    pattern = models.ForeignKey(TimingPattern, models.CASCADE)
+    stop_code = models.CharField(max_length=255, blank=True)
+    stop = models.ForeignKey('busstops.StopPoint', models.SET_NULL, null=True, blank=True)
+    arrival = SecondsField(null=True, blank=True)
+    departure = SecondsField(null=True, blank=True)
+    sequence = models.PositiveSmallIntegerField(null=True, blank=True)
+    timing_status = models.CharField(max_length=3, blank=True)
+    pick_up = models.BooleanField(default=True)
+    set_down = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def get_stop_time(self, trip):
+        stop_time = StopTime(
+            trip=trip,
+            stop_code=self.stop_code,
+            stop_id=self.stop_id,
+            sequence=self.sequence,
+            timing_status=self.timing_status,
+            pick_up=self.pick_up,
+            set_down=self.set_down
+        )
+        if self.arrival is not None:
+            stop_time.arrival = trip.start + self.arrival
+        if self.departure is not None:
+            stop_time.departure = trip.start + self.departure
+        if self.stop_id and TimingPatternStop.stop.is_cached(self):
+            stop_time.stop = self.stop
+        return stop_time
+
+
 class StopTime(models.Model):
     id = models.BigAutoField(primary_key=True)
     trip = models.ForeignKey(Trip, models.CASCADE)
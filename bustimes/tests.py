@@ -1,10 +1,17 @@
 import os
+import time_machine
 from datetime import date, timedelta, datetime, timezone
 from vcr import use_cassette
+from django.core.management import call_command
 from django.test import TestCase
-from busstops.models import DataSource
+from busstops.models import DataSource, Service
 from vehicles.models import Livery, Vehicle
-from .models import Trip
+from .bulk import bulk_create
+from .models import (
+    Route, Trip, StopTime, Calendar, CalendarDate, CalendarBankHoliday, BankHoliday, BankHolidayDate,
+    get_or_create_calendar, get_calendars, compile_calendars
+)
+from .utils import format_timedelta, time_datetime
 
 
 class BusTimesTest(TestCase):
@@ -67,3 +74,107 @@ class BusTimesTest(TestCase):
             trip.start_datetime(date(2021, 10, 31)),
             datetime(2021, 11, 1, 1, 47, 30, tzinfo=timezone(timedelta()))
         )
+
+    def test_bulk_create(self):
+        service = Service.objects.create(line_name='8', current=True)
+        route = Route.objects.create(source_id=7, code='8', service=service)
+        for copy in (True, False):
+            trip = Trip(route=route, start=timedelta(hours=25), end=timedelta(hours=25, minutes=10))
+            bulk_create(Trip, [trip], copy=copy, set_ids=True)
+            self.assertIsNotNone(trip.id)
+            bulk_create(StopTime, [
+                StopTime(trip=trip, stop_code='Bow\tChurch\\', departure=timedelta(hours=25), sequence=1),
+                StopTime(trip=trip, stop_code='Old Ford Road', arrival=timedelta(hours=25, minutes=10), set_down=False),
+            ], copy=copy)
+
+            trip = Trip.objects.get(id=trip.id)
+            self.assertEqual(trip.end, timedelta(hours=25, minutes=10))
+            stop_times = trip.stoptime_set.all()
+            self.assertEqual(stop_times[0].stop_code, 'Bow\tChurch\\')
+            self.assertEqual(stop_times[0].departure, timedelta(hours=25))
+            self.assertIsNone(stop_times[0].arrival)
+            self.assertIsNone(stop_times[1].sequence)
+            self.assertFalse(stop_times[1].set_down)
+            self.assertTrue(stop_times[1].pick_up)
+
+    def test_time_datetime(self):
+        self.assertEqual(format_timedelta(timedelta(hours=7, minutes=5, seconds=30)), '07:05')
+        self.assertEqual(format_timedelta(timedelta(hours=25, minutes=30)), '01:30')
+
+        self.assertEqual(str(time_datetime(timedelta(hours=25, minutes=30), date(2021, 6, 1))),
+                         '2021-06-02 01:30:00+01:00')
+        # the clocks go back at 02:00, so 01:30 happens twice - the first one is used
+        self.assertEqual(str(time_datetime(timedelta(hours=1, minutes=30), date(2021, 10, 31))),
+                         '2021-10-31 01:30:00+01:00')
+        self.assertEqual(str(time_datetime(timedelta(hours=12), date(2021, 10, 31))), '2021-10-31 12:00:00+00:00')
+
+    def test_get_or_create_calendar(self):
+        def get_calendar(special):
+            return get_or_create_calendar(
+                Calendar(mon=True, tue=True, wed=True, thu=True, fri=True, sat=False, sun=False,
+                         start_date=date(2021, 6, 1)),
+                [CalendarDate(start_date=date(2021, 6, 5), end_date=date(2021, 6, 5), operation=True, special=special)]
+            )
+
+        calendar = get_calendar(True)
+        self.assertIsNotNone(calendar.hash)
+        self.assertEqual(calendar.calendardate_set.count(), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_calendar(True), calendar)
+        self.assertNotEqual(get_calendar(False), calendar)
+        self.assertEqual(CalendarDate.objects.count(), 2)
+
+        service = Service.objects.create(line_name='8', current=True)
+        route = Route.objects.create(source_id=7, code='8', service=service)
+        Trip.objects.create(route=route, calendar=calendar, start=timedelta(hours=10), end=timedelta(hours=11))
+
+        # an unused calendar that an import has just used (whose trips might not be committed yet) isn't deleted
+        call_command('delete_unused_calendars', verbosity=0)
+        self.assertEqual(Calendar.objects.count(), 2)
+
+        with time_machine.travel(datetime.now(timezone.utc) + timedelta(days=2)):
+            call_command('delete_unused_calendars', verbosity=0)
+            self.assertEqual(list(Calendar.objects.all()), [calendar])
+            self.assertEqual(CalendarDate.objects.get().calendar, calendar)
+
+            # reusing a calendar after a while marks it as used again
+            with self.assertNumQueries(2):
+                self.assertEqual(get_calendar(True), calendar)
+            calendar.refresh_from_db()
+            self.assertGreater(calendar.last_used, datetime.now(timezone.utc) - timedelta(minutes=1))
+
+            # a calendar that was deleted while unused is created again
+            new_calendar = get_calendar(False)
+            self.assertEqual(new_calendar.calendardate_set.count(), 1)
+            call_command('delete_unused_calendars', verbosity=0)
+            self.assertEqual(Calendar.objects.count(), 2)
+
+    def test_calendar_operating_days(self):
+        calendar = Calendar.objects.create(mon=True, tue=True, wed=True, thu=True, fri=True, sat=False, sun=False,
+                                           start_date=date(2021, 6, 1), end_date=date(2021, 7, 31))
+        CalendarDate.objects.create(calendar=calendar, start_date=date(2021, 6, 7), end_date=date(2021, 6, 8),
+                                    operation=False)
+        CalendarDate.objects.create(calendar=calendar, start_date=date(2021, 6, 12), end_date=date(2021, 6, 12),
+                                    operation=True, special=True)
+        bank_holiday = BankHoliday.objects.create(name='Midsummer Day')
+        BankHolidayDate.objects.create(bank_holiday=bank_holiday, date=date(2021, 6, 24))
+        CalendarBankHoliday.objects.create(calendar=calendar, bank_holiday=bank_holiday, operation=False)
+
+        days = [date(2021, 5, 25) + timedelta(days=i) for i in range(75)]
+
+        def get_days():
+            return [day for day in days if get_calendars(day).filter(id=calendar.id).exists()]
+
+        expected = get_days()  # not compiled yet
+        self.assertEqual(len(expected), 42)
+        self.assertIn(date(2021, 6, 12), expected)
+        self.assertNotIn(date(2021, 6, 24), expected)
+
+        with time_machine.travel('2021-06-15'):
+            compile_calendars([calendar])
+        calendar.refresh_from_db()
+        self.assertEqual(calendar.operating_days_start, date(2021, 6, 1))
+        self.assertEqual(len(calendar.operating_days), 61)
+
+        self.assertEqual(get_days(), expected)
+        self.assertEqual([day for day in days if calendar.allows(day)], expected)
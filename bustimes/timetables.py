@@ -1,22 +1,26 @@
+import copy
 import datetime
 from django.utils.timezone import localdate
 from difflib import Differ
-from functools import cmp_to_key, partial, cached_property
-from django.db.models import Prefetch, Q, OuterRef, Exists
+from functools import cmp_to_key, cached_property
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Q, OuterRef, Exists, Subquery, Case, When, Min
 from .utils import format_timedelta
-from .models import get_calendars, get_routes, Calendar, Trip, StopTime
+from .models import (
+    get_calendars, get_routes, prefetch_stop_times, Calendar, Trip, StopTime, TimingPatternStop
+)
 
 differ = Differ(charjunk=lambda _: True)
 
 
 def get_journey_patterns(trips):
-    trips = trips.prefetch_related(Prefetch('stoptime_set', queryset=StopTime.objects.filter(stop__isnull=False)))
+    trips = trips.prefetch_related(*prefetch_stop_times(stop__isnull=False))
 
     patterns = []
     pattern_hashes = set()
 
     for trip in trips:
-        pattern = [stoptime.stop_id for stoptime in trip.stoptime_set.all()]
+        pattern = [stoptime.stop_id for stoptime in trip.stop_times]
         pattern_hash = str(pattern)
         if pattern_hash not in pattern_hashes:
             patterns.append(pattern)
@@ -26,108 +30,151 @@ def get_journey_patterns(trips):
 
 
 def get_stop_usages(trips):
+    """Given some trips, return a list of (stop_id, timing_status) for each direction (outbound and inbound).
+
+    Instead of loading every trip's stop times, the distinct sequences of stops are got in one grouped query,
+    in order of each sequence's first trip, and merged together
+    """
+    stop_times = StopTime.objects.filter(trip=OuterRef('id'), stop__isnull=False).values('trip')
+    pattern_stops = TimingPatternStop.objects.filter(
+        pattern=OuterRef('timing_pattern'), stop__isnull=False
+    ).values('pattern')
+
+    def get_array(field):
+        # from the trip's own StopTimes, or its TimingPattern
+        return Case(
+            When(timing_pattern=None, then=Subquery(
+                stop_times.annotate(array=ArrayAgg(field, ordering='id')).values('array')
+            )),
+            default=Subquery(pattern_stops.annotate(array=ArrayAgg(field, ordering='id')).values('array'))
+        )
+
+    patterns = trips.annotate(
+        stops=get_array('stop'), timing_statuses=get_array('timing_status')
+    ).values('inbound', 'stops', 'timing_statuses').annotate(first_trip=Min('id')).order_by('first_trip')
+
     groupings = [[], []]
 
-    trips = trips.prefetch_related(Prefetch('stoptime_set', queryset=StopTime.objects.filter(stop__isnull=False)))
+    for pattern in patterns:
+        if not pattern['stops']:
+            continue
 
-    for trip in trips:
-        if trip.inbound:
-            grouping_id = 1
+        if pattern['inbound']:
+            grouping = groupings[1]
         else:
-            grouping_id = 0
-        grouping = groupings[grouping_id]
-
-        stop_times = trip.stoptime_set.all()
+            grouping = groupings[0]
 
-        old_rows = [stop_time.stop_id for stop_time in grouping]
-        new_rows = [stop_time.stop_id for stop_time in stop_times]
-        diff = differ.compare(old_rows, new_rows)
+        old_rows = [stop_id for stop_id, _ in grouping]
+        diff = differ.compare(old_rows, pattern['stops'])
 
         y = 0  # how many rows down we are
 
-        for stop_time in stop_times:
-            if y < len(old_rows):
-                existing_row = old_rows[y]
-            else:
-                existing_row = None
-
+        for stop_id, timing_status in zip(pattern['stops'], pattern['timing_statuses']):
             instruction = next(diff)
 
             while instruction[0] in '-?':
                 if instruction[0] == '-':
                     y += 1
-                    if y < len(old_rows):
-                        existing_row = old_rows[y]
-                    else:
-                        existing_row = None
                 instruction = next(diff)
 
-            assert instruction[2:] == stop_time.stop_id
+            assert instruction[2:] == stop_id
 
             if instruction[0] == '+':
-                if not existing_row:
-                    grouping.append(stop_time)
-                    old_rows.append(stop_time.stop_id)
-                else:
-                    grouping = grouping[:y] + [stop_time] + grouping[y:]
-                    old_rows = old_rows[:y] + [stop_time.stop_id] + old_rows[y:]
+                grouping.insert(y, (stop_id, timing_status))
             else:
-                assert instruction[2:] == existing_row
+                assert instruction[2:] == grouping[y][0]
 
             y += 1
 
-        groupings[grouping_id] = grouping
-
     return groupings
 
 
-def compare_trips(rows, trip_ids, a, b):
-    a_time = None
-    b_time = None
-    a_top = None
-    a_bottom = None
-    b_top = None
-    b_bottom = None
-    a_index = trip_ids.index(a.id)
-    b_index = trip_ids.index(b.id)
-
-    for i, row in enumerate(rows):
-        if row.times[a_index]:
-            if a_top is None:
-                a_top = i
-            a_bottom = i
-        if row.times[b_index]:
-            if b_top is None:
-                b_top = i
-            b_bottom = i
-            if row.times[a_index]:
-                a_time = row.times[a_index].arrival
-                b_time = row.times[b_index].arrival
-                break
-
-    if a_top is None and b_top is None:
-        return 0
+def get_trips_order(rows, trips, trips_rows):
+    """Given a grouping's rows, trips and the rows each trip has times in (see Grouping.build_rows),
+    return the order to put the trips (columns) in.
+    Trips are compared at the first row they both have times for, or failing that by start and end times,
+    with ties broken by which one is further up the table.
 
-    if a_time is None:
-        if a_top >= b_bottom:  # b is above a
-            a_time = a.start
-            b_time = b.end
-        elif b_top >= a_bottom:  # a is above b
-            a_time = a.end
-            b_time = b.start
+    Each trip's row indices and times are worked out beforehand,
+    so comparing two trips doesn't involve scanning all the rows
+    """
+    row_indices = {row: y for y, row in enumerate(rows)}
+
+    # trips with the same sequence of stops share a list of rows (and have the same first shared row with
+    # any other trip)
+    patterns = {}
+    trip_patterns = []
+    trip_rows = []  # row indices
+    trip_times = []  # arrival times at those rows
+    for trip, pattern_rows in zip(trips, trips_rows):
+        if id(pattern_rows) not in patterns:
+            patterns[id(pattern_rows)] = len(patterns), [row_indices[row] for row in pattern_rows]
+        pattern, indices = patterns[id(pattern_rows)]
+        trip_patterns.append(pattern)
+        trip_rows.append(indices)
+        trip_times.append([
+            stoptime.departure if stoptime.arrival is None else stoptime.arrival for stoptime in trip.stop_times
+        ])
+
+    shared_rows = {}
+
+    def get_shared_row(x_a, x_b):
+        """The first row trips a and b both have times for, and its index in each trip's list of rows"""
+        key = (trip_patterns[x_a], trip_patterns[x_b])
+        if key not in shared_rows:
+            a_rows = trip_rows[x_a]
+            b_rows = set(trip_rows[x_b])
+            shared_row = next((y for y in a_rows if y in b_rows), None)
+            if shared_row is None:
+                shared_rows[key] = None
+            else:
+                shared_rows[key] = shared_row, a_rows.index(shared_row), trip_rows[x_b].index(shared_row)
+        return shared_rows[key]
+
+    def compare_trips(x_a, x_b):
+        a_rows = trip_rows[x_a]
+        b_rows = trip_rows[x_b]
+        if not a_rows and not b_rows:
+            return 0
+
+        shared_row = get_shared_row(x_a, x_b)
+        if shared_row:
+            y, a_index, b_index = shared_row
+            a_time = trip_times[x_a][a_index]
+            b_time = trip_times[x_b][b_index]
+            # (only rows down to the shared row are considered)
+            a_top = a_rows[0]
+            b_top = b_rows[0]
+            a_bottom = b_bottom = y
         else:
-            a_time = a.start
-            b_time = b.start
+            a_top = a_rows[0] if a_rows else None
+            a_bottom = a_rows[-1] if a_rows else None
+            b_top = b_rows[0] if b_rows else None
+            b_bottom = b_rows[-1] if b_rows else None
+
+            a = trips[x_a]
+            b = trips[x_b]
+            if a_top >= b_bottom:  # b is above a
+                a_time = a.start
+                b_time = b.end
+            elif b_top >= a_bottom:  # a is above b
+                a_time = a.end
+                b_time = b.start
+            else:
+                a_time = a.start
+                b_time = b.start
+
+        if a_time > b_time:
+            return 1  # a is later
+        elif a_time < b_time:
+            return -1  # b is later
+        elif a_top >= b_bottom:  # b is above a
+            return 1
+        elif b_top >= a_bottom:  # a is above a
+            return -1
+        return 0
 
-    if a_time > b_time:
-        return 1  # a is later
-    elif a_time < b_time:
-        return -1  # b is later
-    elif a_top >= b_bottom:  # b is above a
-        return 1
-    elif b_top >= a_bottom:  # a is above a
-        return -1
-    return 0
+    return sorted(range(len(trips)), key=cmp_to_key(compare_trips))
 
 
 class Timetable:
@@ -194,7 +241,7 @@ class Timetable:
         ).select_related(
             'route__service'
         ).prefetch_related(
-            Prefetch('stoptime_set', queryset=StopTime.objects.filter(Q(pick_up=True) | Q(set_down=True))),
+            *prefetch_stop_times(Q(pick_up=True) | Q(set_down=True)),
             'notes'
         )
 
@@ -212,26 +259,23 @@ class Timetable:
         for grouping in self.groupings:
 
             # longest trips first, to minimise duplicate rows
-            grouping.trips.sort(key=lambda t: -len(t.stoptime_set.all()))
+            grouping.trips.sort(key=lambda t: -len(t.stop_times))
 
             # build the table
-            for trip in grouping.trips:
-                grouping.handle_trip(trip)
-
-            trip_ids = [trip.id for trip in grouping.trips]
+            trips_rows = grouping.build_rows()
 
             # sort columns properly, now we have the rows
-            grouping.trips.sort(key=cmp_to_key(partial(compare_trips, grouping.rows, trip_ids)))
+            indices = get_trips_order(grouping.rows, grouping.trips, trips_rows)
 
-            new_trip_ids = [trip.id for trip in grouping.trips]
-            indices = [trip_ids.index(trip_id) for trip_id in new_trip_ids]
-
-            for row in grouping.rows:
-                # reassemble in order
-                row.times = [row.times[i] for i in indices]
+            grouping.trips = [grouping.trips[i] for i in indices]
+            trips_rows = [trips_rows[i] for i in indices]
 
+            # notes, and runs of trips to abbreviate
             grouping.do_heads_and_feet(detailed)
 
+            # only now fill in the times, leaving out the abbreviated trips
+            grouping.fill_rows(trips_rows)
+
         if all(grouping.trips for grouping in self.groupings):
             self.groupings.sort(key=Grouping.get_order)
 
@@ -239,6 +283,12 @@ class Timetable:
             (route.origin, route.destination, route.via) for route in self.current_routes if route.origin
         }
 
+    def __getstate__(self):
+        """For caching - the calendars have already been used to work out the date options"""
+        state = self.__dict__.copy()
+        state.pop('calendars', None)
+        return state
+
     def any_trip_has(self, attr: str) -> bool:
         for grouping in self.groupings:
             for trip in grouping.trips:
@@ -298,7 +348,7 @@ class Timetable:
         for grouping in self.groupings:
             for row in grouping.rows:
                 for cell in row.times:
-                    if type(cell) is Cell and cell.stoptime.pick_up is False and not cell.last:
+                    if type(cell) is Cell and cell.pick_up is False and not cell.last:
                         return True
 
     def credits(self):
@@ -331,17 +381,13 @@ class Repetition:
 
 
 def abbreviate(grouping, i, in_a_row, difference):
-    """Given a Grouping, and a timedelta, modify each row and..."""
+    """Given a Grouping, and a timedelta, replace the trips before trip i (except the first and last of the run)
+    with a Repetition - before any times are put in the rows, so the trips' cells needn't be made at all
+    """
     seconds = difference.total_seconds()
     if not seconds or (seconds != 3600 and seconds > 1800):  # neither hourly nor more than every 30 minutes
         return
-    repetition = Repetition(in_a_row + 1, difference)
-    grouping.rows[0].times[i - in_a_row - 2] = repetition
-    for j in range(i - in_a_row - 1, i - 1):
-        grouping.rows[0].times[j] = None
-    for j in range(i - in_a_row - 2, i - 1):
-        for row in grouping.rows[1:]:
-            row.times[j] = None
+    grouping.repetitions[i - in_a_row - 2] = Repetition(in_a_row + 1, difference)
 
 
 def journey_patterns_match(trip_a, trip_b):
@@ -360,6 +406,18 @@ class Grouping:
         self.trips = []
         self.inbound = inbound
         self.column_feet = {}
+        self.repetitions = {}  # index of the first trip replaced by each Repetition
+
+    def __getstate__(self):
+        """For caching - leave out the trips' stop times and notes, which are in the rows and feet already"""
+        state = self.__dict__.copy()
+        state['trips'] = []
+        for trip in self.trips:
+            trip = copy.copy(trip)
+            trip.__dict__.pop('stop_times', None)
+            trip.__dict__.pop('_prefetched_objects_cache', None)
+            state['trips'].append(trip)
+        return state
 
     def __str__(self):
         if self.inbound:
@@ -385,66 +443,89 @@ class Grouping:
     def min_height(self):
         return sum(2 if row.has_waittimes else 1 for row in self.rows if not row.is_minor())
 
-    def handle_trip(self, trip):
+    def merge_pattern(self, stop_times):
+        """Align a sequence of stop times with the existing rows, inserting rows for any new stops.
+        Returns the row for each stop time
+        """
         rows = self.rows
-        if rows:
-            x = len(rows[0].times)  # number of existing columns
-        else:
-            x = 0
         previous_list = [row.stop.atco_code for row in rows]
-        current_list = [stoptime.get_key() for stoptime in trip.stoptime_set.all()]
+        current_list = [stoptime.get_key() for stoptime in stop_times]
         diff = differ.compare(previous_list, current_list)
 
+        pattern_rows = []
         y = 0  # how many rows along we are
-        first = True
 
-        for stoptime in trip.stoptime_set.all():
+        for stoptime in stop_times:
             key = stoptime.get_key()
 
-            if y < len(rows):
-                existing_row = rows[y]
-            else:
-                existing_row = None
-
             instruction = next(diff)
 
             while instruction[0] in '-?':
                 if instruction[0] == '-':
                     y += 1
-                    if y < len(rows):
-                        existing_row = rows[y]
-                    else:
-                        existing_row = None
                 instruction = next(diff)
 
             assert instruction[2:] == key
 
             if instruction[0] == '+':
-                row = Row(Stop(key), [''] * x)
+                row = Row(Stop(key))
                 row.timing_status = stoptime.timing_status
-                if not existing_row:
-                    rows.append(row)
-                else:
-                    rows = self.rows = rows[:y] + [row] + rows[y:]
+                rows.insert(y, row)
             else:
-                row = existing_row
-                assert instruction[2:] == existing_row.stop.atco_code
+                row = rows[y]
+                assert instruction[2:] == row.stop.atco_code
 
-            cell = Cell(stoptime, stoptime.arrival, stoptime.departure)
-            if first:
-                cell.first = True
-                first = False
-            row.times.append(cell)
+            pattern_rows.append(row)
 
             y += 1
 
-        if not first:  # (there was at least 1 stoptime in the trip)
-            cell.last = True
+        return pattern_rows
+
+    def build_rows(self):
+        """Collapse the trips into distinct sequences of stops, and merge each sequence into the rows just once.
+        Returns the rows for each trip (see fill_rows)
+        """
+        patterns = {}
+        trips_rows = []
+        for trip in self.trips:
+            pattern = tuple(stoptime.get_key() for stoptime in trip.stop_times)
+            if pattern not in patterns:
+                patterns[pattern] = self.merge_pattern(trip.stop_times)
+            trips_rows.append(patterns[pattern])
+        return trips_rows
+
+    def fill_rows(self, trips_rows):
+        """Put each trip's times in the rows for its sequence of stops -
+        except for trips replaced by a Repetition, which goes in the first row instead
+        """
+        columns = []  # trip indices, and Repetitions
+        x = 0
+        while x < len(self.trips):
+            if x in self.repetitions:
+                columns.append(self.repetitions[x])
+                x += self.repetitions[x].colspan
+            else:
+                columns.append(x)
+                x += 1
+        trip_indices = [column for column in columns if type(column) is int]
 
-        if x:
-            for row in rows:
-                if len(row.times) == x:
-                    row.times.append('')
+        for row in self.rows:
+            row.times = [''] * len(trip_indices)
+
+        for i, x in enumerate(trip_indices):
+            cells = [
+                Cell(stoptime, stoptime.arrival, stoptime.departure) for stoptime in self.trips[x].stop_times
+            ]
+            if cells:
+                cells[0].first = True
+                cells[-1].last = True
+            for row, cell in zip(trips_rows[x], cells):
+                row.times[i] = cell
+
+        if self.repetitions and self.rows:
+            # (spanning all the rows)
+            times = iter(self.rows[0].times)
+            self.rows[0].times = [column if type(column) is Repetition else next(times) for column in columns]
 
     def do_heads_and_feet(self, detailed=False):
         if not self.trips:
@@ -529,11 +610,6 @@ class Grouping:
         if in_a_row > 1:
             abbreviate(self, len(self.trips), in_a_row - 1, prev_difference)
 
-        for row in self.rows:
-            # remove 'None' cells created during the abbreviation process
-            # (actual empty cells will contain an empty string '')
-            row.times = [time for time in row.times if time is not None]
-
     def apply_stops(self, stops):
         for row in self.rows:
             row.stop = stops.get(row.stop.atco_code, row.stop)
@@ -595,6 +671,7 @@ class Cell:
         self.first = False
         self.last = False
         self.stoptime = stoptime
+        self.pick_up = stoptime.pick_up
         self.arrival = arrival
         self.departure = departure
         if arrival is None:
@@ -603,6 +680,12 @@ class Cell:
             self.departure = arrival
         self.wait_time = arrival and departure and departure - arrival
 
+    def __getstate__(self):
+        """For caching - leave out the StopTime"""
+        state = self.__dict__.copy()
+        del state['stoptime']
+        return state
+
     def __repr__(self):
         return format_timedelta(self.arrival)
 
@@ -611,5 +694,5 @@ class Cell:
 
     def set_down_only(self):
         if not self.last:
-            if not self.stoptime.pick_up:
+            if not self.pick_up:
                 return True
@@ -1,8 +1,10 @@
 import os
+import hashlib
 import requests
 import datetime
-from pytz.exceptions import AmbiguousTimeError
-from django.utils.timezone import utc, make_aware
+from functools import lru_cache
+from pytz.exceptions import AmbiguousTimeError, NonExistentTimeError
+from django.utils.timezone import utc, make_aware, get_current_timezone
 from django.utils.http import http_date, parse_http_date
 
 
@@ -12,6 +14,18 @@ def write_file(path, response):
             open_file.write(chunk)
 
 
+def get_sha1(open_file):
+    """Given a file opened in binary mode, returns the hex digest of its contents' SHA-1 hash"""
+    sha1 = hashlib.sha1()
+    while True:
+        data = open_file.read(65536)
+        if data:
+            sha1.update(data)
+        else:
+            break
+    return sha1.hexdigest()
+
+
 def download(path, url):
     response = requests.get(url, stream=True)
     write_file(path, response)
@@ -50,8 +64,13 @@ def download_if_changed(path, url, params=None):
     return modified, last_modified
 
 
+@lru_cache(maxsize=4096)
 def format_timedelta(timedelta):
     if timedelta is not None:
+        seconds = int(timedelta.total_seconds())
+        if 0 <= seconds < 172800:
+            # less than 2 days - 25:30 is shown as 01:30
+            return f'{seconds // 3600 % 24:02}:{seconds % 3600 // 60:02}'
         timedelta = str(timedelta)[:-3]
         timedelta = timedelta.replace('1 day, ', '', 1)
         if len(timedelta) == 4:
@@ -59,13 +78,33 @@ def format_timedelta(timedelta):
         return timedelta
 
 
+@lru_cache(maxsize=64)
+def get_midnight(date, timezone):
+    """The start of a date in a time zone -
+    or None if the clocks change on that date (so the UTC offset isn't the same all day)
+    """
+    try:
+        midnight = make_aware(datetime.datetime.combine(date, datetime.time()), timezone)
+        next_midnight = make_aware(datetime.datetime.combine(date + datetime.timedelta(1), datetime.time()), timezone)
+    except (AmbiguousTimeError, NonExistentTimeError):
+        return
+    if midnight.utcoffset() == next_midnight.utcoffset():
+        return midnight
+
+
 def time_datetime(time, date):
-    seconds = time.total_seconds()
-    while seconds >= 86400:
-        date += datetime.timedelta(1)
-        seconds -= 86400
-    time = datetime.time(int(seconds / 3600), int(seconds % 3600 / 60), int(seconds % 60))
-    combined = datetime.datetime.combine(date, time)
+    days, seconds = divmod(int(time.total_seconds()), 86400)
+    if days:
+        date += datetime.timedelta(days)
+    hour = seconds // 3600
+    minute = seconds % 3600 // 60
+    second = seconds % 60
+
+    midnight = get_midnight(date, get_current_timezone())
+    if midnight:
+        return midnight.replace(hour=hour, minute=minute, second=second)
+
+    combined = datetime.datetime.combine(date, datetime.time(hour, minute, second))
     try:
         return make_aware(combined)
     except AmbiguousTimeError:
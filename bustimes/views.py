@@ -7,7 +7,7 @@ from ciso8601 import parse_datetime
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db.models import Prefetch, Exists, OuterRef
+from django.db.models import Prefetch, Exists, OuterRef, prefetch_related_objects
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.shortcuts import get_object_or_404, render
@@ -18,7 +18,7 @@ from rest_framework.renderers import JSONRenderer
 
 from api.serializers import TripSerializer
 from busstops.models import Service, DataSource, StopPoint, StopUsage
-from departures.live import TimetableDepartures
+from departures.live import TimetableDepartures, get_routes_with_timing_patterns
 from vehicles.models import Vehicle
 from .models import Route, Trip
 
@@ -151,29 +151,17 @@ def stop_times_json(request, atco_code):
     except ValueError:
         return HttpResponseBadRequest("'limit' isn't in the right format (an integer or nothing)")
 
-    routes = {}
-    for route in Route.objects.filter(service__in=services).select_related('source'):
-        if route.service_id in routes:
-            routes[route.service_id].append(route)
-        else:
-            routes[route.service_id] = [route]
+    routes = get_routes_with_timing_patterns(services)
 
     departures = TimetableDepartures(stop, services, None, routes)
     time_since_midnight = timedelta(hours=when.hour, minutes=when.minute, seconds=when.second,
                                     microseconds=when.microsecond)
 
-    # any journeys that started yesterday
-    yesterday_date = (when - timedelta(1)).date()
-    yesterday_time = time_since_midnight + timedelta(1)
-    stop_times = departures.get_times(yesterday_date, yesterday_time)
-
-    for stop_time in stop_times.prefetch_related("trip__route__service__operator")[:limit]:
-        times.append(stop_time_json(stop_time, yesterday_date))
-
-    # journeys that started today
-    stop_times = departures.get_times(when.date(), time_since_midnight)
-    for stop_time in stop_times.prefetch_related("trip__route__service__operator")[:limit]:
-        times.append(stop_time_json(stop_time, when.date()))
+    # journeys that started today - or yesterday, for ones that get here after midnight
+    stop_times = departures.get_times(when.date(), time_since_midnight, days=0, limit=limit)
+    prefetch_related_objects([stop_time.trip for stop_time, _ in stop_times], "route__service__operator")
+    for stop_time, date in stop_times:
+        times.append(stop_time_json(stop_time, date))
 
     return JsonResponse({
         "times": times
@@ -182,9 +170,14 @@ def stop_times_json(request, atco_code):
 
 @require_GET
 def trip_json(request, id):
-    trip = get_object_or_404(Trip, id=id)
+    trip = get_object_or_404(
+        Trip.objects.prefetch_related(
+            'stoptime_set__stop__locality', 'timing_pattern__timingpatternstop_set__stop__locality'
+        ),
+        id=id
+    )
     times = []
-    for stop_time in trip.stoptime_set.select_related('stop__locality'):
+    for stop_time in trip.stop_times:
         stop = {}
         if stop_time.stop:
             stop['atco_code'] = stop_time.stop_id
@@ -205,12 +198,14 @@ def trip_json(request, id):
 
 class TripDetailView(DetailView):
     model = Trip
-    queryset = model.objects.select_related('route__service').prefetch_related('stoptime_set__stop__locality')
+    queryset = model.objects.select_related('route__service').prefetch_related(
+        'stoptime_set__stop__locality', 'timing_pattern__timingpatternstop_set__stop__locality'
+    )
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        context['stops'] = self.object.stoptime_set.all()
+        context['stops'] = self.object.stop_times
 
         trip_serializer = TripSerializer(self.object)
         stops_json = JSONRenderer().render(trip_serializer.data)
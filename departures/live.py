@@ -1,26 +1,55 @@
 """Various ways of getting live departures from some web service"""
 import ciso8601
 import datetime
+import heapq
+from array import array
+from bisect import bisect_left
+from itertools import islice, repeat
 import requests
 import pytz
 import logging
 import xmltodict
 import xml.etree.cElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic, sleep
 from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Exists, F, OuterRef
 from django.utils import timezone
-from busstops.models import Service, SIRISource
-from bustimes.models import get_calendars, get_routes, Route, StopTime
+from busstops.models import Service, SIRISource, StopPoint
+from bustimes.models import get_calendars, compile_calendars, Calendar, Route, StopTime, TimingPattern, Trip
 from vehicles.tasks import log_vehicle_journey
 
 
 logger = logging.getLogger(__name__)
 LOCAL_TIMEZONE = pytz.timezone('Europe/London')
+# how long a stop page will wait for all its live departures sources, in seconds
+LIVE_DEPARTURES_TIMEOUT = 5
+# (connect, read) timeouts for each upstream request, in seconds - less than LIVE_DEPARTURES_TIMEOUT,
+# so a fetch that's been given up on doesn't keep an executor thread for long
+REQUEST_TIMEOUT = (1, 3)
+# the most stops get_siri_departures is asked about at once (so the most sources it fetches from at once)
+MAX_STOPS = 10
+# shared, so connections to each upstream host are kept alive between requests
+session = requests.Session()
+# (each gunicorn worker serves one request at a time) enough threads for the most fetches one request makes,
+# plus as many again still running after an earlier request gave up on them
+executor = ThreadPoolExecutor(max_workers=MAX_STOPS * 2)
+
+
+def increment_counter(key):
+    """Count something (like live departures cache hits), in the cache - see get_departures"""
+    key = f'counter:{key}'
+    try:
+        cache.incr(key)
+    except ValueError:  # the counter doesn't exist yet
+        cache.set(key, 1, None)
 
 
 class Departures:
     """Abstract class for getting departures from a source"""
     request_url = None
+    cache_timeout = 10  # seconds
 
     def __init__(self, stop, services, now=None):
         self.stop = stop
@@ -69,11 +98,11 @@ class Departures:
         return {
             'params': self.get_request_params(),
             'headers': self.get_request_headers(),
-            'timeout': 5
+            'timeout': REQUEST_TIMEOUT
         }
 
     def get_response(self):
-        return requests.get(self.get_request_url(), **self.get_request_kwargs())
+        return session.get(self.get_request_url(), **self.get_request_kwargs())
 
     def get_service(self, line_name):
         """Given a line name string, returns the Service matching a line name
@@ -119,9 +148,64 @@ class Departures:
         if key:
             return cache.set(key, True, age)
 
+    def get_cache_key(self):
+        return f'{self.get_request_url()}:{self.stop.pk}:departures'
+
+    def get_cached_departures(self):
+        """(departures,) if they're in the cache (see get_departures), or None"""
+        cached = cache.get(self.get_cache_key())
+        if cached is not None:
+            increment_counter(f'{type(self).__name__}:hits')
+        return cached
+
+    def start_fetching(self):
+        """Whether to fetch the departures - False if another request (in any worker) is already fetching them"""
+        return cache.add(f'{self.get_cache_key()}:lock', True, LIVE_DEPARTURES_TIMEOUT * 2)
+
+    def fetch_and_cache_departures(self):
+        """Fetch the departures (after start_fetching), and cache them for cache_timeout seconds"""
+        key = self.get_cache_key()
+        try:
+            departures = self.fetch_departures()
+            cache.set(key, (departures,), self.cache_timeout)
+        finally:
+            cache.delete(f'{key}:lock')
+        increment_counter(f'{type(self).__name__}:misses')
+        return departures
+
+    def wait_for_departures(self, deadline):
+        """Wait (until a monotonic() time) for another request that's fetching the departures to cache them"""
+        key = self.get_cache_key()
+        while monotonic() < deadline:
+            sleep(0.05)
+            cached = cache.get(key)
+            if cached is not None:
+                increment_counter(f'{type(self).__name__}:coalesced')
+                return cached[0]
+
     def get_departures(self):
+        """Live departures, shared between simultaneous requests (in any worker) for the same stop and source,
+        and cached for cache_timeout seconds
+        """
+        cached = self.get_cached_departures()
+        if cached is not None:
+            return cached[0]
+
+        if self.start_fetching():
+            return self.fetch_and_cache_departures()
+
+        # another request is already fetching the same departures - wait for it to finish
+        return self.wait_for_departures(monotonic() + LIVE_DEPARTURES_TIMEOUT)
+
+    def fetch_departures(self):
+        response = self.fetch_response()
+        if response is not None:
+            return self.departures_from_response(response)
+
+    def fetch_response(self, *args):
+        """Call get_response, returning None (and backing off for a while) if it goes wrong"""
         try:
-            response = self.get_response()
+            response = self.get_response(*args)
         except requests.exceptions.ReadTimeout:
             self.set_poorly(60)  # back off for 1 minute
             return
@@ -130,12 +214,14 @@ class Departures:
             logger.error(e, exc_info=True)
             return
         if response.ok:
-            return self.departures_from_response(response)
+            return response
         self.set_poorly(1800)  # back off for 30 minutes
 
 
 class TflDepartures(Departures):
     """Departures from the Transport for London API"""
+    cache_timeout = 20
+
     @staticmethod
     def get_request_params():
         return settings.TFL
@@ -243,7 +329,7 @@ class AcisHorizonDepartures(Departures):
                 </s:Body>
             </s:Envelope>
         """.format(self.stop.pk)
-        return requests.post(self.request_url, headers=self.headers, data=data, timeout=2)
+        return session.post(self.request_url, headers=self.headers, data=data, timeout=2)
 
     def departures_from_response(self, res):
         items = ET.fromstring(res.text)
@@ -267,6 +353,120 @@ class AcisHorizonDepartures(Departures):
             return row
 
 
+def get_seconds(duration):
+    if duration is None:
+        return -1
+    return int(duration.total_seconds())
+
+
+def get_duration(seconds):
+    if seconds != -1:
+        return datetime.timedelta(seconds=seconds)
+
+
+class DepartureIndex:
+    """All the departures from a stop, from any of its services' routes on any day, in compact arrays -
+    ordered like ORDER BY departure (nulls last), so the next departures after a time can be found by bisection.
+    Built in a few queries, then cached for each stop (see TimetableDepartures.get_index)
+    """
+    def __init__(self, rows, calendars, destinations):
+        # each row is (StopTime id - or 0 for a trip that uses a TimingPattern, arrival seconds, departure seconds,
+        # trip id, trip start seconds, calendar id, route id, destination atco code) - where -1 seconds means null
+        rows.sort(key=lambda row: (row[2] == -1, row[2]))
+        self.ids = array('q', (row[0] for row in rows))
+        self.arrivals = array('i', (row[1] for row in rows))
+        self.departures = array('i', (row[2] for row in rows))
+        self.trips = array('q', (row[3] for row in rows))
+        self.starts = array('i', (row[4] for row in rows))
+        self.calendars = array('q', (row[5] for row in rows))
+        self.routes = array('q', (row[6] for row in rows))
+        self.destination_stops = list(destinations.values())
+        destinations = {atco_code: i for i, atco_code in enumerate(destinations)}
+        self.destinations = array('i', (destinations.get(row[7], -1) for row in rows))
+        # the number of departures with a departure time (the rest are arrivals only)
+        self.timed = sum(1 for row in rows if row[2] != -1)
+        # {calendar id: (start_date, end_date, operating_days_start, operating_days)}
+        self.calendar_days = calendars
+
+    @classmethod
+    def build(cls, stop, route_ids, timing_patterns):
+        rows = [
+            (id, get_seconds(arrival), get_seconds(departure), trip_id, get_seconds(start), calendar_id, route_id,
+             destination_id)
+            for id, arrival, departure, trip_id, start, calendar_id, route_id, destination_id
+            in StopTime.objects.filter(
+                pick_up=True, stop_id=stop, trip__route__in=route_ids, trip__calendar__isnull=False
+            ).values_list(
+                'id', 'arrival', 'departure', 'trip', 'trip__start', 'trip__calendar', 'trip__route',
+                'trip__destination'
+            ).order_by('id')
+        ]
+        if timing_patterns:
+            rows += [
+                (0, get_seconds(arrival), get_seconds(departure), trip_id, get_seconds(start), calendar_id, route_id,
+                 destination_id)
+                for arrival, departure, trip_id, start, calendar_id, route_id, destination_id
+                in Trip.objects.filter(
+                    timing_pattern__timingpatternstop__stop_id=stop, timing_pattern__timingpatternstop__pick_up=True,
+                    route__in=route_ids, calendar__isnull=False
+                ).annotate(
+                    stop_arrival=F('start') + F('timing_pattern__timingpatternstop__arrival'),
+                    stop_departure=F('start') + F('timing_pattern__timingpatternstop__departure'),
+                ).values_list(
+                    'stop_arrival', 'stop_departure', 'id', 'start', 'calendar', 'route', 'destination'
+                ).order_by('id')
+            ]
+
+        calendars = list(Calendar.objects.filter(id__in={row[5] for row in rows}))
+        # work out the operating_days of any calendars that haven't been compiled yet, without saving them
+        compile_calendars([calendar for calendar in calendars if not calendar.operating_days_start], save=False)
+        calendars = {
+            calendar.id: (
+                calendar.start_date, calendar.end_date, calendar.operating_days_start, calendar.operating_days
+            ) for calendar in calendars
+        }
+
+        destinations = StopPoint.objects.filter(
+            atco_code__in={row[7] for row in rows if row[7]}
+        ).select_related('locality').defer('latlong', 'locality__latlong', 'locality__search_vector')
+        destinations = {destination.atco_code: destination for destination in destinations}
+
+        return cls(rows, calendars, destinations)
+
+    def get_calendars(self, date):
+        """Whether each calendar operates on a date - or None if its operating_days don't say"""
+        calendars = {}
+        for calendar_id, (start_date, end_date, operating_days_start, operating_days) in self.calendar_days.items():
+            if date < start_date or end_date and date > end_date:
+                calendars[calendar_id] = False
+            else:
+                i = (date - operating_days_start).days
+                if 0 <= i < len(operating_days):
+                    calendars[calendar_id] = operating_days[i] == '1'
+                else:
+                    calendars[calendar_id] = None
+        return calendars
+
+    def get_time(self, i):
+        """The departure (or arrival, if there's no departure) seconds at a position in the index"""
+        if self.departures[i] != -1:
+            return self.departures[i]
+        return self.arrivals[i]
+
+    def get_stop_time(self, i, stop, routes):
+        """An (unsaved) StopTime and Trip, given a position in the index and a dict of Routes by id"""
+        destination = self.destinations[i]
+        trip = Trip(
+            id=self.trips[i], start=get_duration(self.starts[i]), route=routes[self.routes[i]],
+            destination=self.destination_stops[destination] if destination != -1 else None,
+            calendar_id=self.calendars[i]
+        )
+        return StopTime(
+            id=self.ids[i] or None, trip=trip, stop_id=stop,
+            arrival=get_duration(self.arrivals[i]), departure=get_duration(self.departures[i])
+        )
+
+
 class TimetableDepartures(Departures):
     def get_row(self, stop_time, date):
         trip = stop_time.trip
@@ -297,41 +497,124 @@ class TimetableDepartures(Departures):
             'link': trip.get_absolute_url()
         }
 
-    def get_times(self, date, time=None):
-        times = get_stop_times(date, time, self.stop.atco_code, self.routes)
-        times = times.select_related('trip__route__service', 'trip__destination__locality')
-        times = times.defer('trip__route__service__geometry', 'trip__route__service__search_vector',
-                            'trip__destination__locality__latlong', 'trip__destination__locality__search_vector')
-        return times.order_by('departure')
-
-    def get_departures(self):
-        time_since_midnight = datetime.timedelta(hours=self.now.hour, minutes=self.now.minute)
-        date = self.now.date()
+    def get_index(self):
+        """The stop's DepartureIndex - from the cache if possible, until any of its services' timetables change"""
+        if self.index is None:
+            versions = Service.get_timetable_versions(sorted(self.routes))
+            versions = ','.join(f'{service_id}:{version}' for service_id, version in versions.items())
+            key = f'{self.stop.atco_code}departures{versions}'
+            self.index = cache.get(key)
+            if self.index is None:
+                self.index = DepartureIndex.build(self.stop.atco_code, list(self.routes_by_id), self.timing_patterns)
+                cache.set(key, self.index, 86400)
+        return self.index
+
+    def get_calendars(self, date):
+        """Whether each of the DepartureIndex's calendars operates on a date -
+        asking the database about any calendars whose operating_days don't say
+        """
+        calendars = self.get_index().get_calendars(date)
+        unknown_calendars = [calendar_id for calendar_id, operates in calendars.items() if operates is None]
+        if unknown_calendars:
+            operating_calendars = set(get_calendars(date, unknown_calendars).values_list('id', flat=True))
+            for calendar_id in unknown_calendars:
+                calendars[calendar_id] = calendar_id in operating_calendars
+        return calendars
+
+    def get_day_positions(self, date, time=None):
+        """Positions in the DepartureIndex of journeys that start on a date
+        (and leave here at or after a time, if given), ordered like ORDER BY departure - nulls last
+        """
+        index = self.get_index()
+        if time is not None:
+            start = bisect_left(index.departures, time.total_seconds(), 0, index.timed)
+            end = index.timed
+        else:
+            start = 0
+            end = len(index.departures)
+
+        # (the cached index may be older than self.routes - ignore any routes deleted since)
+        route_ids = set(get_current_route_ids(date, self.routes)) & self.routes_by_id.keys()
+        calendars = None
+        for i in range(start, end):
+            if index.routes[i] in route_ids:
+                if calendars is None:
+                    calendars = self.get_calendars(date)
+                if calendars.get(index.calendars[i]):
+                    yield i
+
+    def get_positions(self, date, time, days=3):
+        """(DepartureIndex position, date the journey started) pairs for a continuous window of departures, in order -
+        from a time on a date (including journeys that started the day before and leave here after midnight),
+        until the end of a number of following days
+        """
+        if not self.routes:
+            return
+        index = self.get_index()
         one_day = datetime.timedelta(1)
-        yesterday_date = (self.now - one_day).date()
-        yesterday_time = time_since_midnight + one_day
-
-        times = [
-            self.get_row(stop_time, yesterday_date) for stop_time in
-            self.get_times(yesterday_date, yesterday_time)[:10]
-        ] + [
-            self.get_row(stop_time, date) for stop_time in
-            self.get_times(date, time_since_midnight)[:10]
+        yesterday = date - one_day
+        positions = [
+            zip(self.get_day_positions(yesterday, time + one_day), repeat(yesterday)),
+            zip(self.get_day_positions(date, time), repeat(date)),
         ]
-        i = 0
-        while len(times) < 10 and i < 3:
-            i += 1
+        for _ in range(days):
             date += one_day
-            times += [
-                self.get_row(stop_time, date) for stop_time in
-                self.get_times(date)[:10-len(times)]
-            ]
+            positions.append(zip(self.get_day_positions(date), repeat(date)))
+        yield from heapq.merge(
+            *positions, key=lambda position: index.get_time(position[0]) + (position[1] - yesterday).days * 86400
+        )
+
+    def get_times(self, date, time, days=3, limit=10):
+        """
+        Up to limit (StopTime, date the journey started) pairs, from get_positions -
+        including (unsaved) StopTimes for trips that use a shared TimingPattern
+        """
+        return [
+            (self.index.get_stop_time(i, self.stop.atco_code, self.routes_by_id), date)
+            for i, date in islice(self.get_positions(date, time, days), limit)
+        ]
+
+    def get_departures(self, since=None):
+        """Up to 10 rows (see get_row) for departures from now (self.now) until the end of 3 days' time.
+        If since (an earlier datetime) is given, start looking from then instead -
+        and set recently_due if anything was due between then and now
+        """
+        date = self.now.date()
+        time = datetime.timedelta(hours=self.now.hour, minutes=self.now.minute).total_seconds()
+        start = since or self.now
+        start_date = start.date()
+        start_time = datetime.timedelta(hours=start.hour, minutes=start.minute)
+
+        times = []
+        for i, service_date in self.get_positions(start_date, start_time, 3 + (date - start_date).days):
+            if self.index.get_time(i) + (service_date - date).days * 86400 < time:
+                self.recently_due = True
+                continue
+            stop_time = self.index.get_stop_time(i, self.stop.atco_code, self.routes_by_id)
+            times.append(self.get_row(stop_time, service_date))
+            if len(times) == 10:
+                break
         return times
 
     def __init__(self, stop, services, now, routes):
         self.routes = routes
+        # if the routes have been annotated using get_routes_with_timing_patterns, only query TimingPatterns if needed
+        self.timing_patterns = any(
+            getattr(route, 'has_timing_patterns', True)
+            for service_routes in routes.values() for route in service_routes
+        )
+        self.index = None
+        self.recently_due = False
         super().__init__(stop, services, now)
 
+        services_by_id = {service.id: service for service in self.services}
+        self.routes_by_id = {}
+        for service_routes in routes.values():
+            for route in service_routes:
+                if route.service_id in services_by_id:
+                    route.service = services_by_id[route.service_id]
+                self.routes_by_id[route.id] = route
+
 
 def parse_datetime(string):
     return ciso8601.parse_datetime(string).astimezone(LOCAL_TIMEZONE)
@@ -342,11 +625,15 @@ class SiriSmDepartures(Departures):
         's': 'http://www.siri.org.uk/siri'
     }
     data_source = None
+    cache_timeout = 20  # some sources are easily overwhelmed (see get_poorly)
 
     def __init__(self, source, stop, services):
         self.source = source
         super().__init__(stop, services)
 
+    def get_request_url(self):
+        return self.source.url
+
     def get_row(self, item):
         journey = item['MonitoredVehicleJourney']
 
@@ -374,39 +661,86 @@ class SiriSmDepartures(Departures):
     def get_poorly_key(self):
         return self.source.get_poorly_key()
 
-    def departures_from_response(self, response):
+    def get_stop_visits(self, response):
+        """MonitoredStopVisit dicts from a response (which may have a StopMonitoringDelivery for each of several stops),
+        parsed in one streaming pass - or None if the source is poorly
+        """
         if not response.text or 'Client.AUTHENTICATION_FAILED' in response.text:
             cache.set(self.get_poorly_key(), True, 1800)  # back off for 30 minutes
             return
-        data = xmltodict.parse(response.text)
-        try:
-            data = data['Siri']['ServiceDelivery']['StopMonitoringDelivery']['MonitoredStopVisit']
-        except (KeyError, TypeError):
-            return
-        if type(data) is list:
-            return [self.get_row(item) for item in data]
-        return [self.get_row(data)]
 
-    def get_response(self):
+        visits = []
+
+        def handle_item(path, item):
+            # Siri/ServiceDelivery/StopMonitoringDelivery/MonitoredStopVisit
+            if path[-1][0] == 'MonitoredStopVisit':
+                visits.append(item)
+            return True  # carry on parsing (without keeping the item in the parsed document)
+
+        xmltodict.parse(response.text, item_depth=4, item_callback=handle_item)
+        return visits
+
+    def departures_from_response(self, response):
+        visits = self.get_stop_visits(response)
+        if visits is not None:
+            return [self.get_row(item) for item in visits]
+
+    def get_request_xml(self, stops):
         if self.source.requestor_ref:
             username = '<RequestorRef>{}</RequestorRef>'.format(self.source.requestor_ref)
         else:
             username = ''
         timestamp = '<RequestTimestamp>{}</RequestTimestamp>'.format(datetime.datetime.utcnow().isoformat())
-        request_xml = """
-            <Siri version="1.3" xmlns="http://www.siri.org.uk/siri">
-                <ServiceRequest>
-                    {}
-                    {}
+        requests_xml = ''.join("""
                     <StopMonitoringRequest version="1.3">
                         {}
                         <MonitoringRef>{}</MonitoringRef>
-                    </StopMonitoringRequest>
+                    </StopMonitoringRequest>""".format(timestamp, stop.atco_code) for stop in stops)
+        return """
+            <Siri version="1.3" xmlns="http://www.siri.org.uk/siri">
+                <ServiceRequest>
+                    {}
+                    {}{}
                 </ServiceRequest>
             </Siri>
-        """.format(timestamp, username, timestamp, self.stop.atco_code)
+        """.format(timestamp, username, requests_xml)
+
+    def get_response(self, stops=None):
+        request_xml = self.get_request_xml(stops or [self.stop])
         headers = {'Content-Type': 'application/xml'}
-        return requests.post(self.source.url, data=request_xml, headers=headers, timeout=5)
+        return session.post(self.source.url, data=request_xml, headers=headers, timeout=REQUEST_TIMEOUT)
+
+    def get_departures_for_stops(self, others):
+        """Like fetch_and_cache_departures (after start_fetching for each stop), but for this stop and some others
+        (SiriSmDepartures objects for the same source), in one request with a StopMonitoringRequest for each stop.
+        Returns a dict of {atco code: departures},
+        and caches each stop's departures where its own get_departures will find them
+        """
+        everyone = [self, *others]
+        try:
+            response = self.fetch_response([departures.stop for departures in everyone])
+            visits = None
+            if response is not None:
+                visits = self.get_stop_visits(response)
+
+            visits_by_stop = {}
+            for visit in visits or ():
+                visits_by_stop.setdefault(visit.get('MonitoringRef'), []).append(visit)
+
+            departures_by_stop = {}
+            for departures in everyone:
+                atco_code = departures.stop.atco_code
+                rows = None
+                if visits is not None:
+                    rows = [departures.get_row(visit) for visit in visits_by_stop.get(atco_code, ())]
+                cache.set(departures.get_cache_key(), (rows,), departures.cache_timeout)
+                departures_by_stop[atco_code] = rows
+        finally:
+            cache.delete_many([f'{departures.get_cache_key()}:lock' for departures in everyone])
+        increment_counter(f'{type(self).__name__}:batches')
+        for _ in everyone:
+            increment_counter(f'{type(self).__name__}:misses')
+        return departures_by_stop
 
 
 def services_match(a, b):
@@ -460,14 +794,113 @@ def blend(departures, live_rows, stop=None):
         departures.sort(key=get_departure_order)
 
 
-def get_stop_times(date: datetime.datetime, time: datetime.timedelta, stop, services_routes: dict):
-    times = StopTime.objects.filter(pick_up=True, stop_id=stop)
-    if time:
-        times = times.filter(departure__gte=time)
-    routes = []
-    for service_routes in services_routes.values():
-        routes += get_routes(service_routes, date)
-    return times.filter(trip__route__in=routes, trip__calendar__in=get_calendars(date))
+def get_current_route_ids(date: datetime.date, services_routes: dict):
+    """The ids of the services' current routes on a date - cached (see Service.get_current_route_ids), or worked out
+    from the routes already got by get_routes_with_timing_patterns
+    """
+    route_ids = Service.get_current_route_ids(services_routes, date, services_routes)
+    return [route_id for service_route_ids in route_ids.values() for route_id in service_route_ids]
+
+
+def get_routes_with_timing_patterns(services):
+    """Routes of some services, grouped by service id, annotated with whether they have any TimingPatterns"""
+    routes = {}
+    for route in Route.objects.filter(service__in=services).select_related('source').annotate(
+        has_timing_patterns=Exists(TimingPattern.objects.filter(route=OuterRef('pk')))
+    ):
+        if route.service_id in routes:
+            routes[route.service_id].append(route)
+        else:
+            routes[route.service_id] = [route]
+    return routes
+
+
+def get_live_departures(sources, timeout=LIVE_DEPARTURES_TIMEOUT):
+    """Given a list of Departures objects (or Nones), get their departures (like get_departures) at the same time -
+    returning a list of the results, in the same order.
+    The result is None for any source that hasn't finished after timeout seconds
+    (its fetch carries on in the background, so a timeout can still make it set_poorly).
+    Only the fetches use the executor's threads - waiting for other requests' fetches happens in this thread
+    """
+    deadline = monotonic() + timeout
+    results = [None] * len(sources)
+    futures = {}
+    waiting = []
+    for i, source in enumerate(sources):
+        if source:
+            cached = source.get_cached_departures()
+            if cached is not None:
+                results[i] = cached[0]
+            elif source.start_fetching():
+                futures[i] = executor.submit(source.fetch_and_cache_departures)
+            else:
+                waiting.append(i)
+
+    if futures:
+        done, _ = wait(futures.values(), timeout)
+        for i, future in futures.items():
+            if future in done:
+                results[i] = future.result()
+    for i in waiting:
+        results[i] = sources[i].wait_for_departures(deadline)
+
+    return results
+
+
+def get_siri_departures(stops, timeout=LIVE_DEPARTURES_TIMEOUT):
+    """Given a list of (StopPoint, services) pairs (up to MAX_STOPS), get live departures for them
+    from SIRI-SM sources (the first source that isn't poorly for each stop's admin area, as in get_departures).
+    Like get_live_departures, stops whose departures are cached (or being fetched by another request) don't need
+    fetching - the rest are fetched in one request per source, with the sources all at the same time.
+    Returns a dict of {atco code: departures} - without the stops that have no source.
+    The departures are None for any stop that hasn't finished after timeout seconds
+    """
+    deadline = monotonic() + timeout
+
+    admin_area_ids = {stop.admin_area_id for stop, _ in stops if stop.admin_area_id}
+    if not admin_area_ids:
+        return {}
+
+    sources_by_admin_area = {}
+    poorly = {}
+    for source in SIRISource.objects.filter(admin_areas__in=admin_area_ids).annotate(admin_area=F('admin_areas')):
+        if source.admin_area not in sources_by_admin_area:
+            if source.pk not in poorly:
+                poorly[source.pk] = source.get_poorly()
+            if not poorly[source.pk]:
+                sources_by_admin_area[source.admin_area] = source
+
+    departures_by_stop = {}
+    departures_by_source = {}
+    waiting = []
+    for stop, services in stops:
+        source = sources_by_admin_area.get(stop.admin_area_id)
+        if source:
+            departures = SiriSmDepartures(source, stop, services)
+            cached = departures.get_cached_departures()
+            if cached is not None:
+                departures_by_stop[stop.atco_code] = cached[0]
+            elif departures.start_fetching():
+                departures_by_source.setdefault(source.pk, []).append(departures)
+            else:
+                waiting.append(departures)
+
+    futures = [
+        executor.submit(departures[0].get_departures_for_stops, departures[1:])
+        for departures in departures_by_source.values()
+    ]
+    if futures:
+        done, _ = wait(futures, timeout)
+        for departures, future in zip(departures_by_source.values(), futures):
+            if future in done:
+                departures_by_stop.update(future.result())
+            else:
+                for stop_departures in departures:
+                    departures_by_stop[stop_departures.stop.atco_code] = None
+    for departures in waiting:
+        departures_by_stop[departures.stop.atco_code] = departures.wait_for_departures(deadline)
+
+    return departures_by_stop
 
 
 def get_departures(stop, services, when):
@@ -485,28 +918,24 @@ def get_departures(stop, services, when):
 
     now = timezone.localtime()
 
-    routes = {}
-    for route in Route.objects.filter(
-        service__in=[s for s in services if not s.timetable_wrong]
-    ).select_related('source'):
-        if route.service_id in routes:
-            routes[route.service_id].append(route)
-        else:
-            routes[route.service_id] = [route]
-
-    departures = TimetableDepartures(stop, services, when or now, routes).get_departures()
+    routes = get_routes_with_timing_patterns([s for s in services if not s.timetable_wrong])
 
     one_hour = datetime.timedelta(hours=1)
     one_hour_ago = now - one_hour
 
+    timetable_departures = TimetableDepartures(stop, services, when or now, routes)
+    if when:
+        departures = timetable_departures.get_departures()
+    else:
+        departures = timetable_departures.get_departures(since=one_hour_ago)
+
     if when:
         pass
-    elif not departures or ((departures[0]['time'] - now) < one_hour or get_stop_times(
-        one_hour_ago.date(),
-        datetime.timedelta(hours=one_hour_ago.hour, minutes=one_hour_ago.minute),
-        stop.atco_code,
-        routes
-    ).exists()):
+    elif not departures or (
+        (departures[0]['time'] - now) < one_hour
+        or timetable_departures.recently_due
+        or departures[0]['time'].date() == one_hour_ago.date()
+    ):
 
         operators = set()
         for service in services:
@@ -518,20 +947,18 @@ def get_departures(stop, services, when):
 
         # Belfast
         if stop.atco_code[0] == '7' and ('Translink Metro' in operators or 'Translink Glider' in operators):
-            live_rows = AcisHorizonDepartures(stop, services).get_departures()
+            live_rows, = get_live_departures([AcisHorizonDepartures(stop, services)])
             if live_rows:
                 blend(departures, live_rows)
         elif departures:
+            edinburgh_departures = None
             if (
                 'Lothian Buses' in operators
                 or 'Lothian Country Buses' in operators
                 or 'East Coast Buses' in operators
                 or 'Edinburgh Trams' in operators
             ):
-                live_rows = EdinburghDepartures(stop, services, now).get_departures()
-                if live_rows:
-                    departures = live_rows
-                    live_rows = None
+                edinburgh_departures = EdinburghDepartures(stop, services, now)
 
             source = None
 
@@ -541,10 +968,15 @@ def get_departures(stop, services, when):
                         source = possible_source
                         break
 
+            live_departures = None
             if source:
-                live_rows = SiriSmDepartures(source, stop, services).get_departures()
+                live_departures = SiriSmDepartures(source, stop, services)
             elif stop.atco_code[:3] == '430':
-                live_rows = WestMidlandsDepartures(stop, services).get_departures()
+                live_departures = WestMidlandsDepartures(stop, services)
+
+            edinburgh_rows, live_rows = get_live_departures([edinburgh_departures, live_departures])
+            if edinburgh_rows:
+                departures = edinburgh_rows
 
             if live_rows:
                 blend(departures, live_rows)
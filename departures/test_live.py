@@ -2,10 +2,13 @@
 """Tests for live departures
 """
 import vcr
+import time
+import threading
 import time_machine
 import datetime
 from unittest.mock import patch
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.shortcuts import render
 
 from busstops.models import StopPoint, Service, Region, Operator, StopUsage, AdminArea, DataSource, SIRISource
@@ -154,6 +157,223 @@ class LiveDeparturesTest(TestCase):
             departures = live.AcisHorizonDepartures(StopPoint(pk='700000000748'), ())
             self.assertEqual([], departures.get_departures())
 
+    def test_get_live_departures(self):
+        class FastDepartures(live.Departures):
+            request_url = 'http://example.com/fast'
+
+            def fetch_departures(self):
+                return [{'service': 'X98'}]
+
+        class SlowDepartures(live.Departures):
+            request_url = 'http://example.com/slow'
+
+            def fetch_departures(self):
+                time.sleep(0.5)
+                return [{'service': '44'}]
+
+        self.assertEqual(live.get_live_departures([
+            FastDepartures(self.worcester_stop, ()), None, SlowDepartures(self.worcester_stop, ())
+        ], timeout=0.1), [[{'service': 'X98'}], None, None])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_get_live_departures_coalescing(self):
+        cache.clear()
+
+        class WaitingDepartures(live.Departures):
+            request_url = 'http://example.com'
+
+            def fetch_departures(self):
+                raise AssertionError  # another request is fetching them
+
+        departures = WaitingDepartures(self.worcester_stop, ())
+        key = departures.get_cache_key()
+        cache.add(f'{key}:lock', True)
+
+        # waiting for the other request uses this thread, not one of the executor's
+        with patch.object(live.executor, 'submit') as submit:
+            self.assertEqual([None], live.get_live_departures([departures], timeout=0.1))
+            timer = threading.Timer(0.1, cache.set, (key, ([{'service': 'X98'}],)))
+            timer.start()
+            self.assertEqual([[{'service': 'X98'}]], live.get_live_departures([departures]))
+            timer.join()
+        submit.assert_not_called()
+        self.assertEqual(cache.get('counter:WaitingDepartures:coalesced'), 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_coalescing(self):
+        cache.clear()
+        fetches = []
+
+        class CountingDepartures(live.Departures):
+            request_url = 'http://example.com'
+
+            def fetch_departures(self):
+                fetches.append(self)
+                return [{'service': '44'}]
+
+        departures = CountingDepartures(self.worcester_stop, ())
+        self.assertEqual(departures.get_departures(), [{'service': '44'}])
+        self.assertEqual(departures.get_departures(), [{'service': '44'}])  # cached
+        self.assertEqual(1, len(fetches))
+
+        # another request is already fetching the departures, so wait for its result
+        key = departures.get_cache_key()
+        cache.delete(key)
+        cache.add(f'{key}:lock', True)
+        timer = threading.Timer(0.1, cache.set, (key, ([{'service': 'X98'}],)))
+        timer.start()
+        self.assertEqual(departures.get_departures(), [{'service': 'X98'}])
+        timer.join()
+        self.assertEqual(1, len(fetches))
+
+        self.assertEqual(cache.get('counter:CountingDepartures:misses'), 1)
+        self.assertEqual(cache.get('counter:CountingDepartures:hits'), 1)
+        self.assertEqual(cache.get('counter:CountingDepartures:coalesced'), 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_siri_departures_for_stops(self):
+        cache.clear()
+        evesham_stop = StopPoint.objects.create(
+            pk='2000G000400',
+            common_name='Bus Station',
+            locality_centre=False,
+            active=True,
+            admin_area_id=self.worcester_stop.admin_area_id
+        )
+        services = list(self.worcester_stop.service_set.all())
+
+        with time_machine.travel('Sat Feb 09 10:45:45 GMT 2019'):
+            with vcr.use_cassette('data/vcr/worcester_stops.yaml') as cassette:
+                with self.assertNumQueries(1):
+                    departures = live.get_siri_departures([
+                        (self.worcester_stop, services),
+                        (evesham_stop, []),
+                        (self.london_stop, [self.london_service]),  # no SIRI source
+                    ])
+
+                # one request for both stops
+                self.assertEqual(1, cassette.play_count)
+
+                # each stop's departures were cached, so getting them again doesn't make another request
+                siri_source = SIRISource.objects.get()
+                evesham_departures = live.SiriSmDepartures(siri_source, evesham_stop, [])
+                self.assertEqual(evesham_departures.get_departures(), departures['2000G000400'])
+
+        request_xml = evesham_departures.get_request_xml([self.worcester_stop, evesham_stop])
+        self.assertEqual(2, request_xml.count('<StopMonitoringRequest version="1.3">'))
+        self.assertIn('<MonitoringRef>2000G000106</MonitoringRef>', request_xml)
+        self.assertIn('<MonitoringRef>2000G000400</MonitoringRef>', request_xml)
+
+        self.assertEqual(['2000G000106', '2000G000400'], sorted(departures))
+
+        self.assertEqual(2, len(departures['2000G000106']))
+        self.assertEqual(services[0], departures['2000G000106'][0]['service'])
+        self.assertEqual('Sixth Form College', departures['2000G000106'][0]['destination'])
+        self.assertEqual('X50', departures['2000G000106'][1]['service'])
+
+        self.assertEqual(1, len(departures['2000G000400']))
+        self.assertEqual('WORCESTER Bus Stn', departures['2000G000400'][0]['destination'])
+        self.assertEqual(
+            departures['2000G000400'][0]['live'], datetime.datetime(2019, 2, 9, 11, 7, tzinfo=datetime.timezone.utc)
+        )
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_stops_departures_json(self):
+        cache.clear()
+        evesham_stop = StopPoint.objects.create(
+            pk='2000G000400',
+            common_name='Bus Station',
+            locality_centre=False,
+            active=True,
+            admin_area_id=self.worcester_stop.admin_area_id
+        )
+
+        self.assertEqual(400, self.client.get('/stops/departures.json').status_code)
+
+        with time_machine.travel('Sat Feb 09 10:45:45 GMT 2019'):
+            with vcr.use_cassette('data/vcr/worcester_stops.yaml') as cassette:
+                with self.assertNumQueries(3):
+                    response = self.client.get('/stops/departures.json?stops=2000G000106,2000G000400,490014721F')
+                self.assertEqual(1, cassette.play_count)
+
+                # both stops' departures were cached, so don't ask the source again
+                self.assertEqual(response.json(), self.client.get(
+                    '/stops/departures.json?stops=2000G000106,2000G000400'
+                ).json())
+                self.assertEqual(1, cassette.play_count)
+
+                # another request is already fetching one stop's departures, so wait for its result
+                evesham_departures = live.SiriSmDepartures(SIRISource.objects.get(), evesham_stop, [])
+                key = evesham_departures.get_cache_key()
+                cache.delete(key)
+                cache.add(f'{key}:lock', True)
+                timer = threading.Timer(0.1, cache.set, (key, ([],)))
+                timer.start()
+                coalesced_response = self.client.get('/stops/departures.json?stops=2000G000106,2000G000400')
+                timer.join()
+                self.assertEqual(1, cassette.play_count)
+
+        self.assertEqual([], coalesced_response.json()['2000G000400'])
+        self.assertEqual(cache.get('counter:SiriSmDepartures:batches'), 1)
+        self.assertEqual(cache.get('counter:SiriSmDepartures:misses'), 2)
+        self.assertEqual(cache.get('counter:SiriSmDepartures:hits'), 3)
+        self.assertEqual(cache.get('counter:SiriSmDepartures:coalesced'), 1)
+
+        data = response.json()
+        self.assertEqual(['2000G000106', '2000G000400'], sorted(data))
+        self.assertEqual({
+            'time': '2019-02-09T11:14:00Z',
+            'live': '2019-02-09T11:14:40Z',
+            'service': '44',
+            'destination': 'Sixth Form College'
+        }, data['2000G000106'][0])
+        self.assertEqual('X50', data['2000G000106'][1]['service'])
+        self.assertEqual('2019-02-09T11:07:00Z', data['2000G000400'][0]['live'])
+
+    def test_timetable_departures(self):
+        services = list(self.worcester_stop.service_set.all())
+        routes = live.get_routes_with_timing_patterns(services)
+        now = live.LOCAL_TIMEZONE.localize(datetime.datetime(2019, 2, 9, 10, 30))
+
+        departures = live.TimetableDepartures(self.worcester_stop, services, now, routes)
+        rows = departures.get_departures(since=now - datetime.timedelta(hours=1))
+        self.assertEqual(1, len(rows))
+        self.assertEqual('10:54', rows[0]['time'].strftime('%H:%M'))
+        self.assertFalse(departures.recently_due)
+
+        # an hour later, the 10:54 was recently due
+        departures = live.TimetableDepartures(self.worcester_stop, services, now + datetime.timedelta(hours=1), routes)
+        self.assertEqual([], departures.get_departures(since=now))
+        self.assertTrue(departures.recently_due)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_timetable_departures_deleted_route(self):
+        cache.clear()
+        route = Route.objects.create(service=self.trip.route.service, start_date='2017-03-04',
+                                     source=self.trip.route.source, code='44a')
+        trip = Trip.objects.create(calendar=self.trip.calendar, route=route, destination=self.worcester_stop,
+                                   start='0', end='11:30:00')
+        StopTime.objects.create(trip=trip, sequence=0, arrival='11:24:00', departure='11:24:00',
+                                stop_id=self.worcester_stop.pk)
+
+        services = list(self.worcester_stop.service_set.all())
+        now = live.LOCAL_TIMEZONE.localize(datetime.datetime(2019, 2, 9, 10, 30))
+
+        departures = live.TimetableDepartures(
+            self.worcester_stop, services, now, live.get_routes_with_timing_patterns(services)
+        )
+        self.assertEqual(2, len(departures.get_departures()))
+
+        # deleted without bumping the timetable version, so the cached index (and route ids) still include it
+        Route.objects.filter(id=route.id).delete()
+
+        departures = live.TimetableDepartures(
+            self.worcester_stop, services, now, live.get_routes_with_timing_patterns(services)
+        )
+        rows = departures.get_departures()
+        self.assertEqual(1, len(rows))
+        self.assertEqual(self.trip.route, rows[0]['route'])
+
     def test_blend(self):
         service = Service(line_name='X98')
         a = [{
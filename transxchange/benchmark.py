@@ -0,0 +1,109 @@
+"""Measure how long parsing some TransXChange files takes, and how much memory the parsed objects use,
+with each parser.
+
+    python -m transxchange.benchmark bustimes/management/tests/fixtures
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+
+def get_paths(paths):
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            yield from sorted(path.glob('**/*.xml'))
+        else:
+            yield path
+
+
+def measure(paths, iterate=True, parser=None):
+    """Parse each file, and (if iterate) work out the times of every journey, like the importer does.
+    Returns a dict of file paths to results - 'retained' is the memory still used by the TransXChange object
+    afterwards, 'peak' is the most used at any point while parsing
+    (not including memory allocated by lxml's C library, which tracemalloc doesn't see)
+    """
+    from .txc import DEFAULT_PARSER, TransXChange
+
+    if parser is None:
+        parser = DEFAULT_PARSER
+
+    results = {}
+
+    for path in get_paths(paths):
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        with path.open('rb') as open_file:
+            transxchange = TransXChange(open_file, parser)
+        cells = 0
+        if iterate:
+            for journey in transxchange.journeys:
+                for cell in journey.get_times():
+                    cells += 1
+
+        seconds = time.perf_counter() - start
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[str(path)] = {
+            'bytes': path.stat().st_size,
+            'journeys': len(transxchange.journeys),
+            'cells': cells,
+            'seconds': seconds,
+            'retained': retained,
+            'peak': peak,
+        }
+        del transxchange
+
+    return results
+
+
+def measure_throughput(paths, parser, repeat=3):
+    """Parse the files (without working out the times) repeat times, and return the best MB per second"""
+    from .txc import TransXChange
+
+    paths = list(get_paths(paths))
+    total_bytes = sum(path.stat().st_size for path in paths)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            with path.open('rb') as open_file:
+                TransXChange(open_file, parser)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return total_bytes / 1e6 / best
+
+
+def main(paths):
+    from .txc import PARSERS, lxml_etree
+
+    for parser in PARSERS:
+        if parser == 'lxml' and not lxml_etree:
+            continue
+        results = measure(paths, parser=parser)
+        for path, result in results.items():
+            print(
+                f"{parser} {path}: {result['journeys']} journeys, {result['cells']} stop times, "
+                f"{result['seconds']:.3f}s, {result['retained'] / 1024:.0f} KiB retained, "
+                f"{result['peak'] / 1024:.0f} KiB peak"
+            )
+        print(
+            f"{parser} total: {sum(result['seconds'] for result in results.values()):.3f}s, "
+            f"{max((result['peak'] for result in results.values()), default=0) / 1024:.0f} KiB peak, "
+            f"{measure_throughput(paths, parser):.2f} MB/s\n"
+        )
+
+
+if __name__ == '__main__':
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'buses.settings')
+    django.setup()
+
+    main(sys.argv[1:])
@@ -1,8 +1,16 @@
 """Tests for timetables and date ranges"""
 import xml.etree.cElementTree as ET
-from datetime import date
+from datetime import date, timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import skipUnless
+from django.contrib.gis.geos import LineString
 from django.test import TestCase
-from . import txc
+from . import benchmark, txc
+
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / 'bustimes' / 'management' / 'tests' / 'fixtures'
+NCSD_DIR = FIXTURES_DIR / 'NCSD_TXC'
 
 
 class DateRangeTest(TestCase):
@@ -58,3 +66,97 @@ class DateRangeTest(TestCase):
         """)
         operating_profile = txc.OperatingProfile(element, None)
         self.assertEqual(str(operating_profile.regular_days), '[Saturday, Sunday]')
+
+
+class RouteLinkTest(TestCase):
+    def test_get_linestring(self):
+        linestring = txc.get_linestring(['-1.5', '52.1', '-1.4', 52.2, -1.3, '52.3'])
+        self.assertEqual(linestring, LineString((-1.5, 52.1), (-1.4, 52.2), (-1.3, 52.3)))
+        self.assertIsNone(linestring.srid)
+
+        self.assertTrue(txc.get_linestring([]).empty)
+        with self.assertRaises(ValueError):
+            txc.get_linestring(['-1.5', '52.1'])
+        with self.assertRaises(ValueError):
+            txc.get_linestring(['-1.5', '52.1', '-1.4', 'nan'])
+
+    def test_missing_coordinates(self):
+        element = ET.fromstring("""
+            <RouteLink id="RL1">
+                <From><StopPointRef>1</StopPointRef></From>
+                <To><StopPointRef>2</StopPointRef></To>
+                <Track><Mapping>
+                    <Location><Longitude>-1.5</Longitude><Latitude>52.1</Latitude></Location>
+                    <Location><Latitude>52.2</Latitude></Location>
+                </Mapping></Track>
+            </RouteLink>
+        """)
+        with self.assertRaises(ValueError):
+            txc.RouteLink(element)
+
+
+class TransXChangeTest(TestCase):
+    def test_memory(self):
+        transxchange = txc.TransXChange(NCSD_DIR / 'Megabus_Megabus14032016 163144_MEGA_M12.xml')
+
+        journey = transxchange.journeys[0]
+        self.assertFalse(hasattr(journey, '__dict__'))
+        self.assertEqual(journey.departure_seconds, 3600)
+        self.assertEqual(journey.departure_time, timedelta(hours=1))
+
+        cells = list(journey.get_times())
+        self.assertFalse(hasattr(cells[0], '__dict__'))
+        self.assertEqual(cells[0].departure_time, timedelta(hours=1))
+
+        # journeys with equivalent operating profiles share one
+        operating_profiles = {journey.operating_profile.hash: journey.operating_profile
+                              for journey in transxchange.journeys}
+        for journey in transxchange.journeys:
+            self.assertIs(journey.operating_profile, operating_profiles[journey.operating_profile.hash])
+
+        results = benchmark.measure([NCSD_DIR])
+        self.assertEqual(len(results), 2)
+        for result in results.values():
+            self.assertGreater(result['cells'], result['journeys'])
+            self.assertLess(result['retained'], 512 * 1024)
+
+    @skipUnless(txc.lxml_etree, 'lxml is not installed')
+    def test_parsers(self):
+        def get_times(transxchange):
+            return [
+                [
+                    (cell.stopusage.stop.atco_code, cell.arrival_time, cell.departure_time)
+                    for cell in journey.get_times()
+                ] for journey in transxchange.journeys
+            ]
+
+        for path in (
+            FIXTURES_DIR / '904_FE_PF_904_20210102.xml',
+            FIXTURES_DIR / 'set_5-28-A-y08.xml',
+            NCSD_DIR / 'Megabus_Megabus14032016 163144_MEGA_M12.xml'
+        ):
+            with path.open('rb') as open_file:
+                etree = txc.TransXChange(open_file, 'etree')
+            with path.open('rb') as open_file:
+                lxml = txc.TransXChange(open_file, 'lxml')
+
+            self.assertEqual(etree.attributes, lxml.attributes)
+            self.assertEqual(etree.stops.keys(), lxml.stops.keys())
+            self.assertEqual(etree.routes.keys(), lxml.routes.keys())
+            self.assertEqual(etree.services.keys(), lxml.services.keys())
+            self.assertEqual(etree.garages.keys(), lxml.garages.keys())
+            self.assertEqual(
+                [operator.findtext('OperatorCode') for operator in etree.operators],
+                [operator.findtext('OperatorCode') for operator in lxml.operators]
+            )
+            self.assertEqual(get_times(etree), get_times(lxml))
+
+        # lxml can't read text, so falls back to ElementTree
+        with path.open() as open_file:
+            transxchange = txc.TransXChange(StringIO(open_file.read()), 'lxml')
+        self.assertEqual(get_times(transxchange), get_times(etree))
+
+        with self.assertRaises(txc.PARSE_ERRORS):
+            txc.TransXChange(StringIO('<TransXChange>'), 'etree')
+        with self.assertRaises(txc.PARSE_ERRORS):
+            txc.TransXChange(FIXTURES_DIR / 'IncludedServices.csv', 'lxml')
@@ -1,21 +1,66 @@
 import xml.etree.cElementTree as ET
 import calendar
 import datetime
+import io
 import logging
+import struct
+import numpy
+from functools import cache
 from django.contrib.gis.geos import GEOSGeometry, LineString
 from django.utils.dateparse import parse_duration
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 
 logger = logging.getLogger(__name__)
 
+NAMESPACE = '{http://www.transxchange.org.uk/}'
+
+# elements whose children are handled (and can be thrown away) one at a time
+SEQUENCE_TAGS = {
+    'StopPoints': ('StopPoint', 'AnnotatedStopPointRef'),
+    'RouteSections': ('RouteSection',),
+    'Routes': ('Route',),
+    'JourneyPatternSections': ('JourneyPatternSection',),
+    'VehicleJourneys': ('VehicleJourney', 'FlexibleVehicleJourney'),
+}
+# elements that are handled all at once
+TAGS = ('Operators', 'ServicedOrganisations', 'Service', 'Garages', 'TransXChange')
+# elements that are kept after parsing
+KEPT_TAGS = ('Operators', 'Garages')
+
+if lxml_etree:
+    PARSE_ERRORS = (ET.ParseError, lxml_etree.ParseError)
+else:
+    PARSE_ERRORS = (ET.ParseError,)
+
 
 WEEKDAYS = {day: i for i, day in enumerate(calendar.day_name)}  # {'Monday:' 0,
 
 
+@cache
+def get_timedelta(seconds):
+    """Time of day as a timedelta - only a few thousand distinct values, so they're shared"""
+    return datetime.timedelta(seconds=seconds)
+
+
+@cache
+def parse_seconds(duration):
+    """Given an ISO 8601 duration like 'PT1M30S', return a number of seconds (90)"""
+    duration = parse_duration(duration)
+    if duration is not None:
+        return int(duration.total_seconds())
+
+
 class Stop:
     """A TransXChange StopPoint."""
+    __slots__ = ('atco_code', 'common_name', 'locality')
+
     def __init__(self, element):
-        if element:
+        if len(element):
             self.atco_code = element.findtext('StopPointRef')
             if not self.atco_code:
                 self.atco_code = element.findtext('AtcoCode', '')
@@ -31,18 +76,39 @@ class Stop:
 
 
 class Route:
+    __slots__ = ('id', 'route_section_refs')
+
     def __init__(self, element):
         self.id = element.get('id')
         self.route_section_refs = [section.text for section in element.findall('RouteSectionRef')]
 
 
 class RouteSection:
+    __slots__ = ('id', 'links')
+
     def __init__(self, element):
         self.id = element.get('id')
         self.links = [RouteLink(link) for link in element.findall('RouteLink')]
 
 
+def get_linestring(coords):
+    """
+    Make a LineString from a flat sequence of longitudes and latitudes (numbers or strings) - [lon, lat, lon, lat...].
+    Much faster than making a Point for each pair, because it converts them all to a single WKB string at once.
+    Raises ValueError if any are missing (None) or not numbers
+    """
+    coords = numpy.asarray(coords, dtype='<f8')  # (None becomes NaN)
+    if numpy.isnan(coords).any():
+        raise ValueError('missing or invalid coordinates')
+    if coords.size < 4:
+        return LineString(coords.reshape(-1, 2))  # empty, or too short (ValueError)
+    wkb = struct.pack('<BII', 1, 2, coords.size // 2) + coords.tobytes()  # little endian, type 2 (LineString)
+    return GEOSGeometry(memoryview(wkb))
+
+
 class RouteLink:
+    __slots__ = ('id', 'from_stop', 'to_stop', 'track')
+
     def __init__(self, element):
         self.id = element.get('id')
         self.from_stop = element.findtext('From/StopPointRef')
@@ -50,15 +116,17 @@ class RouteLink:
         locations = element.findall('Track/Mapping/Location/Translation')
         if not locations:
             locations = element.findall('Track/Mapping/Location')
-        locations = (
-            GEOSGeometry(f"POINT({location.findtext('Longitude')} {location.findtext('Latitude')})")
-            for location in locations
-        )
-        self.track = LineString(*locations)
+        coords = []
+        for location in locations:
+            coords.append(location.findtext('Longitude'))
+            coords.append(location.findtext('Latitude'))
+        self.track = get_linestring(coords)
 
 
 class JourneyPattern:
     """A collection of JourneyPatternSections, in order."""
+    __slots__ = ('id', 'sections', 'route_ref', 'direction', 'operating_profile')
+
     def __init__(self, element, sections, serviced_organisations):
         self.id = element.attrib.get('id')
         self.sections = [
@@ -88,6 +156,8 @@ class JourneyPattern:
 
 class JourneyPatternSection:
     """A collection of JourneyPatternStopUsages, in order."""
+    __slots__ = ('id', 'timinglinks')
+
     def __init__(self, element, stops):
         self.id = element.get('id')
         self.timinglinks = [
@@ -98,6 +168,8 @@ class JourneyPatternSection:
 
 class JourneyPatternStopUsage:
     """Either a 'From' or 'To' element in TransXChange."""
+    __slots__ = ('activity', 'sequencenumber', 'stop', 'timingstatus', 'wait_time')
+
     def __init__(self, element, stops):
         self.activity = element.findtext('Activity')
 
@@ -111,24 +183,23 @@ class JourneyPatternStopUsage:
 
         self.timingstatus = element.findtext('TimingStatus')
 
-        self.wait_time = element.find('WaitTime')
+        # in seconds
+        self.wait_time = element.findtext('WaitTime')
         if self.wait_time is not None:
-            self.wait_time = parse_duration(self.wait_time.text)
-            if self.wait_time.total_seconds() > 10000:
+            self.wait_time = parse_seconds(self.wait_time)
+            if self.wait_time > 10000:
                 # bad data detected
-                logger.warning(f"long wait time {self.wait_time} at stop {self.stop}")
+                logger.warning(f"long wait time {datetime.timedelta(seconds=self.wait_time)} at stop {self.stop}")
                 self.wait_time = None
 
-        self.row = None
-        self.parent = None
-
 
 class JourneyPatternTimingLink:
+    __slots__ = ('origin', 'destination', 'runtime', 'id', 'route_link_ref')
+
     def __init__(self, element, stops):
         self.origin = JourneyPatternStopUsage(element.find('From'), stops)
         self.destination = JourneyPatternStopUsage(element.find('To'), stops)
-        self.origin.parent = self.destination.parent = self
-        self.runtime = parse_duration(element.find('RunTime').text)
+        self.runtime = parse_seconds(element.find('RunTime').text)  # in seconds
         self.id = element.get('id')
         self.route_link_ref = element.findtext('RouteLinkRef')
 
@@ -150,42 +221,65 @@ def get_deadrun_ref(deadrun_element):
 
 
 class VehicleJourneyTimingLink:
+    """Overrides the run time or wait times of a JourneyPatternTimingLink, for one VehicleJourney (in seconds)"""
+    __slots__ = (
+        'id', 'journeypatterntiminglinkref', 'run_time', 'from_wait_time', 'to_wait_time',
+        'from_activity', 'to_activity'
+    )
+
     def __init__(self, element):
         self.id = element.attrib.get('id')
         self.journeypatterntiminglinkref = element.find('JourneyPatternTimingLinkRef').text
         self.run_time = element.findtext('RunTime')
         if self.run_time is not None:
-            self.run_time = parse_duration(self.run_time)
+            self.run_time = parse_seconds(self.run_time)
 
         self.from_wait_time = element.findtext('From/WaitTime')
         if self.from_wait_time is not None:
-            self.from_wait_time = parse_duration(self.from_wait_time)
+            self.from_wait_time = parse_seconds(self.from_wait_time)
 
         self.to_wait_time = element.findtext('To/WaitTime')
         if self.to_wait_time is not None:
-            self.to_wait_time = parse_duration(self.to_wait_time)
+            self.to_wait_time = parse_seconds(self.to_wait_time)
 
         self.from_activity = element.findtext('From/Activity')
         self.to_activity = element.findtext('To/Activity')
 
 
 class VehicleType:
+    __slots__ = ('code', 'description')
+
     def __init__(self, element):
         self.code = element.findtext('VehicleTypeCode')
         self.description = element.findtext('Description')
 
 
 class Block:
+    __slots__ = ('code', 'description')
+
     def __init__(self, element):
         self.code = element.findtext('BlockNumber')
         self.description = element.findtext('Description')
 
 
 class VehicleJourney:
-    """A scheduled journey that happens at most once per day"""
+    """A scheduled journey that happens at most once per day.
+    Times are only worked out (from the JourneyPattern's timing links) when get_times() is iterated
+    """
+    __slots__ = (
+        'code', 'private_code', 'ticket_machine_journey_code', 'ticket_machine_service_code', 'block',
+        'vehicle_type', 'garage_ref', 'service_ref', 'line_ref', 'journey_ref', 'journey_pattern',
+        'operating_profile', 'departure_seconds', 'start_deadrun', 'end_deadrun', 'operator', 'sequencenumber',
+        'timing_links', 'notes'
+    )
+
     def __str__(self):
         return str(self.departure_time)
 
+    @property
+    def departure_time(self):
+        return datetime.timedelta(seconds=self.departure_seconds)
+
     def __init__(self, element, services, serviced_organisations):
         self.code = element.find('VehicleJourneyCode').text
         self.private_code = element.findtext('PrivateCode')
@@ -220,10 +314,10 @@ class VehicleJourney:
             self.operating_profile = OperatingProfile(self.operating_profile, serviced_organisations)
 
         hours, minutes, seconds = element.find('DepartureTime').text.split(':')
-        self.departure_time = datetime.timedelta(hours=int(hours), minutes=int(minutes), seconds=int(seconds))
+        self.departure_seconds = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
         departure_day_shift = element.findtext('DepartureDayShift')
         if departure_day_shift:
-            self.departure_time += datetime.timedelta(days=int(departure_day_shift))
+            self.departure_seconds += int(departure_day_shift) * 86400
 
         self.start_deadrun, self.end_deadrun = get_deadruns(element)
 
@@ -232,28 +326,31 @@ class VehicleJourney:
         sequencenumber = element.get('SequenceNumber')
         self.sequencenumber = sequencenumber and int(sequencenumber)
 
-        timing_links = element.findall('VehicleJourneyTimingLink')
-        self.timing_links = [VehicleJourneyTimingLink(timing_link) for timing_link in timing_links]
-
-        note_elements = element.findall('Note')
-        if note_elements is not None:
-            self.notes = {
-                note_element.find('NoteCode').text: note_element.find('NoteText').text
-                for note_element in note_elements
-            }
+        # {JourneyPatternTimingLinkRef: VehicleJourneyTimingLink} - most journeys don't have any
+        self.timing_links = None
+        for timing_link in element.findall('VehicleJourneyTimingLink'):
+            timing_link = VehicleJourneyTimingLink(timing_link)
+            if self.timing_links is None:
+                self.timing_links = {}
+            self.timing_links[timing_link.journeypatterntiminglinkref] = timing_link
+
+        self.notes = {
+            note_element.find('NoteCode').text: note_element.find('NoteText').text
+            for note_element in element.findall('Note')
+        }
 
     def get_timinglinks(self):
         pattern_links = self.journey_pattern.get_timinglinks()
-        journey_links = {
-            link.journeypatterntiminglinkref: link
-            for link in self.timing_links
-        }
-        for link in pattern_links:
-            yield link, journey_links.get(link.id)
+        if self.timing_links is None:
+            for link in pattern_links:
+                yield link, None
+        else:
+            for link in pattern_links:
+                yield link, self.timing_links.get(link.id)
 
     def get_times(self):
         stopusage = None
-        time = self.departure_time
+        time = self.departure_seconds
         deadrun = self.start_deadrun is not None
         deadrun_next = False
         wait_time = None
@@ -272,10 +369,11 @@ class VehicleJourney:
 
                 if wait_time:
                     next_time = time + wait_time
-                    yield Cell(stopusage, time, next_time)
+                    yield Cell(stopusage, get_timedelta(time), get_timedelta(next_time))
                     time = next_time
                 else:
-                    yield Cell(stopusage, time, time)
+                    time_delta = get_timedelta(time)
+                    yield Cell(stopusage, time_delta, time_delta)
 
                 if journey_timinglink and journey_timinglink.run_time is not None:
                     run_time = journey_timinglink.run_time
@@ -299,11 +397,14 @@ class VehicleJourney:
                     wait_time = stopusage.wait_time
 
         if not deadrun:
-            yield Cell(timinglink.destination, time, time)
+            time_delta = get_timedelta(time)
+            yield Cell(timinglink.destination, time_delta, time_delta)
 
 
 class ServicedOrganisation:
     """Like a school, college, or workplace"""
+    __slots__ = ('code', 'name', 'working_days', 'holidays')
+
     def __init__(self, element):
         self.code = element.find('OrganisationCode').text
         self.name = element.findtext('Name')
@@ -320,6 +421,13 @@ class ServicedOrganisation:
         else:
             self.holidays = []
 
+    def get_hash(self):
+        return (
+            self.code, self.name,
+            tuple(date_range.get_hash() for date_range in self.working_days),
+            tuple(date_range.get_hash() for date_range in self.holidays)
+        )
+
 
 class ServicedOrganisationDayType:
     operation_holidays = None
@@ -361,8 +469,28 @@ class ServicedOrganisationDayType:
                 self.operation_holidays = self.non_operation_working_days
                 self.non_operation_working_days = None
 
+    def get_hash(self):
+        return tuple(
+            serviced_organisation and serviced_organisation.get_hash() for serviced_organisation in (
+                self.operation_holidays, self.operation_working_days,
+                self.non_operation_holidays, self.non_operation_working_days
+            )
+        )
+
+
+def get_bank_holidays(element):
+    """Given a BankHolidayOperation/DaysOfOperation (or similar) element,
+    return a tuple of (name, date, description) tuples - date and description are only for OtherPublicHolidays
+    """
+    if element is not None:
+        return tuple(
+            (child.tag, child.findtext('Date'), child.findtext('Description')) for child in element
+        )
+
 
 class DayOfWeek:
+    __slots__ = ('day',)
+
     def __init__(self, day):
         if isinstance(day, int):
             self.day = day
@@ -379,12 +507,15 @@ class DayOfWeek:
 
 
 class OperatingProfile:
-    serviced_organisation_day_type = None
-    nonoperation_days = ()
-    operation_days = ()
+    __slots__ = (
+        'regular_days', 'nonoperation_days', 'operation_days', 'serviced_organisation_day_type',
+        'operation_bank_holidays', 'nonoperation_bank_holidays', 'hash'
+    )
 
     def __init__(self, element, serviced_organisations):
-        element = element
+        self.nonoperation_days = ()
+        self.operation_days = ()
+        self.serviced_organisation_day_type = None
 
         week_days = element.find('RegularDayType/DaysOfWeek')
         self.regular_days = []
@@ -427,18 +558,28 @@ class OperatingProfile:
 
         # Bank Holidays
 
-        self.operation_bank_holidays = element.find('BankHolidayOperation/DaysOfOperation')
-        self.nonoperation_bank_holidays = element.find('BankHolidayOperation/DaysOfNonOperation')
+        self.operation_bank_holidays = get_bank_holidays(element.find('BankHolidayOperation/DaysOfOperation'))
+        self.nonoperation_bank_holidays = get_bank_holidays(element.find('BankHolidayOperation/DaysOfNonOperation'))
 
         if not self.operation_bank_holidays:
             holidays_only = element.find('RegularDayType/HolidaysOnly')
             if holidays_only is not None:
-                self.operation_bank_holidays = element.find('RegularDayType')
-
-        self.hash = ET.tostring(element)
+                self.operation_bank_holidays = get_bank_holidays(element.find('RegularDayType'))
+
+        # everything that affects the Calendar, so equivalent profiles can share one
+        self.hash = (
+            tuple(day.day for day in self.regular_days),
+            tuple(date_range.get_hash() for date_range in self.nonoperation_days),
+            tuple(date_range.get_hash() for date_range in self.operation_days),
+            self.serviced_organisation_day_type and self.serviced_organisation_day_type.get_hash(),
+            self.operation_bank_holidays,
+            self.nonoperation_bank_holidays
+        )
 
 
 class DateRange:
+    __slots__ = ('start', 'end', 'note')
+
     def __init__(self, element):
         self.start = element.findtext("StartDate")
         self.end = element.findtext("EndDate")
@@ -455,8 +596,16 @@ class DateRange:
     def contains(self, date):
         return self.start <= date and (not self.end or self.end >= date)
 
+    def get_hash(self):
+        return (self.start, self.end)
+
 
 class Service:
+    __slots__ = (
+        'mode', 'operator', 'operating_profile', 'operating_period', 'public_use', 'service_code',
+        'marketing_name', 'description', 'origin', 'destination', 'vias', 'journey_patterns', 'lines'
+    )
+
     def __init__(self, element, serviced_organisations, journey_pattern_sections):
         self.mode = element.findtext('Mode', '')
 
@@ -487,7 +636,7 @@ class Service:
             self.destination = self.destination.replace('`', "'").strip()
 
         self.vias = element.find('StandardService/Vias')
-        if self.vias:
+        if self.vias is not None:
             self.vias = [via.text for via in self.vias]
 
         self.journey_patterns = {
@@ -503,6 +652,8 @@ class Service:
 
 
 class Line:
+    __slots__ = ('id', 'line_brand', 'line_name', 'outbound_description', 'inbound_description')
+
     def __init__(self, element):
         self.id = element.attrib['id']
         line_name = element.findtext('LineName') or ''
@@ -514,12 +665,134 @@ class Line:
         self.line_name = line_name.strip()
 
         if element.findtext('LineColour') or element.findtext('LineFontColour') or element.findtext('LineImage'):
-            logger.info(ET.tostring(element).decode())
+            logger.info({child.tag: child.text for child in element})
 
         self.outbound_description = element.findtext('OutboundDescription/Description')
         self.inbound_description = element.findtext('InboundDescription/Description')
 
 
+def iterparse_etree(open_file):
+    """Parse with the standard library's ElementTree (building the whole tree of each element in SEQUENCE_TAGS).
+    Yields (tag, element) for the elements in SEQUENCE_TAGS and TAGS, with namespaces removed from tags
+    """
+    for _, element in ET.iterparse(open_file):
+        if element.tag[:33] == NAMESPACE:
+            element.tag = element.tag[33:]
+        tag = element.tag
+
+        if tag not in SEQUENCE_TAGS and tag not in TAGS:
+            continue
+
+        yield tag, element
+
+        if tag in SEQUENCE_TAGS or tag == 'Garages':
+            element.clear()
+
+
+def strip_namespace(element):
+    for child in element.iter():
+        if child.tag[:33] == NAMESPACE:
+            child.tag = child.tag[33:]
+
+
+def to_etree(element):
+    """Copy an lxml element (which can't be pickled) to a standard library one"""
+    etree_element = ET.Element(element.tag, dict(element.attrib))
+    etree_element.text = element.text
+    etree_element.tail = element.tail
+    etree_element.extend(to_etree(child) for child in element)
+    return etree_element
+
+
+def clear(element):
+    """Free the memory used by an element that's been handled, and by its preceding siblings"""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def iter_children(iterator, parent):
+    """Yield each child of parent as soon as it's been parsed, then throw it away"""
+    for event, element in iterator:
+        if element is parent:  # end of parent
+            clear(parent)
+            return
+        if event == 'end' and element.getparent() is parent:
+            if element.tag[:33] == NAMESPACE:
+                strip_namespace(element)
+            yield element
+            clear(element)
+
+
+class WithoutNamespace:
+    """Wraps a file, removing the TransXChange default namespace declaration from the root element,
+    so that (usually) tags don't need to have the namespace stripped after parsing
+    """
+    def __init__(self, open_file):
+        self.open_file = open_file
+        self.start = True
+
+    def read(self, size=-1):
+        data = self.open_file.read(size)
+        if self.start:
+            self.start = False
+            data = data.replace(b' xmlns="http://www.transxchange.org.uk/"', b'', 1)
+        return data
+
+
+def iterparse_lxml(open_file):
+    """Parse with lxml, only stopping at the elements in SEQUENCE_TAGS (and their children) and TAGS.
+    Yields (tag, element), or (tag, iterator of child elements) for SEQUENCE_TAGS
+    """
+    if isinstance(open_file, io.TextIOBase):
+        # lxml can only read bytes
+        yield from iterparse_etree(open_file)
+        return
+
+    if not hasattr(open_file, 'read'):  # a path
+        with open(open_file, 'rb') as open_file:
+            yield from iterparse_lxml(open_file)
+        return
+
+    tags = [*SEQUENCE_TAGS, *TAGS]
+    for child_tags in SEQUENCE_TAGS.values():
+        tags += child_tags
+    iterator = lxml_etree.iterparse(
+        WithoutNamespace(open_file), events=('start', 'end'), tag=[f'{{*}}{tag}' for tag in tags],
+        remove_comments=True, remove_pis=True, huge_tree=True
+    )
+
+    for event, element in iterator:
+        tag = element.tag
+        if tag[:33] == NAMESPACE:
+            tag = tag[33:]
+
+        if event == 'start':
+            if tag in SEQUENCE_TAGS:
+                yield tag, iter_children(iterator, element)
+        elif tag in TAGS:
+            if element.tag != tag:
+                strip_namespace(element)
+            if tag in KEPT_TAGS:
+                yield tag, to_etree(element)
+            else:
+                yield tag, element
+            if tag == 'Garages':
+                element.clear()  # is inside an Operator element, so keep its siblings
+            else:
+                clear(element)
+
+
+PARSERS = {
+    'etree': iterparse_etree,
+    'lxml': iterparse_lxml,
+}
+# lxml's find() and findtext() are much slower than ElementTree's, so lxml is only worth using to save memory
+DEFAULT_PARSER = 'etree'
+
+
 class TransXChange:
     def get_journeys(self, service_code, line_id):
         return [journey for journey in self.journeys
@@ -533,6 +806,8 @@ class TransXChange:
             )
         }
 
+        operating_profiles = {}
+
         # Some Journeys do not have a direct reference to a JourneyPattern,
         # but rather a reference to another Journey which has a reference to a JourneyPattern
         for journey in iter(journeys.values()):
@@ -543,10 +818,16 @@ class TransXChange:
                 if journey.operating_profile is None:
                     journey.operating_profile = referenced_journey.operating_profile
 
+            # lots of journeys have identical OperatingProfiles - only keep one copy of each
+            if journey.operating_profile is not None:
+                journey.operating_profile = operating_profiles.setdefault(
+                    journey.operating_profile.hash, journey.operating_profile
+                )
+
         return [journey for journey in journeys.values() if journey.journey_pattern]
 
-    def __init__(self, open_file):
-        iterator = ET.iterparse(open_file)
+    def __init__(self, open_file, parser=DEFAULT_PARSER):
+        iterator = PARSERS[parser](open_file)
 
         self.services = {}
         self.stops = {}
@@ -559,26 +840,19 @@ class TransXChange:
 
         journey_pattern_sections = {}
 
-        for _, element in iterator:
-            if element.tag[:33] == '{http://www.transxchange.org.uk/}':
-                element.tag = element.tag[33:]
-            tag = element.tag
-
+        for tag, element in iterator:
             if tag == 'StopPoints':
                 for stop_element in element:
                     stop = Stop(stop_element)
                     self.stops[stop.atco_code] = stop
-                element.clear()
             elif tag == 'RouteSections':
                 for section_element in element:
                     section = RouteSection(section_element)
                     self.route_sections[section.id] = section
-                element.clear()
             elif tag == 'Routes':
                 for route_element in element:
                     route = Route(route_element)
                     self.routes[route.id] = route
-                element.clear()
             elif tag == 'Operators':
                 self.operators = element
             elif tag == 'JourneyPatternSections':
@@ -586,7 +860,6 @@ class TransXChange:
                     section = JourneyPatternSection(section, self.stops)
                     if section.timinglinks:
                         journey_pattern_sections[section.id] = section
-                element.clear()
             elif tag == 'ServicedOrganisations':
                 serviced_organisations = (ServicedOrganisation(child) for child in element)
                 serviced_organisations = {
@@ -598,19 +871,18 @@ class TransXChange:
                 except (AttributeError, KeyError) as e:
                     logger.error(e, exc_info=True)
                     return
-                element.clear()
             elif tag == 'Service':
                 service = Service(element, serviced_organisations, journey_pattern_sections)
                 self.services[service.service_code] = service
             elif tag == 'Garages':
                 for garage_element in element:
                     self.garages[garage_element.findtext('GarageCode')] = garage_element
-                element.clear()
-
-        self.attributes = element.attrib
+            elif tag == 'TransXChange':
+                self.attributes = dict(element.attrib)
 
 
 class Cell:
+    __slots__ = ('stopusage', 'arrival_time', 'departure_time', 'wait_time')
     last = False
 
     def __init__(self, stopusage, arrival_time, departure_time):
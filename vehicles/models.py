@@ -11,13 +11,13 @@ from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
 from django.core.serializers.json import DjangoJSONEncoder
 from django.core.exceptions import ValidationError
-from django.db.models import Q, F
+from django.db.models import Q
 from django.db.models.functions import TruncDate, Upper
 from django.urls import reverse
 from django.utils.html import escape, format_html
 from django.utils import timezone
 from busstops.models import Operator, Service, DataSource, SIRISource
-from bustimes.models import get_calendars, get_routes, Trip, RouteLink
+from bustimes.models import get_calendars, prefetch_stop_times, Trip, RouteLink
 
 
 def format_reg(reg):
@@ -667,7 +667,7 @@ class VehicleJourney(models.Model):
         if not datetime:
             datetime = self.datetime
 
-        routes = get_routes(self.service.route_set.select_related('source'))
+        routes = Service.get_current_route_ids([self.service_id])[self.service_id]
         if not routes:
             return
         trips = Trip.objects.filter(route__in=routes)
@@ -733,21 +733,38 @@ class VehicleJourney(models.Model):
             pass
 
     def get_progress(self, location):
+        """The RouteLink nearest a location, between two of the trip's stops (in the trip's order) -
+        with from_stoptime and to_stoptime, the trip's StopTimes at the link's start and the stop after it
+        """
         point = Point(location["coordinates"][0], location["coordinates"][1], srid=4326)
 
-        trip = self.trip_id
+        trip = Trip.objects.filter(id=self.trip_id).prefetch_related(*prefetch_stop_times()).first()
+        if trip is None:
+            return
+        stop_times = trip.stop_times
+
+        # where each stop comes in the trip
+        positions = {}
+        for i, stop_time in enumerate(stop_times):
+            if stop_time.stop_id:
+                positions.setdefault(stop_time.stop_id, []).append(i)
 
-        return RouteLink.objects.filter(
+        route_links = RouteLink.objects.filter(
             geometry__bboverlaps=point.buffer(0.001),
             service=self.service_id,
-            from_stop__stoptime__trip=trip,
-            to_stop__stoptime__trip=trip,
-            to_stop__stoptime__id__gt=F('from_stop__stoptime__id')
+            from_stop__in=positions,
+            to_stop__in=positions
         ).annotate(
-            distance=models.functions.Distance('geometry', point),
-            from_stoptime=F('from_stop__stoptime'),
-            to_stoptime=F('to_stop__stoptime')
-        ).order_by('distance').first()
+            distance=models.functions.Distance('geometry', point)
+        ).order_by('distance')
+
+        for route_link in route_links:
+            last_to_position = positions[route_link.to_stop_id][-1]
+            for i in positions[route_link.from_stop_id]:
+                if i < last_to_position:
+                    route_link.from_stoptime = stop_times[i]
+                    route_link.to_stoptime = stop_times[i + 1]
+                    return route_link
 
 
 class JourneyCode(models.Model):
@@ -9,7 +9,7 @@ from django.db import IntegrityError
 from django.db.models import Exists, OuterRef, Min, F, Case, When, Q
 from django.db.models.functions import Coalesce
 from django.core.cache import cache
-from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.postgres.aggregates import StringAgg
@@ -23,7 +23,7 @@ from django.utils import timezone
 from buses.utils import varnish_ban
 from busstops.utils import get_bounding_box
 from busstops.models import Operator, Service
-from bustimes.models import Garage, Trip, StopTime
+from bustimes.models import Garage, Trip
 from disruptions.views import siri_sx
 from .models import Vehicle, VehicleJourney, VehicleEdit, VehicleEditFeature, VehicleRevision, Livery, VehicleEditVote
 from .forms import EditVehiclesForm, EditVehicleForm
@@ -335,7 +335,7 @@ def vehicles_json(request):
                         'prev_stop': progress.from_stop_id,
                         'next_stop': progress.to_stop_id,
                     }
-                    prev_stop, next_stop = StopTime.objects.filter(trip=trip, id__gte=progress.from_stoptime)[:2]
+                    prev_stop, next_stop = progress.from_stoptime, progress.to_stoptime
                     when = parse_datetime(item['datetime'])
                     when = datetime.timedelta(hours=when.hour, minutes=when.minute, seconds=when.second)
 
@@ -684,10 +684,9 @@ def journey_json(request, pk):
 
     trip = None
     if journey.trip_id:
-        try:
-            trip = journey.trip
-        except ObjectDoesNotExist:
-            pass
+        trip = Trip.objects.filter(id=journey.trip_id).prefetch_related(
+            'stoptime_set__stop__locality', 'timing_pattern__timingpatternstop_set__stop__locality'
+        ).first()
 
     if trip:
         data['stops'] = [{
@@ -696,7 +695,7 @@ def journey_json(request, pk):
             'aimed_departure_time': stop_time.departure_time(),
             'minor': stop_time.is_minor(),
             'coordinates': stop_time.stop and stop_time.stop.latlong and stop_time.stop.latlong.coords
-        } for stop_time in trip.stoptime_set.select_related('stop__locality')]
+        } for stop_time in trip.stop_times]
 
     try:
         locations = redis_client.lrange(f'journey{pk}', 0, -1)